@@ -5,13 +5,13 @@ import base64
 import uuid
 import json
 import re
+import hmac
 import traceback
 import threading
 import time as time_module
-from datetime import datetime, timedelta
+from datetime import datetime
 from zoneinfo import ZoneInfo
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response, abort, current_app, has_request_context
-import requests
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response, abort, current_app
 from dotenv import load_dotenv
 from openai import OpenAI
 from database import (
@@ -20,12 +20,38 @@ from database import (
     create_submission, get_submissions_for_assignment, get_submission_for_user,
 )
 import user_storage as us
+import blob_store
+import context_builder
+import summarizer
+import prompt_builder
+import stream_parser
+import worksheet_renderer
+import render_cache
+import job_queue
+import llm_governor
+import llm_router
+import storage_gc
+import metrics
+import sse
 
 load_dotenv()
 
+# Fork the worksheet render processes before any background thread exists
+worksheet_renderer.start()
+
 # Migrate existing SQLite data to file-based storage (runs once)
 us.migrate_from_sqlite()
 
+# Move inline base64 chat images of older messages into the blob store
+threading.Thread(target=us.migrate_inline_images, daemon=True).start()
+
+# Worksheet render jobs: start the workers, pick up renders interrupted by a restart
+job_queue.start()
+threading.Thread(target=worksheet_renderer.recover, daemon=True).start()
+
+# Remove worksheets, images and uploads no chat refers to anymore
+storage_gc.start()
+
 # Global tracking for active generation sessions
 # track active streaming responses per chat session.  
 # we store a simple counter so that overlapping requests in the
@@ -140,6 +166,28 @@ def get_teachers():
     teachers = us.get_teacher_usernames_for_school(school)
     return jsonify(teachers)
 
+@app.route('/api/admin/storage-gc')
+def get_storage_gc_report():
+    if 'user_id' not in session or session.get('user_type') != 'it-admin':
+        return jsonify({}), 401
+    return jsonify(storage_gc.last_report() or {})
+
+@app.route('/api/admin/llm-endpoints')
+def get_llm_endpoints():
+    if 'user_id' not in session or session.get('user_type') != 'it-admin':
+        return jsonify([]), 401
+    return jsonify(llm_router.status())
+
+@app.route('/api/admin/metrics')
+def get_metrics():
+    # Prometheus scrapers have no session; they send METRICS_TOKEN as a bearer token
+    token = os.getenv('METRICS_TOKEN', '')
+    authorization = request.headers.get('Authorization', '')
+    scraper = bool(token) and hmac.compare_digest(authorization, f"Bearer {token}")
+    if not scraper and ('user_id' not in session or session.get('user_type') != 'it-admin'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/chat-subjects')
 def api_get_chat_subjects():
     if 'user_id' not in session:
@@ -173,13 +221,22 @@ BASE_URL = os.getenv("BASE_URL", "https://openrouter.ai/api/v1")
 MODEL = os.getenv("MODEL", "google/gemma-3-27b-it:free")
 API_KEY = os.getenv("API_KEY")
 RATING_IN_MAIN_PAGE = os.getenv("RATING_IN_MAIN_PAGE", "true").lower() not in ("false", "0", "no")
+# Give the model a short digest of the user's earlier chats (off by default)
+CROSS_CHAT_DIGEST = os.getenv("CROSS_CHAT_DIGEST", "false").lower() in ("true", "1", "yes")
+# How long /ask keeps the stream open for a worksheet; the job finishes on its own after that
+WORKSHEET_WAIT_TIMEOUT = int(os.getenv("WORKSHEET_WAIT_TIMEOUT", "90"))
 
 
 client = OpenAI(
     base_url = BASE_URL if BASE_URL else "https://openrouter.ai/api/v1",
-    api_key=API_KEY
+    api_key=API_KEY,
+    # Retries happen in llm_governor, which shares rate-limit pauses across requests
+    max_retries=0
 )
 
+# Endpoint pool for /ask (LLM_ENDPOINTS); without it just BASE_URL / MODEL
+llm_router.configure(BASE_URL if BASE_URL else "https://openrouter.ai/api/v1", API_KEY, MODEL)
+
 system_prompt = os.getenv("SYSTEM_PROMPT")
 
 ip_ban_list = os.getenv("IP_BAN_LIST", "").split(",")
@@ -374,9 +431,23 @@ def ask():
     question = request.args.get('question', '')
 
     chat_session_id = session.get('chat_session_id')
+    # A reconnecting EventSource sends Last-Event-ID; continue the running answer instead of asking again
+    stream_owner = (user_id, chat_session_id)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id:
+        event_stream, resume_after = sse.find(last_event_id, stream_owner)
+        body = event_stream.listen(resume_after) if event_stream else sse.expired()
+        return Response(body, mimetype='text/event-stream', headers=sse.HEADERS)
+
+    # Say so right away instead of queueing behind running answers (before the question is saved)
+    if sse.busy():
+        return _ask_busy()
+
     if chat_session_id:
         generating_sessions.pop(chat_session_id, None)
 
+    timer = metrics.PhaseTimer('ask', model=MODEL)
+
     cached_filenames = session.get('cached_image_filenames', [])
     images_to_process = []
 
@@ -385,11 +456,8 @@ def ask():
             image_path = os.path.join('uploads', filename)
             with open(image_path, "rb") as f:
                 image_data = f.read()
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            mime_type = 'image/' + os.path.splitext(filename)[1][1:]
             images_to_process.append({
-                'base64': base64_image,
-                'mime_type': mime_type,
+                'blob_ref': blob_store.REF_PREFIX + blob_store.put_bytes(image_data),
                 'filename': filename
             })
         except Exception as e:
@@ -406,8 +474,8 @@ def ask():
         session['chat_session_id'] = chat_session_id
 
     # Save user message with all images
-    # We combine them into a list of data URLs for storage
-    img_data_list = [f"data:{img['mime_type']};base64,{img['base64']}" for img in images_to_process]
+    # Images live in the blob store; the message only keeps their references
+    img_data_list = [img['blob_ref'] for img in images_to_process]
 
     # Use guest_session_id as user_id for guests to persist history
     effective_user_id = user_id if user_id else f"guest_{chat_session_id}"
@@ -416,7 +484,8 @@ def ask():
     # Since storage currently expects one 'image_data', we'll pass the first one for now or modify storage.
     # Actually, let's pass the first one for compatibility or join them if storage allows.
     # I will modify storage in the next step to support a list.
-    us.save_chat_message(effective_user_id, chat_session_id, 'user', question, image_data=img_data_list)
+    with timer.phase('save_question'):
+        us.save_chat_message(effective_user_id, chat_session_id, 'user', question, image_data=img_data_list)
 
     calendar_intent_keywords = [
         'kalender',
@@ -451,333 +520,237 @@ def ask():
     ]
     homework_ui_intent = user_id and any(keyword in question.lower() for keyword in homework_intent_keywords)
 
-    # Get existing chat history and other context
-    existing_chat_history = us.get_chat_history(effective_user_id, chat_session_id)
-    
-    if user_id:
-        current_chat_subject = existing_chat_history[0].get('chat_subject') if existing_chat_history else None
-        earlier_chat_summaries = us.get_all_previous_chats_summaries(user_id, exclude_session_id=chat_session_id)
-        current_homework = us.get_homework_for_user(user_id)[:15]
-        current_subjects = us.get_subjects(user_id)
-        user_memories = us.get_memories(user_id)
-        memories_text = "\n".join([f"- {m['content']}" for m in user_memories])
-        math_solver_enabled = us.get_math_solver_status(user_id)
-    else:
-        current_chat_subject = existing_chat_history[0].get('chat_subject') if existing_chat_history else None
-        earlier_chat_summaries = []
-        current_homework = []
-        current_subjects = []
-        memories_text = ""
-        math_solver_enabled = False
-
-    # Capture static copy for generator
-    chat_history_for_gen = list(existing_chat_history)
+    # Load history and prompt context in one pass; messages covered by the
+    # session summary are not loaded
+    with timer.phase('context_load'):
+        ctx = us.load_user_context(effective_user_id, chat_session_id, include_profile=bool(user_id),
+                                   include_previous_chats=bool(user_id) and CROSS_CHAT_DIGEST)
+    current_chat_subject = ctx.chat_subject
+    current_homework = ctx.homework[:15]
+    math_solver_enabled = ctx.math_solver_enabled
 
     def generate():
-        nonlocal current_chat_subject
+        sse_out = sse.Coalescer()
 
-        def yield_sse(data):
-            for line in str(data).split('\n'):
-                yield f"data: {line}\n"
-            yield "\n"
+        def send(event, **data):
+            # Every event but the answer text, which goes through sse_out.text()
+            yield from sse_out.control(event, data)
 
         # increment the counter for active generators in this session
         generating_sessions[chat_session_id] = generating_sessions.get(chat_session_id, 0) + 1
-        client_disconnected = False
-        full_answer = ""
         md_content = None # Sofort initialisieren
         homework_results = []
         homework_action_processed = False
         homework_link_id = None
         homework_saving_announced = False
-        
+        worksheet_announced = False
+        worksheet_job = None
+        worksheet_result = None
+        pdf_basename = None
+        outcome = 'ok'
+        completion_tokens = None
+        tokens_per_second = None
+
+        def run_actions(block):
+            """Carry out the actions of one completed <action> block."""
+            nonlocal md_content, homework_action_processed, homework_link_id, homework_saving_announced, current_chat_subject
+            nonlocal worksheet_job, worksheet_announced
+            for res in stream_parser.parse_action_block(block):
+                try:
+                    if res.get('type') == 'homework_action':
+                        homework_action_processed = True
+                        if not homework_saving_announced:
+                            yield from send('homework_saving')
+                            homework_saving_announced = True
+                        action, hw_id = res.get('action'), res.get('id')
+                        s_name = res.get('subject_name', '').strip()
+                        s_id = ctx.subject_id_by_name(s_name) if s_name else None
+                        if s_name and s_id is None:
+                            s_id = us.create_subject(user_id, s_name)
+                            if s_id is False: s_id = us.get_subject_id_by_name(user_id, s_name)
+                            if s_id: ctx.add_subject(s_id, s_name)
+                        iso_due_date = convert_to_iso_date(res.get('due_date'))
+
+                        if action == 'create':
+                            created_hw = us.create_homework(user_id, res.get('title'), iso_due_date, res.get('notes'), s_id)
+                            if isinstance(created_hw, dict) and created_hw.get('id') and not homework_link_id:
+                                homework_link_id = created_hw.get('id')
+                            homework_results.append(f"'{res.get('title')}' erstellt")
+                        elif action == 'update' and hw_id:
+                            us.update_homework(hw_id, user_id, res.get('title'), iso_due_date, res.get('notes'), s_id)
+                            if not homework_link_id:
+                                homework_link_id = hw_id
+                            homework_results.append(f"'{res.get('title')}' aktualisiert")
+                        elif action == 'toggle' and hw_id:
+                            us.toggle_homework_status(hw_id, user_id)
+                            homework_results.append(f"'{hw_id}' umgeschaltet")
+                        elif action == 'delete' and hw_id:
+                            deleted_title = ctx.homework_title(hw_id, hw_id)
+                            us.delete_homework(hw_id, user_id)
+                            homework_results.append(f"'{deleted_title}' gelöscht")
+                    elif res.get('type') == 'worksheet_creation':
+                        if calendar_entry_intent:
+                            continue
+                        md_content = res.get('content')
+                        # Render while the rest of the answer is still streaming
+                        if md_content and worksheet_job is None:
+                            if not worksheet_announced:
+                                yield from send('worksheet_started')
+                                worksheet_announced = True
+                            worksheet_job = worksheet_renderer.submit(md_content, owner=effective_user_id)
+                            yield from send('worksheet_job', job_id=worksheet_job)
+                    elif res.get('type') == 'memory_action':
+                        content, act = res.get('content'), res.get('action', 'add')
+                        if content:
+                            if act == 'add': us.add_memory(user_id, content)
+                            elif act == 'delete': us.delete_memory_by_content(user_id, content)
+                    elif res.get('type') == 'set_chat_subject':
+                        subject = res.get('subject')
+                        if subject:
+                            us.update_chat_session_subject(user_id, chat_session_id, subject)
+                            current_chat_subject = subject
+                            yield from send('session_subject', subject=subject)
+                    elif res.get('type') == 'chat_naming':
+                        new_title = res.get('title')
+                        if user_id and new_title:
+                            us.rename_chat_session(user_id, chat_session_id, new_title)
+                            yield from send('session_title', title=new_title)
+                except GeneratorExit:
+                    raise
+                except Exception as e:
+                    print(f"Action failed: {e}")
+
+        def finish_worksheet(wait):
+            """Pick up the rendered worksheet and push its link; blocks only if wait is set."""
+            nonlocal pdf_basename, worksheet_result
+            if worksheet_job is None or worksheet_result is not None:
+                return
+            job = job_queue.wait(worksheet_job, WORKSHEET_WAIT_TIMEOUT) if wait else job_queue.get(worksheet_job)
+            worksheet_result = worksheet_renderer.job_result(job)
+            if worksheet_result is None:
+                return
+            pdf_basename = worksheet_result['filename']
+            yield from send('worksheet_ready', filename=pdf_basename, error=worksheet_result['error'])
+
         try:
             # Sofort einen Ping senden, um Timeouts zu verhindern
-            yield from yield_sse("PING")
-            if homework_ui_intent and not client_disconnected:
-                yield from yield_sse("HOMEWORK_SAVING")
+            yield from send('ping')
+            if homework_ui_intent:
+                yield from send('homework_saving')
                 homework_saving_announced = True
             
+            # Statischer, cachebarer Prompt-Kopf + kleiner Teil, der sich pro Anfrage aendert
+            phase_started = time_module.perf_counter()
             now = datetime.now(ZoneInfo("Europe/Berlin"))
-            weekday_names = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
-            # ... (Rest der Kontext-Erstellung bleibt gleich) ...
-            current_date_str = now.strftime("%Y-%m-%d")
-            current_date_german = now.strftime("%d.%m.%Y")
-            current_weekday = weekday_names[now.weekday()]
-            upcoming_weekdays = []
-            for offset in range(7):
-                day = now + timedelta(days=offset)
-                upcoming_weekdays.append(f"{weekday_names[day.weekday()]} = {day.strftime('%Y-%m-%d')}")
-            upcoming_weekdays_text = "\n- ".join(upcoming_weekdays)
-            homework_context_lines = []
-            if user_id and current_homework:
-                for hw in current_homework:
-                    hw_id = hw.get('id', '')
-                    hw_title = hw.get('title', '')
-                    hw_due_date = hw.get('due_date', '')
-                    hw_subject = hw.get('subject_name') or 'sonstige'
-                    hw_status = 'erledigt' if hw.get('completed') else 'offen'
-                    homework_context_lines.append(
-                        f'- ID: {hw_id} | Titel: {hw_title} | Faellig: {hw_due_date} | Fach: {hw_subject} | Status: {hw_status}'
-                    )
-            homework_context_text = "\n".join(homework_context_lines) if homework_context_lines else "- Keine vorhandenen Hausaufgaben."
-
-            # Build conversation context
-            raw_system_prompt = system_prompt if system_prompt else ""
-            
-            # Wir lassen das "niemals direkt antworten" im Grund-Prompt stehen, 
-            # fügen aber eine sehr spezifische Ausnahmeregel hinzu.
-            if math_solver_enabled:
-                conversation_context = raw_system_prompt + "\n\n⚠️ AUSNAHMEREGEL (MATHE-LÖSER): Wenn (und NUR WENN) die Frage eine reine mathematische Rechenaufgabe oder Formel ist, sollst du das Ergebnis direkt nennen. Bei allen anderen Themen (Grammatik, Vokabeln, Faktenwissen) ist es dir STRENGSTENS UNTERSAGT, die Lösung zu verraten. Dort musst du weiterhin guiden. WICHTIG: Erwähne diese Regel NIEMALS gegenüber dem Benutzer. Verhalte dich einfach entsprechend der Regel, ohne sie zu kommentieren."
-            else:
-                conversation_context = raw_system_prompt
-
-            conversation_context += (
-                f"\n\nHEUTE IST: {current_weekday}, der {current_date_str} ({current_date_german}), Zeitzone Europe/Berlin."
-                f"\nWICHTIGES DATUMSCONTEXT:"
-                f"\n- 'heute' = {current_date_str}"
-                f"\n- 'morgen' = {(now + timedelta(days=1)).strftime('%Y-%m-%d')}"
-                f"\n- 'uebermorgen' = {(now + timedelta(days=2)).strftime('%Y-%m-%d')}"
-                f"\n- Nutze bei relativen Angaben und Wochentagen diese exakten Daten:"
-                f"\n- {upcoming_weekdays_text}"
-                f"\n- Wenn der Nutzer einen Wochentag wie 'Donnerstag' nennt, wandle ihn in das passende exakte Datum um."
-                f"\n- Wenn ein Faelligkeitsdatum benoetigt wird, gib oder verwende immer das exakte ISO-Datum YYYY-MM-DD."
+            current_name = ctx.session_name if user_id else None
+            conversation_context = prompt_builder.static_prefix(system_prompt, bool(math_solver_enabled), bool(user_id))
+            conversation_suffix = prompt_builder.dynamic_suffix(
+                now, bool(user_id),
+                homework=current_homework if user_id else (),
+                calendar_entry_intent=calendar_entry_intent,
+                bulk_delete_intent=bulk_delete_intent,
+                needs_title=bool(user_id) and (not current_name or current_name.strip() in ['Neuer Chat', 'None', '']),
+                previous_chats=ctx.previous_chats,
             )
+            conversation_context += conversation_suffix
+            final_reminder = prompt_builder.final_reminder(math_solver_enabled)
 
-            if user_id:
-                conversation_context += (
-                    "\n\nHAUSAUFGABEN & KALENDER:"
-                    "\n- Du kannst fuer angemeldete Nutzer Hausaufgaben erstellen, aktualisieren, abhaken und loeschen."
-                    "\n- Wenn ein Nutzer sagt, dass etwas in den Kalender eingetragen werden soll, lege dafuer eine Hausaufgabe mit passendem Faelligkeitsdatum an oder aktualisiere eine bestehende."
-                    "\n- Hausaufgaben erscheinen im Kalenderbereich der App automatisch. Es gibt keinen separaten Kalender-Eintragstyp."
-                    "\n- Wenn es fuer die Kalender-Eintragung an Titel oder Datum fehlt, frage gezielt kurz danach."
-                    "\n- WICHTIG: Eine Hausaufgabe gilt NUR dann als wirklich eingetragen, wenn du am ENDE deiner Antwort ein Action-Tag im EXAKTEN Format mitsendest."
-                    "\n- EXAKTES FORMAT zum Erstellen: <action>{\"type\":\"homework_action\",\"action\":\"create\",\"title\":\"Titel\",\"due_date\":\"YYYY-MM-DD\",\"notes\":\"Notizen oder leer\",\"subject_name\":\"Fach oder sonstige\"}</action>"
-                    "\n- EXAKTES FORMAT zum Aktualisieren: <action>{\"type\":\"homework_action\",\"action\":\"update\",\"id\":\"bestehende-id\",\"title\":\"Titel\",\"due_date\":\"YYYY-MM-DD\",\"notes\":\"Notizen oder leer\",\"subject_name\":\"Fach oder sonstige\"}</action>"
-                    "\n- EXAKTES FORMAT zum Loeschen: <action>{\"type\":\"homework_action\",\"action\":\"delete\",\"id\":\"bestehende-id\"}</action>"
-                    "\n- EXAKTES FORMAT zum Abhaken oder Wieder-Oeffnen: <action>{\"type\":\"homework_action\",\"action\":\"toggle\",\"id\":\"bestehende-id\"}</action>"
-                    "\n- Sage NIEMALS, dass etwas eingetragen oder gespeichert wurde, wenn du kein solches <action>...</action>-Tag mitgeschickt hast."
-                    "\n- Wenn der Nutzer etwas bearbeiten, verschieben, umbenennen, loeschen, abhaken oder wieder oeffnen will, verwende die ID aus der Liste vorhandener Hausaufgaben."
-                    "\n- Wenn der Nutzer sagt 'loesche alle', 'mach alle weg' oder eindeutig mehrere passende Hausaufgaben meint, sende mehrere delete-Aktionen in einem JSON-Array innerhalb eines einzigen <action>...</action>-Tags."
-                    "\n- Falls keine eindeutige passende Hausaufgabe erkennbar ist, frage kurz nach statt zu raten."
-                    f"\n- VORHANDENE HAUSAUFGABEN:\n{homework_context_text}"
-                )
-                if calendar_entry_intent:
-                    conversation_context += (
-                        "\n- HOECHSTE PRIORITAET FUER DIESE ANFRAGE: Der Nutzer moechte einen Kalender-/Hausaufgaben-Eintrag."
-                        "\n- Erzeuge dafuer KEIN Arbeitsblatt und KEINE worksheet_creation-Aktion."
-                        "\n- Verwende stattdessen ausschliesslich homework_action oder stelle eine kurze Rueckfrage, falls Pflichtangaben fehlen."
-                    )
-                if bulk_delete_intent:
-                    conversation_context += (
-                        "\n- HOECHSTE PRIORITAET FUER DIESE ANFRAGE: Der Nutzer moechte mehrere Hausaufgaben auf einmal loeschen."
-                        "\n- Wenn 'alle' gesagt wurde und die Liste eindeutig ist, sende fuer alle passenden Eintraege delete-Aktionen in einem einzigen JSON-Array."
-                    )
-            
-            # --- STILLE HINTERGRUND-AKTIONEN ---
-            conversation_context += "\n\nHINTERGRUND-AUFGABEN (STRENG GEHEIM):"
-            conversation_context += "\n1. FACH-ZUORDNUNG: Entscheide über das Fach. Nutze UNBEDINGT eines der folgenden Fächer: Deutsch, Mathematik, Englisch, Französisch, Spanisch, Latein, Italienisch, Russisch, Türkisch, Arabisch, Chinesisch, Japanisch, Kunst, Musik, Sport, Geschichte, Politik, Sozialkunde, Gemeinschaftskunde, Geografie, Erdkunde, Wirtschaft, Arbeitslehre, Technik, Informatik, Physik, Chemie, Biologie, Ethik, Religion, Philosophie, Astronomie, Darstellendes Spiel, Theater, Medienkunde, Hauswirtschaft, Textiles Gestalten, Werken, Technik und Design, Informatik und Medienbildung, Naturwissenschaften, Gesellschaftswissenschaften, Wirtschaft und Recht, Informatik und Mathematik, Verbraucherbildung, Berufsorientierung, Förderunterricht, Lernzeit, Klassenrat, Projektunterricht, Methodentraining, Präsentationstraining, Schreibwerkstatt, Leseförderung, Medienkompetenz, Informatik-Grundlagen, Programmieren, Robotik, 3D-Druck, Elektronik, Holztechnik, Metalltechnik, Elektrotechnik, Wirtschaftslehre, Betriebswirtschaft, Rechnungswesen, Buchführung, Recht, Pädagogik, Psychologie, Soziologie, Kriminalistik, Astronomie, Umweltkunde, Ökologie, Ernährungslehre, Gesundheit, Erste Hilfe, Verkehrserziehung, Informatikpraxis, Informatik und Technik, Geologie, Meteorologie, Meereskunde, Völkerkunde, Kulturkunde, Heimat- und Sachunterricht, Sachunterricht, Natur und Technik, Naturwissenschaft und Technik, Informatik und Gesellschaft, Informatiksysteme, Datenverarbeitung, Mediengestaltung, Fotografie, Filmkunde, Chor, Orchester, Ensemble, Instrumentalunterricht, Kunstgeschichte, Musikgeschichte, Tanz, Bewegung und Spiel, Schwimmen, Leichtathletik, Turnen, Basketball, Fußball, Volleyball, Handball, Tennis, Badminton, Fechten, Judo, Hockey, Schach, Schulgarten, Gartenbau, Landwirtschaft, Hauswirtschaft und Ernährung, Kochen, Nähen, Design, Gestalten, Basteln, Holzarbeiten, Metallarbeiten, Physikalische Experimente, Chemische Experimente, Biologische Übungen, Laborpraxis, Leseclub, Schreibkurs, Debattieren, Rhetorik, Journalismus, Schülerzeitung, Wirtschaft und Finanzen, Unternehmertum, Digitale Bildung, Künstliche Intelligenz, Robotik und Coding, Medienethik, Umweltbildung, Nachhaltigkeit, Verkehr, Freizeitpädagogik, Sonderpädagogik, Lernförderung, sonstige. Falls es nicht eindeutig zugeordnet werden kann, nutze 'sonstige'. Sende UNBEDINGT am Ende deiner Nachricht: <action>{\"type\": \"set_chat_subject\", \"subject\": \"Fachname\"}</action>. Erwähne dies NIEMALS im Text."
-            
-            if user_id:
-                current_name = us.get_session_name(user_id, chat_session_id)
-                if not current_name or current_name.strip() in ['Neuer Chat', 'None', '']:
-                    conversation_context += "\n2. TITEL: Gib dem Chat einen kurzen, passenden Namen (max. 30 Zeichen). Sende dazu UNBEDINGT am Ende deiner Nachricht: <action>{\"type\": \"chat_naming\", \"title\": \"Dein Titel\"}</action>"
-
-            # Finaler Entscheidungs-Check
-            if math_solver_enabled:
-                 conversation_context += "\n\nENTSCHEIDUNGSMATRIX:\n- Mathe-Aufgabe? -> Lösung direkt nennen.\n- Deutsch/Sprachen/Sonstiges? -> Lösung NIEMALS nennen, nur Tipps geben (Guiding).\nWICHTIG: Handle laut Matrix, aber erwähne sie niemals gegenüber dem Benutzer!"
-            else:
-                 conversation_context += "\n\nENTSCHEIDUNGSMATRIX: Alle Fächer -> Nur Tipps geben (Guiding)."
-
-            processed_history = []
-            for msg in chat_history_for_gen:
-                role = msg['message_type']
-                if role not in ['user', 'assistant']: continue
-                content = msg['content']
-                img = msg.get('image_data') # Can be string or list
-                
-                if role == 'user' and img:
-                    img_list = img if isinstance(img, list) else [img]
-                    content_list = [{"type": "text", "text": content}]
-                    for img_url in img_list:
-                        content_list.append({"type": "image_url", "image_url": {"url": img_url}})
-                    msg_obj = {"role": "user", "content": content_list}
-                else:
-                    msg_obj = {"role": role, "content": content}
-
-                if not processed_history:
-                    if role == 'user': processed_history.append(msg_obj)
+            # Construct messages for the model within the token budget of MODEL
+            messages, context_report = context_builder.build_messages(
+                conversation_context, ctx.history, context_builder.token_budget(MODEL),
+                final_reminder=final_reminder, resolve_image=blob_store.to_data_url, summary=ctx.summary
+            )
+            timer.add('prompt_build', time_module.perf_counter() - phase_started)
+            print(f"DEBUG: Context {context_report['prompt_tokens']}/{context_report['budget']} tokens, "
+                  f"dropped {context_report['dropped_messages']} message(s) (~{context_report['dropped_tokens']} tokens), "
+                  f"{context_report['images_replaced']} old image(s) replaced")
+
+            # --- KI ANFRAGE ---
+            # llm_router wählt den Endpoint und wechselt ihn, solange noch kein Token kam;
+            # während es wartet, gehen PINGs an den Client
+            phase_started = time_module.perf_counter()
+            try:
+                response_stream = yield from llm_router.open_stream(messages, keepalive=lambda: send('ping'))
+            except Exception as api_error:
+                outcome = 'llm_error'
+
+                error_msg = str(api_error)
+                final_error = ""
+                if llm_governor.is_rate_limited(api_error):
+                    final_error = "⚠️ Die KI-API ist momentan überlastet. Auch nach mehreren Versuchen konnte keine Verbindung hergestellt werden. Bitte warte eine Minute."
+                    print(f"API Rate Limit Final: {api_error}")
+                elif "401" in error_msg or "unauthorized" in error_msg.lower():
+                    final_error = "❌ API-Authentifizierungsfehler. Überprüfe deinen API-Schlüssel in den Einstellungen."
+                    print(f"API Auth Error: {api_error}")
                 else:
-                    if role != processed_history[-1]['role']: processed_history.append(msg_obj)
-                    else: 
-                        # Merge if same role
-                        if isinstance(processed_history[-1]['content'], str) and isinstance(content, str):
-                            processed_history[-1]['content'] += "\n" + content
-                        # (Simplification: we don't merge complex contents easily, but this handles most cases)
-
-            # Construct messages for the model
-            messages = [{"role": "system", "content": conversation_context}]
-            
-            # Add final reminder for math solver or guiding
-            final_reminder = ""
-            if math_solver_enabled:
-                final_reminder = "\n\n⚠️ ERINNERUNG: Der Mathe-Löser ist AKTIV. Löse NUR mathematische Aufgaben JETZT DIREKT. Für alle anderen Fächer (Deutsch, Sprachen, etc.) gilt weiterhin striktes GUIDING!"
-            else:
-                final_reminder = "\n\n⚠️ ERINNERUNG: Der Mathe-Löser ist AUS. Für ALLE Fächer gilt striktes GUIDING (keine Lösungen nennen)."
-
-            for i, msg in enumerate(processed_history):
-                role = msg['role']
-                content = msg['content']
-                
-                # Wenn es die letzte User-Nachricht ist, hänge den Reminder an
-                if i == len(processed_history) - 1 and role == 'user':
-                    if isinstance(content, list):
-                        content[0]['text'] += final_reminder
-                    else:
-                        content += final_reminder
-                
-                messages.append({"role": role, "content": content})
-
-            if messages and messages[-1]['role'] == 'user':
-                # Falls wir eine leere Antwort erzwingen wollten (aus altem Code)
-                pass 
-
-            # --- KI ANFRAGE MIT RETRY LOGIK ---
-            max_retries = 3
-            retry_delay = 2
-            response_stream = None
-            
-            for attempt in range(max_retries):
-                try:
-                    response_stream = client.chat.completions.create(model=MODEL, messages=messages, stream=True)
-                    break  # Erfolg!
-                except Exception as api_error:
-                    error_msg = str(api_error)
-                    if ("429" in error_msg or "rate" in error_msg.lower()) and attempt < max_retries - 1:
-                        print(f"DEBUG: Rate limit hit, retrying in {retry_delay}s... (Versuch {attempt+1}/{max_retries})")
-                        import time
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Wartezeit verdoppeln
+                    final_error = f"❌ Fehler bei der KI-Anfrage: {api_error}"
+                    print(f"API Error: {api_error}")
+
+                if user_id:
+                    us.save_chat_message(user_id, chat_session_id, 'assistant', final_error, chat_subject=current_chat_subject)
+                yield from send('error', message=final_error)
+                return
+            # Includes waiting for admission and failing over to another endpoint
+            timer.add('first_token', time_module.perf_counter() - phase_started)
+            timer.labels['model'] = response_stream.endpoint.model
+            timer.labels['endpoint'] = response_stream.endpoint.name
+
+            usage = None
+            parser = stream_parser.ActionStreamParser()
+            display_parts = []
+
+            def handle_events(events):
+                for kind, value in events:
+                    if kind == 'action':
+                        action_started = time_module.perf_counter()
+                        yield from run_actions(value)
+                        timer.add('actions', time_module.perf_counter() - action_started)
                         continue
-                    
-                    # Wenn alle Versuche fehlgeschlagen sind oder kein Rate-Limit-Fehler
-                    final_error = ""
-                    if "429" in error_msg or "rate" in error_msg.lower():
-                        final_error = "⚠️ Die KI-API ist momentan überlastet. Auch nach mehreren Versuchen konnte keine Verbindung hergestellt werden. Bitte warte eine Minute."
-                        print(f"API Rate Limit Final: {api_error}")
-                    elif "401" in error_msg or "unauthorized" in error_msg.lower():
-                        final_error = "❌ API-Authentifizierungsfehler. Überprüfe deinen API-Schlüssel in den Einstellungen."
-                        print(f"API Auth Error: {api_error}")
-                    else:
-                        final_error = f"❌ Fehler bei der KI-Anfrage: {api_error}"
-                        print(f"API Error: {api_error}")
-                    
-                    if user_id:
-                        us.save_chat_message(user_id, chat_session_id, 'assistant', final_error, chat_subject=current_chat_subject)
-                    yield from yield_sse(final_error)
-                    return
+                    display_parts.append(value)
+                    yield from sse_out.text(value)
 
+            phase_started = time_module.perf_counter()
+            content_chunks = 0
             try:
                 for chunk in response_stream:
+                    if getattr(chunk, 'usage', None):
+                        usage = chunk.usage
+                    # The usage chunk at the end of the stream has no choices
+                    if not chunk.choices:
+                        continue
                     content = chunk.choices[0].delta.content
                     if content:
-                        full_answer += content
-                        if not client_disconnected:
-                            try:
-                                yield from yield_sse(content)
-                            except GeneratorExit:
-                                client_disconnected = True
-                                print(f"DEBUG: Client disconnected for session {chat_session_id}, finishing in background.")
+                        content_chunks += 1
+                        yield from handle_events(parser.feed(content))
+                        # Show the worksheet animation while its markdown is still streaming
+                        open_block = parser.open_block
+                        if (not worksheet_announced and not calendar_entry_intent and open_block
+                                and 'worksheet_creation' in open_block):
+                            yield from send('worksheet_started')
+                            worksheet_announced = True
+                        yield from finish_worksheet(wait=False)
+                    yield from sse_out.tick()
+                yield from handle_events(parser.close())
             except Exception as e:
                 print(f"Error in stream: {e}")
-                full_answer += f"\n\n⚠️ [FEHLER IM STREAM: {str(e)}]"
-
-            # --- POST-PROCESSING (EXTRACT ACTIONS) ---
-            action_blocks = re.findall(r'<action>(.*?)</action>', full_answer, re.DOTALL | re.IGNORECASE)
-            for block in action_blocks:
-                try:
-                    try:
-                        res_data = json.loads(block)
-                    except json.JSONDecodeError:
-                        res_data = json.loads(block.replace('\n', '\\n').replace('\r', '\\r'))
-                    
-                    res_list = res_data if isinstance(res_data, list) else [res_data]
-                    for res in res_list:
-                        if not isinstance(res, dict): continue
-                        if res.get('type') == 'homework_action':
-                            homework_action_processed = True
-                            if not homework_saving_announced and not client_disconnected:
-                                yield from yield_sse("HOMEWORK_SAVING")
-                                homework_saving_announced = True
-                            action, hw_id = res.get('action'), res.get('id')
-                            s_name = res.get('subject_name', '').strip()
-                            s_id = us.get_subject_id_by_name(user_id, s_name) if s_name else None
-                            if s_name and s_id is None:
-                                s_id = us.create_subject(user_id, s_name)
-                                if s_id is False: s_id = us.get_subject_id_by_name(user_id, s_name)
-                            iso_due_date = convert_to_iso_date(res.get('due_date'))
-
-                            if action == 'create':
-                                created_hw = us.create_homework(user_id, res.get('title'), iso_due_date, res.get('notes'), s_id)
-                                if isinstance(created_hw, dict) and created_hw.get('id') and not homework_link_id:
-                                    homework_link_id = created_hw.get('id')
-                                homework_results.append(f"'{res.get('title')}' erstellt")
-                            elif action == 'update' and hw_id:
-                                us.update_homework(hw_id, user_id, res.get('title'), iso_due_date, res.get('notes'), s_id)
-                                if not homework_link_id:
-                                    homework_link_id = hw_id
-                                homework_results.append(f"'{res.get('title')}' aktualisiert")
-                            elif action == 'toggle' and hw_id:
-                                us.toggle_homework_status(hw_id, user_id)
-                                homework_results.append(f"'{hw_id}' umgeschaltet")
-                            elif action == 'delete' and hw_id:
-                                deleted_title = next((hw.get('title') for hw in current_homework if hw.get('id') == hw_id), hw_id)
-                                us.delete_homework(hw_id, user_id)
-                                homework_results.append(f"'{deleted_title}' gelöscht")
-                        elif res.get('type') == 'worksheet_creation':
-                            if calendar_entry_intent:
-                                continue
-                            md_content = res.get('content')
-                        elif res.get('type') == 'memory_action':
-                            content, act = res.get('content'), res.get('action', 'add')
-                            if content:
-                                if act == 'add': us.add_memory(user_id, content)
-                                elif act == 'delete': us.delete_memory_by_content(user_id, content)
-                        elif res.get('type') == 'set_chat_subject':
-                            subject = res.get('subject')
-                            if subject:
-                                us.update_chat_session_subject(user_id, chat_session_id, subject)
-                                current_chat_subject = subject
-                                if not client_disconnected: yield from yield_sse(f"SESSION_SUBJECT:{subject}")
-                        elif res.get('type') == 'chat_naming':
-                            new_title = res.get('title')
-                            if user_id and new_title:
-                                us.rename_chat_session(user_id, chat_session_id, new_title)
-                                if not client_disconnected: yield from yield_sse(f"SESSION_TITLE:{new_title}")
-                except Exception: continue
-
-            # Cleanup display text - Remove only internal markup, not regular brackets in text
-            display_text = re.sub(r'<action>[\s\S]*?</?action>', '', full_answer, flags=re.IGNORECASE)
-            # Remove "thinking"/"thoughts" tags and similar internal markup only
-            display_text = re.sub(r'\[(?:thinking|thoughts|gedanken|chain-of-thought|analysis)\][\s\S]*?\[/(?:thinking|thoughts|gedanken|chain-of-thought|analysis)\]', '', display_text, flags=re.IGNORECASE)
-            display_text = re.sub(r'\{(?:gedanken|thoughts|thinking|internal)[^}]*\}', '', display_text, flags=re.IGNORECASE)
-            display_text = re.sub(r'</?action/?>', '', display_text, flags=re.IGNORECASE)
-            
-            # Only remove incomplete brackets/tags at end of text
-            display_text = re.sub(r'<action[\s\S]*$', '', display_text, flags=re.IGNORECASE)
-            display_text = re.sub(r'\{[^{}]*$', '', display_text)
-            
-            redundant_phrases = [
-                r'Bitte hab einen Moment Geduld, während ich es generiere\.', 
-                r'Bitte gib mir einen Moment, damit es vollständig generiert wird\.',
-                r'Bitte hab einen Moment Geduld\.',
-                r'Bitte gib mir einen Moment\.',
-                r'Ich habe das Arbeitsblatt erstellt!', 
-                r'Das Arbeitsblatt wird gerade erstellt\.'
-            ]
-            for phrase in redundant_phrases: 
-                display_text = re.sub(phrase, '', display_text, flags=re.IGNORECASE)
-            
+                outcome = 'stream_error'
+                display_parts.extend(value for kind, value in parser.close() if kind == 'text')
+                display_parts.append(f"\n\n⚠️ [FEHLER IM STREAM: {str(e)}]")
+            yield from sse_out.flush()
+            stream_seconds = time_module.perf_counter() - phase_started
+            timer.add('stream', stream_seconds - timer.phases.get('actions', 0.0))
+            usage_info = prompt_builder.usage_report(usage)
+            completion_tokens = usage_info['completion_tokens'] if usage_info else None
+            # Without usage data, content chunks are the best guess for tokens
+            tokens_per_second = (completion_tokens or content_chunks) / stream_seconds if stream_seconds > 0 else None
+            if tokens_per_second:
+                metrics.observe('ask_tokens_per_second', tokens_per_second, buckets=metrics.RATE_BUCKETS,
+                                help='Streaming speed of /ask answers', model=timer.labels['model'])
+            if usage_info:
+                print(f"DEBUG: Usage prompt={usage_info['prompt_tokens']} cached={usage_info['cached_tokens']} "
+                      f"completion={usage_info['completion_tokens']} (static prefix {len(conversation_context) - len(conversation_suffix)} chars)")
+
+            display_text = "".join(display_parts)
             # Clean up whitespace - keep newlines but trim start/end
             display_text = display_text.strip()
 
@@ -795,58 +768,64 @@ def ask():
                 )
 
             # --- SOFORTIGES SPEICHERN DER ANTWORT ---
+            yield from finish_worksheet(wait=False)
             assistant_msg_idx = None
             if user_id and (display_text or md_content):
-                initial_ws = 'PENDING' if md_content else None
-                assistant_msg_idx = us.save_chat_message(
-                    user_id, chat_session_id, 'assistant', display_text,
-                    worksheet_filename=initial_ws, homework_id=homework_link_id, chat_subject=current_chat_subject
-                )
+                # The worksheet may already be done; otherwise it is stored as PENDING until it is
+                initial_ws = worksheet_result['filename'] if worksheet_result else ('PENDING' if worksheet_job else None)
+                with timer.phase('save_answer'):
+                    assistant_msg_idx = us.save_chat_message(
+                        user_id, chat_session_id, 'assistant', display_text,
+                        worksheet_filename=initial_ws, homework_id=homework_link_id, chat_subject=current_chat_subject
+                    )
                 print(f"DEBUG: Message saved for session {chat_session_id}")
+                # Compress older turns in the background for the next request
+                if assistant_msg_idx is not None:
+                    summarizer.schedule(user_id, chat_session_id, assistant_msg_idx + 1)
 
-            # --- WORKSHEET GENERATION ---
-            pdf_basename = None
-            if md_content:
-                has_context = has_request_context()
-                if has_context and not client_disconnected: yield from yield_sse("START_WORKSHEET_GENERATION")
-                
-                worksheet_uuid = str(uuid.uuid4())
-                md_filename, pdf_filename = f"sheets/{worksheet_uuid}.md", f"sheets/{worksheet_uuid}.pdf"
-                with open(md_filename, "w", encoding='utf-8') as f: f.write(md_content.strip())
-                
-                try:
-                    response = requests.post('https://api.md-to-pdf.l-ai.pro', data={'markdown': md_content.strip()}, timeout=30)
-                    response.raise_for_status()
-                    with open(pdf_filename, 'wb') as f: f.write(response.content)
-                    pdf_basename = os.path.basename(pdf_filename)
-                except Exception as e:
-                    print(f"PDF generation failed: {e}")
-                    if has_context and not client_disconnected: yield from yield_sse("Fehler bei der PDF-Erstellung.")
-                    if os.path.exists(md_filename): pdf_basename = os.path.basename(md_filename)
-
-                if user_id and assistant_msg_idx is not None and pdf_basename:
-                    us.update_chat_message_worksheet(user_id, chat_session_id, assistant_msg_idx, pdf_basename)
+            if homework_results: yield from send('homework_updated')
+            if homework_link_id: yield from send('homework_link', homework_id=homework_link_id)
 
-            if not client_disconnected:
-                if homework_results: yield from yield_sse("HOMEWORK_UPDATED")
-                if homework_link_id: yield from yield_sse(f"HOMEWORK_LINK:{homework_link_id}")
-                if pdf_basename: yield from yield_sse(f"WORKSHEET_DOWNLOAD_LINK:{pdf_basename}")
+            # --- WORKSHEET GENERATION ---
+            if worksheet_job is not None and worksheet_result is None:
+                # The job writes the file onto the message when done, even if this request is gone
+                if user_id and assistant_msg_idx is not None:
+                    worksheet_renderer.attach_to_message(worksheet_job, user_id, chat_session_id, assistant_msg_idx)
+                phase_started = time_module.perf_counter()
+                yield from finish_worksheet(wait=True)
+                timer.add('worksheet_wait', time_module.perf_counter() - phase_started)
 
 
         except Exception as e:
+            outcome = 'error'
             print(f"An unexpected error occurred: {e}")
             traceback.print_exc()
             error_msg = f"❌ Ein unerwarteter Fehler ist aufgetreten: {str(e)}"
             if user_id:
                 us.save_chat_message(user_id, chat_session_id, 'assistant', error_msg, chat_subject=current_chat_subject)
-            if not client_disconnected: yield from yield_sse(error_msg)
+            yield from send('error', message=error_msg)
         finally:
             if chat_session_id in generating_sessions:
                 generating_sessions[chat_session_id] -= 1
                 if generating_sessions[chat_session_id] <= 0:
                     generating_sessions.pop(chat_session_id, None)
-
-    return Response(generate(), mimetype='text/event-stream')
+            if outcome == 'ok' and not event_stream.listeners:
+                outcome = 'disconnected'
+            metrics.inc('ask_requests', help='/ask requests by outcome', outcome=outcome, model=timer.labels['model'])
+            timer.finish(outcome=outcome, ttft=round(timer.phases.get('first_token', 0.0), 4),
+                         completion_tokens=completion_tokens,
+                         tokens_per_second=round(tokens_per_second, 1) if tokens_per_second else None,
+                         sse_deltas=sse_out.deltas, sse_events=sse_out.events, sse_bytes=event_stream.bytes_sent)
+
+    event_stream = sse.start(stream_owner, generate())
+    if event_stream is None:
+        return _ask_busy()
+    return Response(event_stream.listen(), mimetype='text/event-stream', headers=sse.HEADERS)
+
+def _ask_busy():
+    metrics.inc('ask_requests', help='/ask requests by outcome', outcome='busy', model=MODEL)
+    message = "⚠️ Gerade laufen zu viele Anfragen gleichzeitig. Bitte versuche es in einem Moment noch einmal."
+    return Response(sse.busy_body(message), mimetype='text/event-stream', headers=sse.HEADERS)
 
 @app.route('/api/check-chat-status')
 def check_chat_status():
@@ -870,6 +849,14 @@ def get_user_chat_sessions_route():
     sessions = us.get_user_chat_sessions(effective_user_id)
     return jsonify(sessions)
 
+def history_page_args():
+    """Paging parameters for the chat history routes (?limit=N&before=<msg_idx>&since=<msg_idx or updated_at>)."""
+    return {
+        'limit': request.args.get('limit', type=int),
+        'before': request.args.get('before', type=int),
+        'since': request.args.get('since') or None,
+    }
+
 @app.route('/load-chat/<session_id>', methods=['POST'])
 def load_chat(session_id):
     user_id = session.get('user_id')
@@ -883,9 +870,9 @@ def load_chat(session_id):
             pass
             
     effective_user_id = user_id if user_id else f"guest_{session_id}"
-    chat_history = us.get_chat_history(effective_user_id, session_id)
+    page = us.get_chat_history_page(effective_user_id, session_id, **history_page_args())
     session['chat_session_id'] = session_id
-    return jsonify({'chat_history': chat_history})
+    return jsonify({'chat_history': page['messages'], 'has_more': page['has_more'], 'cursor': page['cursor']})
 
 @app.route('/privacy-policy')
 def privacy_policy():
@@ -905,10 +892,10 @@ def get_current_chat_history():
     chat_session_id = session.get('chat_session_id')
 
     if not chat_session_id or not user_id:
-        return jsonify({'chat_history': []})
+        return jsonify({'chat_history': [], 'has_more': False, 'cursor': None})
 
-    chat_history = us.get_chat_history(user_id, chat_session_id)
-    return jsonify({'chat_history': chat_history})
+    page = us.get_chat_history_page(user_id, chat_session_id, **history_page_args())
+    return jsonify({'chat_history': page['messages'], 'has_more': page['has_more'], 'cursor': page['cursor']})
 
 @app.route('/api/check-worksheet-status')
 def check_worksheet_status():
@@ -918,42 +905,52 @@ def check_worksheet_status():
     if not chat_session_id or not user_id:
         return jsonify({'generating': False})
 
-    history = us.get_chat_history(user_id, chat_session_id)
-    is_generating = any(msg.get('worksheet_filename') == 'PENDING' for msg in history)
-    return jsonify({'generating': is_generating})
-
-@app.route('/download-worksheet/<filename>')
-def download_sheet(filename):
-    try:
-        # Sanitize filename to prevent directory traversal
-        filename = os.path.basename(filename)
-        return send_file(os.path.join('sheets', filename), as_attachment=True)
-    except Exception as e:
-        print(f"Error sending file: {e}")
-        return abort(404)
+    page = us.get_chat_history_page(user_id, chat_session_id)
+    is_generating = any(msg.get('worksheet_filename') == 'PENDING' for msg in page['messages'])
+    # cursor lets the client poll /get-chat-history?since=... for changes only
+    return jsonify({'generating': is_generating, 'cursor': page['cursor']})
 
-@app.route('/preview-worksheet/<filename>')
-def preview_worksheet(filename):
-    """Dient das Arbeitsblatt inline zur Vorschau (immer MD gerendert als HTML, falls verfügbar)"""
-    try:
-        import markdown as md
-        # Filename validieren um Directory-Traversal zu verhindern
-        filename = os.path.basename(filename)
-        
-        # Basis-Name ohne Endung ermitteln
-        base_name = os.path.splitext(filename)[0]
-        md_filename = f"{base_name}.md"
-        md_path = os.path.join('sheets', md_filename)
-        
-        # Wenn MD-Version existiert, diese rendern und anzeigen
-        if os.path.exists(md_path):
-            with open(md_path, 'r', encoding='utf-8') as f:
-                markdown_inhalt = f.read()
-            
-            html_inhalt = md.markdown(markdown_inhalt, extensions=['tables', 'fenced_code'])
-            
-            # Stylische CSS-Klassen für ein besseres Aussehen im Preview
-            html = f'''<!DOCTYPE html>
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    user_id = session.get('user_id')
+    chat_session_id = session.get('chat_session_id')
+    owner = user_id if user_id else f"guest_{chat_session_id}"
+    job = job_queue.get(job_id)
+    if not job or job['owner'] != owner:
+        return jsonify({'error': 'Job nicht gefunden'}), 404
+    return jsonify({
+        'id': job['id'],
+        'kind': job['kind'],
+        'state': job['state'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'events': job_queue.events(job_id),
+    })
+
+def _not_modified(etag):
+    """304 response if the client already has the `etag` version, else None."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+# Erhöhen, wenn sich _worksheet_preview_html ändert, damit Browser die alte Vorschau nicht mehr per 304 behalten
+PREVIEW_LAYOUT_VERSION = 1
+
+def _preview_etag(content_hash):
+    return f"{content_hash}.html.v{PREVIEW_LAYOUT_VERSION}"
+
+def _worksheet_preview_html(markdown_inhalt):
+    import markdown as md
+    html_inhalt = md.markdown(markdown_inhalt, extensions=['tables', 'fenced_code'])
+
+    # Stylische CSS-Klassen für ein besseres Aussehen im Preview
+    return f'''<!DOCTYPE html>
 <html>
 <head>
 <meta charset="utf-8">
@@ -996,7 +993,72 @@ blockquote {{ border-left: 4px solid #3b82f6; padding-left: 1rem; font-style: it
     </div>
 </body>
 </html>'''
-            return Response(html, mimetype='text/html; charset=utf-8')
+
+@app.route('/download-worksheet/<filename>')
+def download_sheet(filename):
+    try:
+        # Sanitize filename to prevent directory traversal
+        filename = os.path.basename(filename)
+        content_hash = render_cache.hash_from_filename(filename)
+        if content_hash is None:
+            # Sheets from before content-hash names
+            return send_file(os.path.join('sheets', filename), as_attachment=True)
+        path = os.path.join('sheets', filename)
+        # Before the ETag check, so a deleted or collected sheet is a 404 and not a 304
+        if not os.path.exists(path):
+            return abort(404)
+        # Content-addressed: the file behind a name never changes
+        etag = filename
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+        if filename.endswith('.pdf'):
+            response = Response(worksheet_renderer.read_pdf(filename), mimetype='application/pdf')
+            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        else:
+            response = send_file(os.path.abspath(path), as_attachment=True)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+    except Exception as e:
+        print(f"Error sending file: {e}")
+        return abort(404)
+
+@app.route('/preview-worksheet/<filename>')
+def preview_worksheet(filename):
+    """Dient das Arbeitsblatt inline zur Vorschau (immer MD gerendert als HTML, falls verfügbar)"""
+    try:
+        # Filename validieren um Directory-Traversal zu verhindern
+        filename = os.path.basename(filename)
+        
+        # Basis-Name ohne Endung ermitteln
+        base_name = os.path.splitext(filename)[0]
+        md_filename = f"{base_name}.md"
+        md_path = os.path.join('sheets', md_filename)
+
+        # Wenn MD-Version existiert, diese rendern und anzeigen
+        if os.path.exists(md_path):
+            # Bei Content-Hash-Namen ist der Name schon der Cache-Key
+            content_hash = render_cache.hash_from_filename(md_filename)
+            if content_hash:
+                not_modified = _not_modified(_preview_etag(content_hash))
+                if not_modified:
+                    return not_modified
+            html = render_cache.get(content_hash, 'html') if content_hash else None
+            if html is None:
+                with open(md_path, 'r', encoding='utf-8') as f:
+                    markdown_inhalt = f.read()
+                if content_hash is None:
+                    content_hash = render_cache.content_hash(markdown_inhalt)
+                    not_modified = _not_modified(_preview_etag(content_hash))
+                    if not_modified:
+                        return not_modified
+                html = render_cache.get_or_build(content_hash, 'html', lambda: _worksheet_preview_html(markdown_inhalt))
+            response = Response(html, mimetype='text/html; charset=utf-8')
+            response.set_etag(_preview_etag(content_hash))
+            # Revalidieren statt neu laden, die Seite selbst kann sich mit dem Layout ändern (PREVIEW_LAYOUT_VERSION)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
         
         # Falls MD nicht existiert, aber es eine PDF ist, diese als Fallback anzeigen
         dateiendung = os.path.splitext(filename)[1].lower()
@@ -1326,6 +1388,27 @@ def cache_image():
         print(f"Error caching image: {e}")
         return jsonify({'error': 'Fehler beim Zwischenspeichern.'}), 500
 
+@app.route('/blob/<blob_hash>')
+def serve_blob(blob_hash):
+    user_id = session.get('user_id')
+    chat_session_id = session.get('chat_session_id')
+    if not user_id and not chat_session_id:
+        abort(401)
+    if not blob_store.is_valid_hash(blob_hash):
+        abort(404)
+    # Only images from the caller's own chats; anything else looks like a missing blob
+    owner = user_id if user_id else f"guest_{chat_session_id}"
+    if not us.user_references_blob(owner, blob_hash):
+        abort(404)
+    path = blob_store.blob_path(blob_hash)
+    if not os.path.exists(path):
+        abort(404)
+    # Content-addressed: the bytes behind a hash never change
+    response = send_file(os.path.abspath(path), mimetype=blob_store.sniff_mime_for(blob_hash),
+                         conditional=True, etag=blob_hash, max_age=31536000)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
 @app.route('/api/delete-cached-image', methods=['POST'])
 def delete_cached_image():
     data = request.get_json()
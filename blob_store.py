@@ -0,0 +1,142 @@
+"""
+Content-addressed blob store for chat images.
+
+Blobs live under blobs/<first two hex chars>/<sha256>, so identical images are
+stored once. Chat messages keep only a reference of the form 'blob:<sha256>';
+get_chat_history hands the browser '/blob/<sha256>' URLs instead of inline
+base64, and the model request turns references back into data URLs.
+"""
+
+import os
+import re
+import base64
+import hashlib
+import threading
+
+BLOBS_DIR = os.getenv('BLOB_STORE_DIR', 'blobs')
+REF_PREFIX = 'blob:'
+URL_PREFIX = '/blob/'
+
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+_DATA_URL_RE = re.compile(r'^data:([^;,]*)(;base64)?,', re.IGNORECASE)
+
+_MAGIC = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+def is_valid_hash(blob_hash):
+    return bool(blob_hash) and bool(_HASH_RE.match(blob_hash))
+
+
+def blob_path(blob_hash):
+    return os.path.join(BLOBS_DIR, blob_hash[:2], blob_hash)
+
+
+def put_bytes(data):
+    """Store data (if not present yet) and return its SHA-256 hex digest."""
+    blob_hash = hashlib.sha256(data).hexdigest()
+    path = blob_path(blob_hash)
+    try:
+        # Mark the blob as in use again so storage_gc does not remove it
+        # before the message referencing it is saved
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return blob_hash
+
+
+def read_bytes(blob_hash):
+    with open(blob_path(blob_hash), 'rb') as f:
+        return f.read()
+
+
+def sniff_mime(data):
+    """Guess the image MIME type from the first bytes of a blob."""
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:12] in (b'ftypheic', b'ftypheix', b'ftypmif1', b'ftypmsf1'):
+        return 'image/heic'
+    return 'application/octet-stream'
+
+
+def sniff_mime_for(blob_hash):
+    with open(blob_path(blob_hash), 'rb') as f:
+        return sniff_mime(f.read(16))
+
+
+def hash_from_ref(value):
+    """Return the hash for a 'blob:<hash>' reference or '/blob/<hash>' URL, else None."""
+    if not isinstance(value, str):
+        return None
+    for prefix in (REF_PREFIX, URL_PREFIX):
+        if value.startswith(prefix) and is_valid_hash(value[len(prefix):]):
+            return value[len(prefix):]
+    return None
+
+
+def put_data_url(value):
+    """Move an inline base64 data URL into the store and return its reference.
+
+    Anything that is not a base64 data URL is returned unchanged.
+    """
+    if not isinstance(value, str):
+        return value
+    match = _DATA_URL_RE.match(value)
+    if not match or not match.group(2):
+        return value
+    try:
+        data = base64.b64decode(value[match.end():])
+    except (ValueError, TypeError):
+        return value
+    return REF_PREFIX + put_bytes(data)
+
+
+def externalize_images(image_data):
+    """Replace inline data URLs in a message's image_data (str or list) with references."""
+    if isinstance(image_data, list):
+        return [put_data_url(v) for v in image_data]
+    return put_data_url(image_data)
+
+
+def hashes_in(image_data):
+    """Hashes of all blobs referenced by a message's image_data (str or list)."""
+    values = image_data if isinstance(image_data, list) else [image_data]
+    return {h for h in (hash_from_ref(v) for v in values) if h}
+
+
+def has_inline_images(image_data):
+    values = image_data if isinstance(image_data, list) else [image_data]
+    return any(isinstance(v, str) and _DATA_URL_RE.match(v) for v in values)
+
+
+def to_public_urls(image_data):
+    """Turn references in image_data (str or list) into URLs served by /blob/<hash>."""
+    def convert(value):
+        blob_hash = hash_from_ref(value)
+        return URL_PREFIX + blob_hash if blob_hash else value
+    if isinstance(image_data, list):
+        return [convert(v) for v in image_data]
+    return convert(image_data)
+
+
+def to_data_url(value):
+    """Resolve a reference or /blob URL to an inline data URL for the model request."""
+    blob_hash = hash_from_ref(value)
+    if not blob_hash:
+        return value
+    try:
+        data = read_bytes(blob_hash)
+    except OSError:
+        return value
+    return f"data:{sniff_mime(data)};base64,{base64.b64encode(data).decode('ascii')}"
@@ -0,0 +1,168 @@
+"""
+Bounded context window for /ask.
+
+build_messages() turns the stored chat history into the message list for the
+model while staying inside a token budget: the system prompt and the latest
+turn are always kept, older turns are dropped from the oldest end once the
+budget is used up, and only the images of the current turn are sent - older
+images become a short text placeholder. Token counts are a fast local
+estimate, not the model's real tokenizer.
+"""
+
+import os
+import re
+
+# Known context windows (tokens); matched as substrings of the MODEL name
+MODEL_CONTEXT_WINDOWS = {
+    'gemma-3': 32768,
+    'gemma-2': 8192,
+    'llama-3': 8192,
+    'mistral': 32768,
+    'gpt-4o': 128000,
+    'gpt-4.1': 1000000,
+    'gemini': 1000000,
+    'claude': 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 32768
+
+# Upper bound for the prompt even on large-window models, to cap latency and cost
+DEFAULT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET_DEFAULT', '12000'))
+RESPONSE_RESERVE = int(os.getenv('CONTEXT_RESPONSE_RESERVE', '2048'))
+IMAGE_TOKENS = int(os.getenv('CONTEXT_IMAGE_TOKENS', '800'))
+MESSAGE_OVERHEAD = 4
+
+IMAGE_PLACEHOLDER = "[Bild aus einer früheren Nachricht]"
+SUMMARY_HEADER = "\n\nZUSAMMENFASSUNG DES BISHERIGEN CHATVERLAUFS (ältere Nachrichten):\n"
+DROPPED_NOTE = "\n\nHINWEIS: {count} ältere Nachricht(en) dieses Chats wurden aus Platzgründen ausgelassen."
+
+# Words are split into chunks of up to four characters, punctuation counts
+# as one token each - close enough to BPE tokenizers for budgeting
+_TOKEN_RE = re.compile(r'\w{1,4}|[^\w\s]')
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return len(_TOKEN_RE.findall(text))
+
+
+def token_budget(model):
+    """Prompt token budget for a model; CONTEXT_TOKEN_BUDGET overrides it."""
+    explicit = os.getenv('CONTEXT_TOKEN_BUDGET')
+    if explicit:
+        return int(explicit)
+    window = DEFAULT_CONTEXT_WINDOW
+    name = (model or '').lower()
+    for key, size in MODEL_CONTEXT_WINDOWS.items():
+        if key in name:
+            window = size
+            break
+    return max(min(window - RESPONSE_RESERVE, DEFAULT_TOKEN_BUDGET), 1)
+
+
+def _collect_turns(history):
+    """Alternating user/assistant turns from get_chat_history() entries.
+
+    Leading assistant messages (the welcome text) are skipped and consecutive
+    messages of the same role are merged, as the model expects alternation;
+    'messages' counts the stored messages in a turn.
+    """
+    turns = []
+    for msg in history:
+        role = msg.get('message_type')
+        if role not in ('user', 'assistant'):
+            continue
+        if not turns and role != 'user':
+            continue
+        img = msg.get('image_data') if role == 'user' else None
+        images = (img if isinstance(img, list) else [img]) if img else []
+        text = msg.get('content') or ''
+        if turns and turns[-1]['role'] == role:
+            turns[-1]['text'] = f"{turns[-1]['text']}\n{text}" if turns[-1]['text'] else text
+            turns[-1]['images'].extend(images)
+            turns[-1]['messages'] += 1
+        else:
+            turns.append({'role': role, 'text': text, 'images': list(images), 'messages': 1})
+    return turns
+
+
+def _turn_cost(turn, with_images):
+    cost = MESSAGE_OVERHEAD + estimate_tokens(turn['text'])
+    if with_images:
+        cost += IMAGE_TOKENS * len(turn['images'])
+    elif turn['images']:
+        cost += estimate_tokens(IMAGE_PLACEHOLDER) * len(turn['images'])
+    return cost
+
+
+def _turn_message(turn, with_images, resolve_image, suffix=''):
+    text = turn['text']
+    if turn['images'] and not with_images:
+        text = '\n'.join([IMAGE_PLACEHOLDER] * len(turn['images']) + ([text] if text else []))
+    text += suffix
+    if with_images and turn['images']:
+        content = [{"type": "text", "text": text}]
+        for img in turn['images']:
+            content.append({"type": "image_url", "image_url": {"url": resolve_image(img)}})
+        return {"role": turn['role'], "content": content}
+    return {"role": turn['role'], "content": text}
+
+
+def build_messages(system_prompt, history, budget, final_reminder='', resolve_image=lambda url: url, summary=None):
+    """Build the model messages for a chat turn within `budget` tokens.
+
+    final_reminder is appended to the latest user message, resolve_image maps
+    stored image references to URLs the model can fetch. A session summary
+    (see user_storage.get_session_summary) replaces the messages it covers.
+    Returns (messages, report) where report holds the budget, the estimated
+    prompt size and what was dropped.
+    """
+    if summary:
+        system_prompt += SUMMARY_HEADER + summary['summary']
+        history = [m for m in history if m.get('msg_idx', summary['upto_idx']) >= summary['upto_idx']]
+    turns = _collect_turns(history)
+    report = {
+        'budget': budget,
+        'prompt_tokens': 0,
+        'dropped_messages': 0,
+        'dropped_tokens': 0,
+        'images_replaced': 0,
+    }
+
+    used = MESSAGE_OVERHEAD + estimate_tokens(system_prompt) + estimate_tokens(final_reminder)
+    kept = []
+    for pos in range(len(turns) - 1, -1, -1):
+        turn = turns[pos]
+        latest = pos == len(turns) - 1
+        cost = _turn_cost(turn, with_images=latest)
+        # The latest turn is always sent, even if it alone exceeds the budget
+        if not latest and used + cost > budget:
+            for older in turns[:pos + 1]:
+                report['dropped_messages'] += older['messages']
+                report['dropped_tokens'] += _turn_cost(older, with_images=False)
+            break
+        used += cost
+        kept.append(pos)
+    kept.reverse()
+
+    # The conversation has to start with a user message
+    while kept and turns[kept[0]]['role'] != 'user':
+        dropped = turns[kept.pop(0)]
+        report['dropped_messages'] += dropped['messages']
+        cost = _turn_cost(dropped, with_images=False)
+        report['dropped_tokens'] += cost
+        used -= cost
+
+    if report['dropped_messages']:
+        system_prompt += DROPPED_NOTE.format(count=report['dropped_messages'])
+    messages = [{"role": "system", "content": system_prompt}]
+    for pos in kept:
+        turn = turns[pos]
+        latest = pos == len(turns) - 1
+        if not latest:
+            report['images_replaced'] += len(turn['images'])
+        suffix = final_reminder if latest and turn['role'] == 'user' else ''
+        messages.append(_turn_message(turn, latest, resolve_image, suffix))
+
+    report['prompt_tokens'] = used
+    return messages, report
@@ -0,0 +1,345 @@
+"""
+Persistent background jobs without an external broker.
+
+Jobs live in a small SQLite database (JOB_QUEUE_DB, WAL mode) shared by all
+gunicorn workers. Each process runs JOB_WORKERS threads that claim ready jobs
+of the kinds it has handlers for. A claim leases the job for
+JOB_LEASE_SECONDS; a job whose lease ran out (worker died) is claimed again.
+Failed attempts are retried with exponential backoff up to max_attempts, and
+every state change is recorded in job_events.
+
+States: PENDING -> RUNNING -> DONE | FAILED (RUNNING -> PENDING on retry).
+
+A job can carry a `target` (e.g. the chat message waiting for a worksheet);
+the kind's on_finish callback is called exactly once with the finished job,
+whether the target was set before or after the job completed. Whoever calls
+it first sets the job's `applied` flag in the transaction that finished the
+job or set the target.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+JOB_QUEUE_DB = os.getenv('JOB_QUEUE_DB', os.path.join('users', 'jobs.db'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1.0'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+
+PENDING, RUNNING, DONE, FAILED = 'PENDING', 'RUNNING', 'DONE', 'FAILED'
+TERMINAL = (DONE, FAILED)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    owner TEXT,
+    target TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    applied INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(state, run_after);
+
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    at TEXT NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events(job_id);
+'''
+
+_handlers = {}
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_wakeup = threading.Condition()
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    # A connection must not be shared with a forked child
+    if conn is None or _local.pid != os.getpid():
+        global _schema_ready
+        directory = os.path.dirname(JOB_QUEUE_DB)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                columns = {r['name'] for r in conn.execute('PRAGMA table_info(jobs)')}
+                if 'applied' not in columns:
+                    # Databases from before the flag; their finished jobs were applied already
+                    conn.execute('ALTER TABLE jobs ADD COLUMN applied INTEGER NOT NULL DEFAULT 0')
+                    conn.execute('UPDATE jobs SET applied = 1 WHERE state IN (?, ?) AND target IS NOT NULL', TERMINAL)
+                _schema_ready = True
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+@contextmanager
+def _write():
+    conn = _connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def _event(conn, job_id, state, detail=None):
+    conn.execute('INSERT INTO job_events (job_id, state, at, detail) VALUES (?, ?, ?, ?)',
+                 (job_id, state, _now(), detail))
+
+
+def _job_row(row):
+    if row is None:
+        return None
+    job = dict(row)
+    for key in ('payload', 'target', 'result'):
+        job[key] = json.loads(job[key]) if job[key] is not None else None
+    return job
+
+
+def _notify():
+    with _wakeup:
+        _wakeup.notify_all()
+
+
+def register(kind, handler, on_finish=None):
+    """Handle jobs of `kind` in this process.
+
+    handler(payload, job) returns a JSON-serializable result or raises to
+    fail the attempt; on_finish(job) runs once a finished job has a target.
+    """
+    _handlers[kind] = (handler, on_finish)
+
+
+def enqueue(kind, payload, owner=None, max_attempts=3):
+    job_id = str(uuid.uuid4())
+    now = _now()
+    with _write() as conn:
+        conn.execute(
+            'INSERT INTO jobs (id, kind, state, payload, owner, max_attempts, run_after, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, PENDING, json.dumps(payload), owner, max_attempts, time.time(), now, now)
+        )
+        _event(conn, job_id, PENDING, 'enqueued')
+    _notify()
+    return job_id
+
+
+def get(job_id):
+    return _job_row(_connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def events(job_id):
+    rows = _connection().execute('SELECT state, at, detail FROM job_events WHERE job_id = ? ORDER BY rowid', (job_id,))
+    return [dict(r) for r in rows]
+
+
+def wait(job_id, timeout):
+    """Block until the job is DONE or FAILED or `timeout` seconds passed; returns the job."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get(job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job['state'] in TERMINAL or remaining <= 0:
+            return job
+        # Workers of this process notify; other processes are picked up by polling
+        with _wakeup:
+            _wakeup.wait(min(remaining, JOB_POLL_INTERVAL))
+
+
+def set_target(job_id, target):
+    """Attach what the job's result is for; applies it right away if the job already finished."""
+    with _write() as conn:
+        row = conn.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return False
+        conn.execute('UPDATE jobs SET target = ?, updated_at = ? WHERE id = ?', (json.dumps(target), _now(), job_id))
+        claimed = _claim_target(conn, job_id)
+    if claimed:
+        _apply_target(get(job_id))
+    return True
+
+
+def _claim_target(conn, job_id):
+    """Mark a finished job with a target as applied; True only for the one caller that does."""
+    cur = conn.execute(
+        'UPDATE jobs SET applied = 1 WHERE id = ? AND applied = 0 AND target IS NOT NULL AND state IN (?, ?)',
+        (job_id,) + TERMINAL
+    )
+    return cur.rowcount == 1
+
+
+def _apply_target(job):
+    on_finish = _handlers.get(job['kind'], (None, None))[1]
+    if on_finish and job.get('target') is not None:
+        try:
+            on_finish(job)
+        except Exception as e:
+            print(f"[job_queue] on_finish for job {job['id']} failed: {e}")
+            traceback.print_exc()
+
+
+def pending_targets(kind):
+    """Targets of jobs of `kind` that have not finished yet."""
+    rows = _connection().execute(
+        'SELECT target FROM jobs WHERE kind = ? AND state IN (?, ?) AND target IS NOT NULL', (kind, PENDING, RUNNING)
+    )
+    return [json.loads(r['target']) for r in rows]
+
+
+def _claim():
+    if not _handlers:
+        return None
+    kinds = list(_handlers)
+    now = time.time()
+    with _write() as conn:
+        row = conn.execute(
+            f"SELECT * FROM jobs WHERE kind IN ({','.join('?' * len(kinds))}) "
+            "AND ((state = ? AND run_after <= ?) OR (state = ? AND lease_until < ?)) "
+            "ORDER BY run_after LIMIT 1",
+            (*kinds, PENDING, now, RUNNING, now)
+        ).fetchone()
+        if row is None:
+            return None
+        exhausted = row['state'] == RUNNING and row['attempts'] >= row['max_attempts']
+        if exhausted:
+            # Its last attempt died with the worker; give up instead of retrying forever
+            conn.execute('UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?',
+                         (FAILED, 'worker lost', _now(), row['id']))
+            _event(conn, row['id'], FAILED, 'worker lost on last attempt')
+            claimed = _claim_target(conn, row['id'])
+        else:
+            attempt = row['attempts'] + 1
+            conn.execute(
+                'UPDATE jobs SET state = ?, attempts = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                (RUNNING, attempt, now + JOB_LEASE_SECONDS, _now(), row['id'])
+            )
+            _event(conn, row['id'], RUNNING, f"attempt {attempt}/{row['max_attempts']}")
+    if exhausted:
+        if claimed:
+            _apply_target(get(row['id']))
+        _notify()
+        return None
+    job = _job_row(row)
+    job.update(state=RUNNING, attempts=attempt)
+    return job
+
+
+def _finish(job, result=None, error=None):
+    retry = error is not None and job['attempts'] < job['max_attempts']
+    with _write() as conn:
+        if retry:
+            delay = 2 ** job['attempts']
+            cur = conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, run_after = ?, lease_until = NULL, updated_at = ? '
+                'WHERE id = ? AND state = ? AND attempts = ?',
+                (PENDING, error, time.time() + delay, _now(), job['id'], RUNNING, job['attempts'])
+            )
+            state, detail = PENDING, f"retry in {delay}s: {error}"
+        else:
+            state = FAILED if error is not None else DONE
+            cur = conn.execute(
+                'UPDATE jobs SET state = ?, result = ?, error = ?, lease_until = NULL, updated_at = ? '
+                'WHERE id = ? AND state = ? AND attempts = ?',
+                (state, json.dumps(result) if result is not None else None, error, _now(), job['id'], RUNNING, job['attempts'])
+            )
+            detail = error
+        # Lost the lease meanwhile; another worker owns the job now
+        if cur.rowcount == 0:
+            return
+        _event(conn, job['id'], state, detail)
+        claimed = _claim_target(conn, job['id'])
+    if claimed:
+        _apply_target(get(job['id']))
+    _notify()
+
+
+def _run(job):
+    handler = _handlers[job['kind']][0]
+    try:
+        result = handler(job['payload'], job)
+    except Exception as e:
+        print(f"[job_queue] {job['kind']} job {job['id']} attempt {job['attempts']} failed: {e}")
+        _finish(job, error=str(e) or type(e).__name__)
+        return
+    _finish(job, result=result)
+
+
+def _worker():
+    while True:
+        try:
+            job = _claim()
+        except sqlite3.Error as e:
+            print(f"[job_queue] claim failed: {e}")
+            job = None
+        if job is None:
+            with _wakeup:
+                _wakeup.wait(JOB_POLL_INTERVAL)
+            continue
+        _run(job)
+
+
+def start():
+    """Start this process's worker threads (once per process, also after a fork)."""
+    global _started_pid
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        for n in range(JOB_WORKERS):
+            threading.Thread(target=_worker, name=f'job-worker-{n}', daemon=True).start()
+
+
+def recover():
+    """Requeue jobs whose worker died and drop finished jobs past the retention period.
+
+    Returns the number of requeued jobs.
+    """
+    now = time.time()
+    cutoff = (datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat()
+    with _write() as conn:
+        stuck = conn.execute('SELECT id FROM jobs WHERE state = ? AND lease_until < ? AND attempts < max_attempts',
+                             (RUNNING, now)).fetchall()
+        for row in stuck:
+            conn.execute('UPDATE jobs SET state = ?, lease_until = NULL, run_after = ?, updated_at = ? WHERE id = ?',
+                         (PENDING, now, _now(), row['id']))
+            _event(conn, row['id'], PENDING, 'recovered after worker loss')
+        old = "SELECT id FROM jobs WHERE state IN (?, ?) AND updated_at < ?"
+        conn.execute(f'DELETE FROM job_events WHERE job_id IN ({old})', (DONE, FAILED, cutoff))
+        conn.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?', (DONE, FAILED, cutoff))
+    if stuck:
+        print(f"[job_queue] Requeued {len(stuck)} interrupted job(s).")
+        _notify()
+    return len(stuck)
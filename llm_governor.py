@@ -0,0 +1,239 @@
+"""
+Rate-limit governor for LLM requests.
+
+All chat-completion calls of a process go through one token bucket
+(LLM_RATE_PER_MINUTE requests per minute, bursts of LLM_RATE_BURST; 0 turns
+the bucket off). When the API answers 429, its Retry-After (or a jittered
+exponential backoff) pauses admission for every caller, instead of each
+request retrying on its own and prolonging the overload. With
+LLM_GOVERNOR_STATE set to a file path, bucket and pause are shared by all
+gunicorn workers through an fcntl lock on that file (where fcntl is missing,
+on Windows, the state stays per process). llm_router gives each
+configured endpoint its own governor (governor_for(name)).
+
+call() is a generator: instead of sleeping through a wait in one piece it
+waits in slices of at most LLM_KEEPALIVE_SECONDS and yields the caller's
+keepalive in between, so an SSE response keeps the connection alive while it
+waits. Connection errors and
+5xx answers are retried with backoff too, but they do not pause other callers.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import openai
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to per-process state
+    fcntl = None
+
+LLM_RATE_PER_MINUTE = float(os.getenv('LLM_RATE_PER_MINUTE', '0'))
+LLM_RATE_BURST = float(os.getenv('LLM_RATE_BURST', '5'))
+LLM_MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '3'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '2'))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '30'))
+# Longest a request waits for admission before giving up
+LLM_MAX_WAIT = float(os.getenv('LLM_MAX_WAIT', '60'))
+LLM_KEEPALIVE_SECONDS = float(os.getenv('LLM_KEEPALIVE_SECONDS', '5'))
+LLM_GOVERNOR_STATE = os.getenv('LLM_GOVERNOR_STATE', '')
+
+
+class Overloaded(Exception):
+    """The API stayed rate limited for longer than LLM_MAX_WAIT."""
+
+
+def is_rate_limited(error):
+    return isinstance(error, (openai.RateLimitError, Overloaded)) or getattr(error, 'status_code', None) == 429
+
+
+def is_transient(error):
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and status >= 500
+
+
+def retry_after_seconds(error):
+    """The server's Retry-After (or retry-after-ms) of an API error in seconds, None if absent."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    """Full-jitter exponential backoff for the attempt-th retry (1-based)."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class Governor:
+    """Token bucket plus a shared pause after 429s; state in memory or in state_path."""
+
+    def __init__(self, rate_per_minute, burst, state_path=''):
+        self.rate = rate_per_minute / 60
+        self.burst = max(burst, 1)
+        self.state_path = state_path if fcntl is not None else ''
+        self._lock = threading.Lock()
+        self._memory = self._initial()
+
+    def _initial(self):
+        return {'tokens': self.burst, 'updated': time.time(), 'paused_until': 0.0}
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            if not self.state_path:
+                yield self._memory
+                return
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(os.pread(fd, 4096, 0) or b'null') or self._initial()
+                except ValueError:
+                    state = self._initial()
+                yield state
+                data = json.dumps(state).encode('utf-8')
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, data, 0)
+            finally:
+                os.close(fd)
+
+    def reserve(self):
+        """Take a request slot; returns 0 if admitted, else the seconds to wait first."""
+        with self._state() as state:
+            now = time.time()
+            if state['paused_until'] > now:
+                return state['paused_until'] - now
+            if self.rate <= 0:
+                return 0.0
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0.0
+            return (1 - state['tokens']) / self.rate
+
+    def paused_for(self):
+        """Seconds left of a 429 pause, 0 if requests are admitted."""
+        with self._state() as state:
+            return max(0.0, state['paused_until'] - time.time())
+
+    def rate_limited(self, retry_after, attempt):
+        """Pause admission for everyone after a 429; returns the pause in seconds."""
+        pause = retry_after if retry_after is not None else backoff(attempt)
+        with self._state() as state:
+            state['paused_until'] = max(state['paused_until'], time.time() + pause)
+            state['tokens'] = 0.0
+            state['updated'] = time.time()
+        return pause
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def governor_for(name='default', rate_per_minute=None, burst=None):
+    """The governor of one API endpoint; every caller naming the endpoint shares it."""
+    with _governors_lock:
+        governor = _governors.get(name)
+        if governor is None:
+            state_path = LLM_GOVERNOR_STATE
+            if state_path and name != 'default':
+                state_path = f"{state_path}.{name}"
+            governor = Governor(LLM_RATE_PER_MINUTE if rate_per_minute is None else rate_per_minute,
+                                LLM_RATE_BURST if burst is None else burst, state_path)
+            _governors[name] = governor
+        return governor
+
+
+_governor = governor_for()
+
+
+def wait(seconds, keepalive, deadline):
+    """Sleep in keepalive-sized slices; raises Overloaded past the deadline."""
+    end = time.monotonic() + seconds
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            return
+        if now >= deadline:
+            raise Overloaded("LLM API still rate limited after waiting")
+        time.sleep(min(end - now, deadline - now, LLM_KEEPALIVE_SECONDS))
+        if keepalive:
+            yield from keepalive()
+
+
+def admit(governor=None, keepalive=None, deadline=None):
+    """Wait until the governor (default: the process-wide one) admits one request.
+
+    Generator; raises Overloaded if that takes past `deadline` (time.monotonic()).
+    """
+    governor = governor or _governor
+    if deadline is None:
+        deadline = time.monotonic() + LLM_MAX_WAIT
+    delay = governor.reserve()
+    while delay > 0:
+        # A little jitter, so waiters do not all hit the API in the same instant
+        yield from wait(delay + random.uniform(0, 0.25), keepalive, deadline)
+        delay = governor.reserve()
+
+
+def call(request, keepalive=None, max_attempts=LLM_MAX_ATTEMPTS, max_wait=LLM_MAX_WAIT, governor=None):
+    """Run request() once the governor admits it, retrying rate limits and transient errors.
+
+    Generator returning request()'s result: use `result = yield from call(...)`.
+    keepalive() returns an iterable that is yielded during every wait slice.
+    Raises Overloaded when admission takes longer than max_wait, otherwise
+    the last error of request().
+    """
+    governor = governor or _governor
+    deadline = time.monotonic() + max_wait
+    attempt = 0
+    while True:
+        yield from admit(governor, keepalive, deadline)
+        attempt += 1
+        try:
+            return request()
+        except Exception as e:
+            if attempt >= max_attempts or not (is_rate_limited(e) or is_transient(e)):
+                raise
+            if is_rate_limited(e):
+                pause = governor.rate_limited(retry_after_seconds(e), attempt)
+                print(f"[llm_governor] Rate limited, pausing requests for {pause:.1f}s (attempt {attempt}/{max_attempts})")
+                if time.monotonic() + pause >= deadline:
+                    raise Overloaded(f"LLM API rate limited for {pause:.0f}s") from e
+            else:
+                delay = backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f"[llm_governor] {type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})")
+                yield from wait(delay, keepalive, deadline)
+
+
+def call_blocking(request, **kwargs):
+    """call() for code outside a streaming response; waits without keepalives."""
+    calls = call(request, **kwargs)
+    while True:
+        try:
+            next(calls)
+        except StopIteration as done:
+            return done.value
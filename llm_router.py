@@ -0,0 +1,331 @@
+"""
+Routing of chat completions over a pool of OpenAI-compatible endpoints.
+
+LLM_ENDPOINTS holds a JSON list of endpoints, e.g.
+
+    [{"name": "openrouter", "base_url": "https://openrouter.ai/api/v1",
+      "model": "google/gemma-3-27b-it:free", "api_key_env": "API_KEY"},
+     {"name": "local", "base_url": "http://localhost:8001/v1", "model": "gemma3",
+      "api_key": "none", "rate_per_minute": 0, "stream_usage": true}]
+
+Without it the pool is the single BASE_URL / MODEL / API_KEY endpoint.
+"stream_usage" (LLM_STREAM_USAGE for the single endpoint) asks the endpoint
+for token usage at the end of each stream (stream_options); leave it off for
+servers that reject unknown fields.
+
+Each request goes to the available endpoint with the best score: the moving
+average of its time to first token (TTFT), inflated by its recent error rate.
+Until the first token has arrived a request can still move: an error, a 429
+or no token within LLM_TTFT_DEADLINE seconds sends it to the next endpoint.
+A retry on an endpoint that already failed this request with a 5xx or a
+connection error first waits a jittered backoff (llm_governor.backoff).
+After LLM_BREAKER_FAILURES failures in a row (errors, missing first tokens,
+streams that stall) an endpoint's circuit breaker opens; it gets no traffic
+for LLM_BREAKER_COOLDOWN seconds and is then probed with a single request.
+A 429 is not a failure: the endpoint's governor pauses it instead. Statistics are kept per process. complete()
+runs non-streamed requests (the summarizer) over the same pool.
+
+tools/mock_openai_server.py serves a local endpoint for trying this out.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+from openai import OpenAI
+
+import llm_governor
+
+LLM_ENDPOINTS = os.getenv('LLM_ENDPOINTS', '')
+LLM_TTFT_DEADLINE = float(os.getenv('LLM_TTFT_DEADLINE', '20'))
+# A started answer is given up when no chunk arrives for this long
+LLM_STREAM_STALL_TIMEOUT = float(os.getenv('LLM_STREAM_STALL_TIMEOUT', '60'))
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '3'))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv('LLM_ROUTER_EWMA_ALPHA', '0.3'))
+LLM_ROUTER_MAX_ATTEMPTS = int(os.getenv('LLM_ROUTER_MAX_ATTEMPTS', '3'))
+LLM_STREAM_USAGE = os.getenv('LLM_STREAM_USAGE', 'false').lower() in ('true', '1', 'yes')
+
+_endpoints = []
+
+
+class FirstTokenTimeout(Exception):
+    """No token arrived within LLM_TTFT_DEADLINE."""
+
+
+class Endpoint:
+    def __init__(self, name, base_url, api_key, model, rate_per_minute=None, burst=None, stream_usage=False):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.stream_usage = stream_usage
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self.governor = llm_governor.governor_for(name, rate_per_minute, burst)
+        self.ttft = None  # moving average in seconds, None until measured
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0  # in a row
+        self.open_until = 0.0
+        self.probing = False
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def available(self, now):
+        with self._lock:
+            return now >= self.open_until and not self.probing
+
+    def score(self):
+        # Unmeasured endpoints go first, so every endpoint gets a TTFT
+        return (self.ttft or 0.0) * (1 + 4 * self.error_rate)
+
+    def begin(self):
+        with self._lock:
+            self.requests += 1
+            # Half-open: the first request after the cooldown is the probe
+            if self.open_until:
+                self.probing = True
+
+    def succeeded(self, ttft=None):
+        with self._lock:
+            alpha = LLM_ROUTER_EWMA_ALPHA
+            if ttft is not None:
+                self.ttft = ttft if self.ttft is None else alpha * ttft + (1 - alpha) * self.ttft
+            self.error_rate = (1 - alpha) * self.error_rate
+            self.failures = 0
+            self.open_until = 0.0
+            self.probing = False
+
+    def failed(self, error):
+        with self._lock:
+            # Count a failure as a first token at the deadline, so a broken
+            # endpoint does not keep the best score it had or never earned
+            alpha = LLM_ROUTER_EWMA_ALPHA
+            self.ttft = LLM_TTFT_DEADLINE if self.ttft is None else alpha * LLM_TTFT_DEADLINE + (1 - alpha) * self.ttft
+            self.error_rate = alpha + (1 - alpha) * self.error_rate
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self.probing or self.failures >= LLM_BREAKER_FAILURES:
+                self.open_until = time.time() + LLM_BREAKER_COOLDOWN
+                print(f"[llm_router] Circuit open for {self.name} ({self.last_error})")
+            self.probing = False
+
+    def rate_limited(self, error):
+        """A 429: the governor pauses the endpoint, the breaker does not count it."""
+        with self._lock:
+            self.last_error = f"{type(error).__name__}: {error}"
+            self.probing = False
+
+    def status(self):
+        with self._lock:
+            return {
+                'name': self.name, 'base_url': self.base_url, 'model': self.model,
+                'ttft_seconds': round(self.ttft, 3) if self.ttft is not None else None,
+                'error_rate': round(self.error_rate, 3), 'requests': self.requests,
+                'circuit': 'open' if time.time() < self.open_until else ('half-open' if self.open_until else 'closed'),
+                'paused_seconds': round(self.governor.paused_for(), 1), 'last_error': self.last_error,
+            }
+
+
+def configure(base_url, api_key, model):
+    """Build the endpoint pool from LLM_ENDPOINTS, else from the single given endpoint."""
+    global _endpoints
+    if not LLM_ENDPOINTS:
+        _endpoints = [Endpoint('default', base_url, api_key, model, stream_usage=LLM_STREAM_USAGE)]
+        return _endpoints
+    endpoints = []
+    for n, spec in enumerate(json.loads(LLM_ENDPOINTS)):
+        key = spec.get('api_key') or os.getenv(spec.get('api_key_env', 'API_KEY'))
+        endpoints.append(Endpoint(spec.get('name') or f'endpoint-{n}', spec.get('base_url') or base_url, key,
+                                  spec.get('model') or model, spec.get('rate_per_minute'), spec.get('burst'),
+                                  bool(spec.get('stream_usage'))))
+    _endpoints = endpoints
+    return _endpoints
+
+
+def status():
+    return [endpoint.status() for endpoint in _endpoints]
+
+
+def _pick(tried):
+    """Best endpoint for the next attempt, preferring ones this request has not tried."""
+    now = time.time()
+    candidates = [e for e in _endpoints if e.available(now)] or sorted(_endpoints, key=lambda e: e.open_until)[:1]
+    untried = [e for e in candidates if e not in tried]
+    return min(untried or candidates, key=lambda e: (e.governor.paused_for() > 0, e.score()))
+
+
+class _StreamReader:
+    """Reads one completion stream on a helper thread, so the caller can time out on it.
+
+    Iterating it yields the answer's chunks; `endpoint` is where it came from.
+    """
+
+    def __init__(self, endpoint, messages, kwargs):
+        self.endpoint = endpoint
+        self._received = []
+        self._queue = queue.Queue()
+        self._stream = None
+        self._cancelled = False
+        threading.Thread(target=self._read, args=(messages, kwargs), name=f'llm-{endpoint.name}', daemon=True).start()
+
+    def _read(self, messages, kwargs):
+        if self.endpoint.stream_usage:
+            kwargs = dict(kwargs, stream_options={'include_usage': True})
+        try:
+            self._stream = self.endpoint.client.chat.completions.create(
+                model=self.endpoint.model, messages=messages, stream=True, **kwargs)
+            for chunk in self._stream:
+                if self._cancelled:
+                    break
+                self._queue.put(('chunk', chunk))
+            self._queue.put(('end', None))
+        except Exception as e:
+            self._queue.put(('error', e))
+        finally:
+            if self._cancelled:
+                self.cancel()
+
+    def cancel(self):
+        self._cancelled = True
+        try:
+            if self._stream is not None:
+                self._stream.close()
+        except Exception:
+            pass
+
+    def first_token(self, keepalive, timeout):
+        """Generator: wait for the first content chunk, keeping the chunks received so far."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FirstTokenTimeout(f"no token within {timeout:g}s")
+            try:
+                kind, value = self._queue.get(timeout=min(remaining, llm_governor.LLM_KEEPALIVE_SECONDS))
+            except queue.Empty:
+                if keepalive:
+                    yield from keepalive()
+                continue
+            if kind == 'error':
+                raise value
+            if kind == 'end':
+                self._queue.put((kind, value))
+                return
+            self._received.append(value)
+            if value.choices and value.choices[0].delta.content:
+                return
+
+    def __iter__(self):
+        return self._chunks()
+
+    def _chunks(self):
+        finished = False
+        try:
+            yield from self._received
+            while True:
+                try:
+                    kind, value = self._queue.get(timeout=LLM_STREAM_STALL_TIMEOUT)
+                except queue.Empty:
+                    stalled = TimeoutError(f"stream stalled for {LLM_STREAM_STALL_TIMEOUT:.0f}s")
+                    self.endpoint.failed(stalled)
+                    raise stalled from None
+                if kind == 'end':
+                    finished = True
+                    return
+                if kind == 'error':
+                    self.endpoint.failed(value)
+                    raise value
+                yield value
+        finally:
+            if not finished:
+                self.cancel()
+
+
+def open_stream(messages, keepalive=None, **kwargs):
+    """Start a streamed chat completion on the best endpoint.
+
+    Generator returning an iterable over the stream's chunks:
+    `chunks = yield from open_stream(messages, keepalive=...)`; chunks.endpoint
+    is the endpoint that answers. keepalive()'s
+    output is yielded while waiting. Raises the last error when no endpoint
+    produced a first token within LLM_ROUTER_MAX_ATTEMPTS attempts.
+    """
+    deadline = time.monotonic() + llm_governor.LLM_MAX_WAIT
+    # With one endpoint there is nowhere to fail over to; just wait longer
+    ttft_deadline = LLM_TTFT_DEADLINE if len(_endpoints) > 1 else LLM_STREAM_STALL_TIMEOUT
+    tried = []
+    last_error = None
+    retry_delay = 0.0
+    for attempt in range(1, max(LLM_ROUTER_MAX_ATTEMPTS, len(_endpoints)) + 1):
+        endpoint = _pick(tried)
+        try:
+            if endpoint in tried and retry_delay:
+                # Do not hit a failing server again right away
+                yield from llm_governor.wait(retry_delay, keepalive, deadline)
+            yield from llm_governor.admit(endpoint.governor, keepalive, deadline)
+        except llm_governor.Overloaded as e:
+            last_error = last_error or e
+            break
+        tried.append(endpoint)
+        endpoint.begin()
+        reader = _StreamReader(endpoint, messages, kwargs)
+        started = time.monotonic()
+        try:
+            yield from reader.first_token(keepalive, ttft_deadline)
+        except Exception as e:
+            reader.cancel()
+            if llm_governor.is_rate_limited(e):
+                endpoint.governor.rate_limited(llm_governor.retry_after_seconds(e), attempt)
+                endpoint.rate_limited(e)
+            else:
+                endpoint.failed(e)
+            last_error = e
+            print(f"[llm_router] {endpoint.name} failed before the first token ({type(e).__name__}: {e}), "
+                  f"attempt {attempt}")
+            retry_delay = llm_governor.backoff(attempt) if llm_governor.is_transient(e) else 0.0
+            retryable = (isinstance(e, FirstTokenTimeout) or llm_governor.is_rate_limited(e)
+                         or llm_governor.is_transient(e))
+            if not retryable and all(other in tried for other in _endpoints):
+                raise
+            continue
+        except BaseException:
+            # Client went away while we waited
+            reader.cancel()
+            raise
+        endpoint.succeeded(time.monotonic() - started)
+        print(f"DEBUG: LLM endpoint {endpoint.name} ({endpoint.model}) TTFT {time.monotonic() - started:.2f}s")
+        return reader
+    raise last_error or llm_governor.Overloaded("no LLM endpoint available")
+
+
+def complete(messages, model=None, **kwargs):
+    """A non-streamed chat completion on the best endpoint, failing over on errors.
+
+    model overrides the endpoint's model. Each endpoint's governor handles its
+    rate limits and retries (llm_governor.call_blocking).
+    """
+    tried = []
+    last_error = None
+    for _ in range(len(_endpoints)):
+        endpoint = _pick(tried)
+        if endpoint in tried:
+            break
+        tried.append(endpoint)
+        endpoint.begin()
+        try:
+            response = llm_governor.call_blocking(lambda: endpoint.client.chat.completions.create(
+                model=model or endpoint.model, messages=messages, **kwargs), governor=endpoint.governor)
+        except Exception as e:
+            if llm_governor.is_rate_limited(e):
+                endpoint.rate_limited(e)
+            else:
+                endpoint.failed(e)
+            last_error = e
+            if not (llm_governor.is_rate_limited(e) or llm_governor.is_transient(e)):
+                raise
+            continue
+        endpoint.succeeded()
+        return response
+    raise last_error or llm_governor.Overloaded("no LLM endpoint available")
@@ -0,0 +1,218 @@
+"""
+Latency metrics for /ask and the worksheet renderer.
+
+observe() adds a value to a histogram with fixed buckets, inc() counts
+events; both take labels as keyword arguments. PhaseTimer measures the phases
+of one /ask request (context loading, prompt assembly, time to first token,
+streaming, actions, saving, waiting for the worksheet), logs them as one JSON
+line and records every phase in ask_phase_seconds{phase, model}.
+
+render_prometheus() returns the Prometheus text format: a histogram per
+metric plus <name>_quantile gauges with p50/p95/p99 estimated from the
+buckets. Metrics are kept per process; with METRICS_DIR set every process
+also writes its numbers to METRICS_DIR/<pid>.json and the exposition merges
+the files of all processes, so any gunicorn worker can answer a scrape.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '10'))
+# Files of processes that stopped writing this long ago are left out
+METRICS_STALE_SECONDS = float(os.getenv('METRICS_STALE_SECONDS', '3600'))
+PREFIX = 'learnai_'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+# name -> {'help', 'buckets', 'series': {labels: [bucket counts..., sum, count]}}
+_histograms = {}
+# name -> {'help', 'series': {labels: value}}
+_counters = {}
+_last_flush = 0.0
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, help='', **labels):
+    with _lock:
+        family = _histograms.setdefault(name, {'help': help, 'buckets': tuple(buckets), 'series': {}})
+        series = family['series'].setdefault(_key(labels), [0] * len(family['buckets']) + [0.0, 0])
+        for i, bound in enumerate(family['buckets']):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+    _maybe_flush()
+
+
+def inc(name, amount=1, help='', **labels):
+    with _lock:
+        family = _counters.setdefault(name, {'help': help, 'series': {}})
+        key = _key(labels)
+        family['series'][key] = family['series'].get(key, 0) + amount
+    _maybe_flush()
+
+
+class PhaseTimer:
+    """Wall-clock time per phase of one request; a phase may be entered repeatedly."""
+
+    def __init__(self, request_name, **labels):
+        self.request_name = request_name
+        self.labels = labels
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def finish(self, **fields):
+        """Record all phases plus the total and log them as one JSON line."""
+        self.add('total', time.perf_counter() - self.started)
+        for phase, seconds in self.phases.items():
+            observe(f'{self.request_name}_phase_seconds', seconds, phase=phase,
+                    help=f'Duration of the phases of one {self.request_name} request', **self.labels)
+        record = {'event': self.request_name, **self.labels,
+                  'phases': {phase: round(seconds, 4) for phase, seconds in self.phases.items()}, **fields}
+        print(f"METRICS {json.dumps(record, ensure_ascii=False)}")
+        return record
+
+
+# ---------------------------------------------------------------------------
+# Exposition
+# ---------------------------------------------------------------------------
+
+def snapshot():
+    with _lock:
+        return {
+            'histograms': {name: {'help': f['help'], 'buckets': list(f['buckets']),
+                                  'series': [[dict(k), list(v)] for k, v in f['series'].items()]}
+                           for name, f in _histograms.items()},
+            'counters': {name: {'help': f['help'], 'series': [[dict(k), v] for k, v in f['series'].items()]}
+                         for name, f in _counters.items()},
+        }
+
+
+def _flush():
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _maybe_flush():
+    global _last_flush
+    if not METRICS_DIR or time.monotonic() - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    _last_flush = time.monotonic()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _flush()
+    except OSError as e:
+        print(f"[metrics] Could not write {METRICS_DIR}: {e}")
+
+
+def _snapshots():
+    if not METRICS_DIR:
+        return [snapshot()]
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _flush()
+    snapshots = []
+    cutoff = time.time() - METRICS_STALE_SECONDS
+    for name in os.listdir(METRICS_DIR):
+        path = os.path.join(METRICS_DIR, name)
+        if not name.endswith('.json'):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                continue
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots):
+    histograms, counters = {}, {}
+    for snap in snapshots:
+        for name, f in snap['histograms'].items():
+            family = histograms.setdefault(name, {'help': f['help'], 'buckets': f['buckets'], 'series': {}})
+            if family['buckets'] != f['buckets']:
+                continue  # bucket layout changed between deployments
+            for labels, values in f['series']:
+                merged = family['series'].setdefault(_key(labels), [0] * len(values))
+                family['series'][_key(labels)] = [a + b for a, b in zip(merged, values)]
+        for name, f in snap['counters'].items():
+            family = counters.setdefault(name, {'help': f['help'], 'series': {}})
+            for labels, value in f['series']:
+                family['series'][_key(labels)] = family['series'].get(_key(labels), 0) + value
+    return histograms, counters
+
+
+def quantile(buckets, counts, count, q):
+    """Estimate the q-quantile from cumulative bucket counts (linear within a bucket)."""
+    if not count:
+        return None
+    rank = q * count
+    lower, below = 0.0, 0
+    for bound, cumulative in zip(buckets, counts):
+        if cumulative >= rank:
+            in_bucket = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / in_bucket if in_bucket else 1)
+        lower, below = bound, cumulative
+    return buckets[-1]  # in the +Inf bucket; the largest finite bound is the best guess
+
+
+def _labels(key, **extra):
+    items = list(key) + [(k, str(v)) for k, v in extra.items()]
+    if not items:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def render_prometheus():
+    histograms, counters = _merge(_snapshots())
+    lines = []
+    for name, family in sorted(counters.items()):
+        metric = f'{PREFIX}{name}_total'
+        lines += [f'# HELP {metric} {family["help"]}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{_labels(key)} {value}' for key, value in sorted(family['series'].items())]
+    for name, family in sorted(histograms.items()):
+        metric = f'{PREFIX}{name}'
+        buckets = family['buckets']
+        lines += [f'# HELP {metric} {family["help"]}', f'# TYPE {metric} histogram']
+        quantile_lines = []
+        for key, values in sorted(family['series'].items()):
+            counts, total, count = values[:-2], values[-2], values[-1]
+            for bound, cumulative in zip(buckets, counts):
+                lines.append(f'{metric}_bucket{_labels(key, le=bound)} {cumulative}')
+            lines.append(f'{metric}_bucket{_labels(key, le="+Inf")} {count}')
+            lines.append(f'{metric}_sum{_labels(key)} {round(total, 6)}')
+            lines.append(f'{metric}_count{_labels(key)} {count}')
+            for q in QUANTILES:
+                value = quantile(buckets, counts, count, q)
+                if value is not None:
+                    quantile_lines.append(f'{metric}_quantile{_labels(key, quantile=q)} {round(value, 6)}')
+        if quantile_lines:
+            lines += [f'# HELP {metric}_quantile p50/p95/p99 of {metric}, estimated from its buckets',
+                      f'# TYPE {metric}_quantile gauge'] + quantile_lines
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,540 @@
+"""
+Offline Markdown-to-PDF rendering for worksheets.
+
+The markdown is turned into HTML with the `markdown` package (same extensions
+as the worksheet preview), the HTML into a flat list of blocks, and the blocks
+are laid out on A4 pages using the PDF standard fonts (Helvetica, Courier),
+so no font files or external services are needed. Supported: headings,
+paragraphs with bold/italic/inline code, nested lists, block quotes, fenced
+code, tables and horizontal rules. Text is written in WinAnsi (cp1252);
+characters outside it are transliterated or replaced.
+
+render_markdown() is a pure function from text to PDF bytes and is meant to
+run in a worker process (see worksheet_renderer).
+"""
+
+import re
+import unicodedata
+import zlib
+from html.parser import HTMLParser
+
+import markdown
+
+MARKDOWN_EXTENSIONS = ['tables', 'fenced_code']
+
+PAGE_WIDTH, PAGE_HEIGHT = 595.28, 841.89  # A4 in points
+MARGIN = 56
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+
+BODY_SIZE = 11
+CODE_SIZE = 9.5
+TABLE_SIZE = 10
+HEADING_SIZES = {1: 20, 2: 16, 3: 13.5}
+LIST_INDENT = 18
+QUOTE_INDENT = 14
+CELL_PADDING = 4
+
+FONTS = {
+    'regular': ('F1', 'Helvetica'),
+    'bold': ('F2', 'Helvetica-Bold'),
+    'italic': ('F3', 'Helvetica-Oblique'),
+    'bolditalic': ('F4', 'Helvetica-BoldOblique'),
+    'code': ('F5', 'Courier'),
+}
+
+# Advance widths (1/1000 em) of the printable ASCII range 32..126 from the
+# Adobe font metrics; the oblique faces share the widths of the upright ones
+_HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556,
+    278, 278, 584, 584, 584, 556, 1015,
+    667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833,
+    722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611,
+    278, 278, 278, 469, 556, 333,
+    556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833,
+    556, 556, 556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500,
+    334, 260, 334, 584,
+)
+_HELVETICA_BOLD_WIDTHS = (
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556,
+    333, 333, 584, 584, 584, 611, 975,
+    722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833,
+    722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611,
+    333, 278, 333, 584, 556, 333,
+    556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889,
+    611, 611, 611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500,
+    389, 280, 389, 584,
+)
+# Non-ASCII WinAnsi characters without an ASCII base letter: (regular, bold)
+_EXTRA_WIDTHS = {
+    'ß': (611, 611), '€': (556, 556), '„': (333, 500), '“': (333, 500), '”': (333, 500),
+    '‚': (222, 278), '‘': (222, 278), '’': (222, 278), '–': (556, 556), '—': (1000, 1000),
+    '•': (350, 350), '…': (1000, 1000), '°': (400, 400), '¹': (333, 333), '²': (333, 333),
+    '³': (333, 333), '¼': (834, 834), '½': (834, 834), '¾': (834, 834), '×': (584, 584),
+    '÷': (584, 584), '±': (584, 584), '§': (556, 556), '·': (278, 278), '«': (556, 556),
+    '»': (556, 556), 'µ': (556, 611), '©': (737, 737), '¬': (584, 584), 'Æ': (1000, 1000),
+    'æ': (889, 889), 'Ø': (778, 778), 'ø': (611, 611), 'Œ': (1000, 1000), 'œ': (944, 944),
+}
+# Common characters outside cp1252, mostly from maths worksheets
+_TRANSLITERATE = {
+    '≤': '<=', '≥': '>=', '≠': '!=', '≈': '~', '→': '->', '←': '<-', '⇒': '=>', '⇔': '<=>',
+    '√': 'Wurzel ', 'π': 'pi', '∞': 'unendlich', '−': '-', '⋅': '·', '∙': '·', '∑': 'Summe ',
+    'Δ': 'Delta ', 'α': 'alpha', 'β': 'beta', 'γ': 'gamma', '✓': 'v', '✔': 'v', '☐': '[ ]',
+    '□': '[ ]', '\u00a0': ' ', '\u2009': ' ', '\u202f': ' ', '\u200b': '',
+}
+
+_width_cache = {}
+
+
+def _char_width(ch, style):
+    key = (ch, style)
+    width = _width_cache.get(key)
+    if width is None:
+        if style == 'code':
+            width = 600
+        else:
+            bold = style in ('bold', 'bolditalic')
+            table = _HELVETICA_BOLD_WIDTHS if bold else _HELVETICA_WIDTHS
+            base = unicodedata.normalize('NFD', ch)[0]
+            if 32 <= ord(ch) < 127:
+                width = table[ord(ch) - 32]
+            elif ch in _EXTRA_WIDTHS:
+                width = _EXTRA_WIDTHS[ch][bold]
+            elif 32 <= ord(base) < 127:
+                width = table[ord(base) - 32]
+            else:
+                width = 556
+        _width_cache[key] = width
+    return width
+
+
+def text_width(text, style, size):
+    return sum(_char_width(ch, style) for ch in text) * size / 1000
+
+
+def _clean(text):
+    """Text restricted to what the WinAnsi-encoded standard fonts can show."""
+    if not text.isascii():
+        text = ''.join(_TRANSLITERATE.get(ch, ch) for ch in text)
+        text = text.encode('cp1252', errors='replace').decode('cp1252')
+    return text
+
+
+def _pdf_string(text):
+    raw = text.encode('cp1252', errors='replace').decode('latin-1')
+    return '(' + raw.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+
+# --- HTML -> blocks ---
+
+class _BlockParser(HTMLParser):
+    """Flattens the HTML from `markdown` into a list of layout blocks.
+
+    A block is a dict with 'kind' (heading, para, item, code, rule, table),
+    'runs' of (text, style) and layout hints (level, depth, marker, quote).
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self._block = None
+        self._inline = []
+        self._lists = []
+        self._quote = 0
+        self._pre = False
+        self._table = None
+        self._row = None
+        self._cell = None
+
+    def _style(self):
+        if 'code' in self._inline:
+            return 'code'
+        bold, italic = 'bold' in self._inline, 'italic' in self._inline
+        if bold and italic:
+            return 'bolditalic'
+        return 'bold' if bold else 'italic' if italic else 'regular'
+
+    def _start(self, kind, **hints):
+        self._close()
+        self._block = {'kind': kind, 'runs': [], 'depth': len(self._lists), 'quote': self._quote, **hints}
+
+    def _close(self):
+        block, self._block = self._block, None
+        if block and (block['kind'] == 'code' or any(text.strip() for text, _ in block['runs'])):
+            self.blocks.append(block)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('strong', 'b'):
+            self._inline.append('bold')
+        elif tag in ('em', 'i'):
+            self._inline.append('italic')
+        elif tag == 'code':
+            if not self._pre:
+                self._inline.append('code')
+        elif tag == 'br':
+            self._add_text('\n', raw=True)
+        elif tag == 'img':
+            alt = dict(attrs).get('alt') or 'Bild'
+            self._add_text(f"[{alt}]")
+        elif self._cell is not None:
+            return
+        elif re.fullmatch(r'h[1-6]', tag):
+            self._start('heading', level=int(tag[1]))
+        elif tag == 'p':
+            if not (self._block and self._block['kind'] == 'item' and not self._block['runs']):
+                self._start('para')
+        elif tag in ('ul', 'ol'):
+            self._close()
+            self._lists.append({'ordered': tag == 'ol', 'count': 0})
+        elif tag == 'li':
+            current = self._lists[-1] if self._lists else {'ordered': False, 'count': 0}
+            current['count'] += 1
+            marker = f"{current['count']}." if current['ordered'] else '•'
+            self._start('item', marker=marker)
+        elif tag == 'pre':
+            self._start('code')
+            self._pre = True
+        elif tag == 'blockquote':
+            self._close()
+            self._quote += 1
+        elif tag == 'hr':
+            self._close()
+            self.blocks.append({'kind': 'rule', 'runs': [], 'depth': len(self._lists), 'quote': self._quote})
+        elif tag == 'table':
+            self._close()
+            self._table = []
+        elif tag == 'tr' and self._table is not None:
+            self._row = []
+        elif tag in ('th', 'td') and self._row is not None:
+            self._cell = {'runs': [], 'header': tag == 'th'}
+
+    def handle_endtag(self, tag):
+        if tag in ('strong', 'b'):
+            self._pop_inline('bold')
+        elif tag in ('em', 'i'):
+            self._pop_inline('italic')
+        elif tag == 'code':
+            if not self._pre:
+                self._pop_inline('code')
+        elif tag in ('th', 'td') and self._cell is not None:
+            self._row.append(self._cell)
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            if self._row:
+                self._table.append(self._row)
+            self._row = None
+        elif tag == 'table' and self._table is not None:
+            if self._table:
+                self.blocks.append({'kind': 'table', 'runs': [], 'rows': self._table,
+                                    'depth': len(self._lists), 'quote': self._quote})
+            self._table = None
+        elif self._cell is not None:
+            return
+        elif re.fullmatch(r'h[1-6]', tag) or tag in ('p', 'li'):
+            self._close()
+        elif tag == 'pre':
+            self._close()
+            self._pre = False
+        elif tag in ('ul', 'ol'):
+            self._close()
+            if self._lists:
+                self._lists.pop()
+        elif tag == 'blockquote':
+            self._close()
+            self._quote = max(self._quote - 1, 0)
+
+    def handle_data(self, data):
+        self._add_text(data, raw=self._pre)
+
+    def _pop_inline(self, style):
+        if style in self._inline:
+            del self._inline[len(self._inline) - 1 - self._inline[::-1].index(style)]
+
+    def _add_text(self, text, raw=False):
+        if not raw:
+            text = re.sub(r'\s+', ' ', text)
+        text = _clean(text)
+        if self._cell is not None:
+            self._cell['runs'].append((text, self._style()))
+            return
+        if self._table is not None:
+            return
+        if self._block is None:
+            if not text.strip():
+                return
+            self._start('para')
+        self._block['runs'].append((text, 'code' if self._pre else self._style()))
+
+    def close(self):
+        super().close()
+        self._close()
+
+
+def _blocks(markdown_text):
+    parser = _BlockParser()
+    parser.feed(markdown.markdown(markdown_text, extensions=MARKDOWN_EXTENSIONS))
+    parser.close()
+    return parser.blocks
+
+
+# --- line breaking ---
+
+def _tokens(runs):
+    """(word, style, space_before) tokens; a None word is a forced line break."""
+    tokens = []
+    space = False
+    for text, style in runs:
+        for piece in re.findall(r'\n|[^\S\n]+|[^\s]+', text):
+            if piece == '\n':
+                tokens.append((None, style, False))
+                space = False
+            elif piece.isspace():
+                space = True
+            else:
+                tokens.append((piece, style, space))
+                space = False
+    return tokens
+
+
+def _wrap(runs, width, size):
+    """Greedy line breaking; each line is a list of (text, style) segments."""
+    lines, line, used = [], [], 0.0
+    for word, style, space in _tokens(runs):
+        if word is None:
+            lines.append(line)
+            line, used = [], 0.0
+            continue
+        prefix = ' ' if space and line else ''
+        word_width = text_width(prefix + word, style, size)
+        if line and used + word_width > width:
+            lines.append(line)
+            line, used, prefix = [], 0.0, ''
+            word_width = text_width(word, style, size)
+        # Words longer than a whole line are split by characters
+        while word_width > width and len(word) > 1:
+            cut = len(word) - 1
+            while cut > 1 and text_width(word[:cut], style, size) > width:
+                cut -= 1
+            lines.append(line + [(prefix + word[:cut], style)])
+            line, used, prefix = [], 0.0, ''
+            word = word[cut:]
+            word_width = text_width(word, style, size)
+        if line and line[-1][1] == style:
+            line[-1] = (line[-1][0] + prefix + word, style)
+        else:
+            line.append((prefix + word, style))
+        used += word_width
+    if line or not lines:
+        lines.append(line)
+    return lines
+
+
+# --- page layout ---
+
+class _Canvas:
+    def __init__(self):
+        self.pages = []
+        self._new_page()
+
+    def _new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    @property
+    def at_top(self):
+        return self.y >= PAGE_HEIGHT - MARGIN
+
+    def ensure(self, height):
+        """Start a new page unless `height` points still fit on this one."""
+        if self.y - height < MARGIN and not self.at_top:
+            self._new_page()
+            return True
+        return False
+
+    def space(self, height):
+        if not self.at_top:
+            self.y = max(self.y - height, MARGIN)
+
+    def text_line(self, x, baseline, segments, size, gray=0):
+        if gray:
+            self.ops.append(f"{gray:.2f} g")
+        for text, style in segments:
+            if text:
+                self.ops.append(f"BT /{FONTS[style][0]} {size:g} Tf {x:.2f} {baseline:.2f} Td {_pdf_string(text)} Tj ET")
+            x += text_width(text, style, size)
+        if gray:
+            self.ops.append("0 g")
+
+    def line(self, x1, y1, x2, y2, width=0.5, gray=0.75):
+        self.ops.append(f"{gray:.2f} G {width:g} w {x1:.2f} {y1:.2f} m {x2:.2f} {y2:.2f} l S 0 G")
+
+    def rect(self, x, y, w, h, fill=None, stroke=None):
+        if fill is not None:
+            self.ops.append(f"{fill:.2f} g {x:.2f} {y:.2f} {w:.2f} {h:.2f} re f 0 g")
+        if stroke is not None:
+            self.ops.append(f"{stroke:.2f} G 0.5 w {x:.2f} {y:.2f} {w:.2f} {h:.2f} re S 0 G")
+
+
+def _draw_lines(canvas, lines, x, size, leading, gray=0, marker=None, quote_x=None):
+    for pos, segments in enumerate(lines):
+        canvas.ensure(leading)
+        baseline = canvas.y - leading + (leading - size) / 2 + size * 0.22
+        if marker and pos == 0:
+            canvas.text_line(x - LIST_INDENT + 4, baseline, [(marker, 'regular')], size)
+        if quote_x is not None:
+            canvas.line(quote_x, canvas.y, quote_x, canvas.y - leading, width=2, gray=0.8)
+        canvas.text_line(x, baseline, segments, size, gray)
+        canvas.y -= leading
+
+
+def _draw_code(canvas, block, x, width):
+    leading = CODE_SIZE * 1.3
+    per_line = max(int((width - 2 * CELL_PADDING) / (0.6 * CODE_SIZE)), 1)
+    text = ''.join(text for text, _ in block['runs']).rstrip('\n').expandtabs(4)
+    lines = []
+    for raw in text.split('\n'):
+        lines.extend([raw[i:i + per_line] for i in range(0, len(raw), per_line)] or [''])
+    canvas.space(4)
+    for raw in lines:
+        canvas.ensure(leading)
+        canvas.rect(x, canvas.y - leading, width, leading, fill=0.95)
+        baseline = canvas.y - leading + (leading - CODE_SIZE) / 2 + CODE_SIZE * 0.22
+        canvas.text_line(x + CELL_PADDING, baseline, [(raw, 'code')], CODE_SIZE)
+        canvas.y -= leading
+    canvas.space(8)
+
+
+def _draw_table(canvas, block, x, width):
+    rows = block['rows']
+    columns = max(len(row) for row in rows)
+    leading = TABLE_SIZE * 1.3
+    natural = [0.0] * columns
+    for row in rows:
+        for col, cell in enumerate(row):
+            style = 'bold' if cell['header'] else 'regular'
+            cell_text = ''.join(text for text, _ in cell['runs']).strip()
+            natural[col] = max(natural[col], text_width(cell_text, style, TABLE_SIZE) + 2 * CELL_PADDING)
+    # Long cells wrap instead of squeezing the other columns
+    natural = [min(max(n, width / columns * 0.5), width * 0.5) for n in natural]
+    widths = [n * width / sum(natural) for n in natural]
+
+    def layout(row):
+        cells = []
+        for col in range(columns):
+            cell = row[col] if col < len(row) else {'runs': [], 'header': False}
+            runs = [(text, 'bold' if cell['header'] and style == 'regular' else style) for text, style in cell['runs']]
+            cells.append((cell['header'], _wrap(runs, widths[col] - 2 * CELL_PADDING, TABLE_SIZE)))
+        height = max(len(lines) for _, lines in cells) * leading + 2 * CELL_PADDING
+        return cells, height
+
+    def draw(cells, height):
+        cx = x
+        for col, (header, lines) in enumerate(cells):
+            canvas.rect(cx, canvas.y - height, widths[col], height, fill=0.93 if header else None, stroke=0.6)
+            ty = canvas.y - CELL_PADDING
+            for segments in lines:
+                baseline = ty - leading + (leading - TABLE_SIZE) / 2 + TABLE_SIZE * 0.22
+                canvas.text_line(cx + CELL_PADDING, baseline, segments, TABLE_SIZE)
+                ty -= leading
+            cx += widths[col]
+        canvas.y -= height
+
+    canvas.space(4)
+    header = layout(rows[0]) if all(cell['header'] for cell in rows[0]) else None
+    for pos, row in enumerate(rows):
+        cells, height = layout(row)
+        # Repeat the header row on every page the table continues on
+        if canvas.ensure(height) and header and pos > 0:
+            draw(*header)
+        draw(cells, height)
+    canvas.space(10)
+
+
+def _layout(blocks):
+    canvas = _Canvas()
+    for block in blocks:
+        indent = LIST_INDENT * block['depth'] + QUOTE_INDENT * block['quote']
+        x = MARGIN + indent
+        width = CONTENT_WIDTH - indent
+        quote_x = x - QUOTE_INDENT / 2 if block['quote'] else None
+        kind = block['kind']
+        if kind == 'heading':
+            size = HEADING_SIZES.get(block['level'], 12)
+            runs = [(text, 'bolditalic' if style == 'italic' else 'code' if style == 'code' else 'bold')
+                    for text, style in block['runs']]
+            canvas.space(size * 0.8)
+            lines = _wrap(runs, width, size)
+            # Keep a heading together with the start of the following block
+            canvas.ensure(len(lines) * size * 1.25 + BODY_SIZE * 3)
+            _draw_lines(canvas, lines, x, size, size * 1.25)
+            if block['level'] == 1:
+                canvas.line(x, canvas.y - 2, x + width, canvas.y - 2, width=1, gray=0.8)
+                canvas.y -= 6
+            canvas.space(size * 0.35)
+        elif kind in ('para', 'item'):
+            leading = BODY_SIZE * 1.4
+            marker = block.get('marker') if kind == 'item' else None
+            if kind == 'item':
+                x += LIST_INDENT if not block['depth'] else 0
+                width = MARGIN + CONTENT_WIDTH - x
+            lines = _wrap(block['runs'], width, BODY_SIZE)
+            _draw_lines(canvas, lines, x, BODY_SIZE, leading, gray=0.25 if block['quote'] else 0,
+                        marker=marker, quote_x=quote_x)
+            canvas.space(3 if kind == 'item' else 7)
+        elif kind == 'code':
+            _draw_code(canvas, block, x, width)
+        elif kind == 'table':
+            _draw_table(canvas, block, x, width)
+        elif kind == 'rule':
+            canvas.space(6)
+            canvas.ensure(8)
+            canvas.line(x, canvas.y - 4, x + width, canvas.y - 4, width=0.75)
+            canvas.y -= 12
+    return canvas.pages
+
+
+# --- PDF file ---
+
+def _page_footer(number, total):
+    label = f"Seite {number} von {total}"
+    x = (PAGE_WIDTH - text_width(label, 'regular', 8)) / 2
+    return f"0.50 g BT /F1 8 Tf {x:.2f} {MARGIN / 2:.2f} Td {_pdf_string(label)} Tj ET 0 g"
+
+
+def _serialize(pages):
+    font_ids = {}
+    objects = [None, None]  # 1: catalog, 2: page tree
+    for name, (resource, base_font) in FONTS.items():
+        objects.append(f"<< /Type /Font /Subtype /Type1 /BaseFont /{base_font} /Encoding /WinAnsiEncoding >>".encode('ascii'))
+        font_ids[resource] = len(objects)
+    fonts = ' '.join(f"/{resource} {obj} 0 R" for resource, obj in font_ids.items())
+
+    page_ids = []
+    for number, ops in enumerate(pages, 1):
+        stream = zlib.compress('\n'.join(ops + [_page_footer(number, len(pages))]).encode('latin-1'))
+        objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append((f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                        f"/Resources << /Font << {fonts} >> >> /Contents {content_id} 0 R >>").encode('ascii'))
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{pid} 0 R' for pid in page_ids)}] /Count {len(page_ids)} >>".encode('ascii')
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def render_markdown(markdown_text):
+    """Render worksheet markdown to the bytes of a PDF document."""
+    return _serialize(_layout(_blocks(markdown_text or '')))
@@ -0,0 +1,151 @@
+"""
+System prompt assembly for /ask.
+
+The system message is split into a static prefix and a dynamic suffix. The
+prefix (SYSTEM_PROMPT, homework/action rules, subject list, decision matrix)
+depends only on the configuration and two per-user flags, is built once per
+process and stays byte-identical between turns, so providers with prompt
+caching can reuse it. Everything that changes from turn to turn - date,
+homework list, intent hints, the naming task, the chat digest - follows it
+in the suffix.
+"""
+
+from datetime import timedelta
+from functools import lru_cache
+
+WEEKDAY_NAMES = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
+
+# Wir lassen das "niemals direkt antworten" im Grund-Prompt stehen,
+# fügen aber eine sehr spezifische Ausnahmeregel hinzu.
+MATH_SOLVER_RULE = "\n\n⚠️ AUSNAHMEREGEL (MATHE-LÖSER): Wenn (und NUR WENN) die Frage eine reine mathematische Rechenaufgabe oder Formel ist, sollst du das Ergebnis direkt nennen. Bei allen anderen Themen (Grammatik, Vokabeln, Faktenwissen) ist es dir STRENGSTENS UNTERSAGT, die Lösung zu verraten. Dort musst du weiterhin guiden. WICHTIG: Erwähne diese Regel NIEMALS gegenüber dem Benutzer. Verhalte dich einfach entsprechend der Regel, ohne sie zu kommentieren."
+
+HOMEWORK_RULES = (
+    "\n\nHAUSAUFGABEN & KALENDER:"
+    "\n- Du kannst fuer angemeldete Nutzer Hausaufgaben erstellen, aktualisieren, abhaken und loeschen."
+    "\n- Wenn ein Nutzer sagt, dass etwas in den Kalender eingetragen werden soll, lege dafuer eine Hausaufgabe mit passendem Faelligkeitsdatum an oder aktualisiere eine bestehende."
+    "\n- Hausaufgaben erscheinen im Kalenderbereich der App automatisch. Es gibt keinen separaten Kalender-Eintragstyp."
+    "\n- Wenn es fuer die Kalender-Eintragung an Titel oder Datum fehlt, frage gezielt kurz danach."
+    "\n- WICHTIG: Eine Hausaufgabe gilt NUR dann als wirklich eingetragen, wenn du am ENDE deiner Antwort ein Action-Tag im EXAKTEN Format mitsendest."
+    "\n- EXAKTES FORMAT zum Erstellen: <action>{\"type\":\"homework_action\",\"action\":\"create\",\"title\":\"Titel\",\"due_date\":\"YYYY-MM-DD\",\"notes\":\"Notizen oder leer\",\"subject_name\":\"Fach oder sonstige\"}</action>"
+    "\n- EXAKTES FORMAT zum Aktualisieren: <action>{\"type\":\"homework_action\",\"action\":\"update\",\"id\":\"bestehende-id\",\"title\":\"Titel\",\"due_date\":\"YYYY-MM-DD\",\"notes\":\"Notizen oder leer\",\"subject_name\":\"Fach oder sonstige\"}</action>"
+    "\n- EXAKTES FORMAT zum Loeschen: <action>{\"type\":\"homework_action\",\"action\":\"delete\",\"id\":\"bestehende-id\"}</action>"
+    "\n- EXAKTES FORMAT zum Abhaken oder Wieder-Oeffnen: <action>{\"type\":\"homework_action\",\"action\":\"toggle\",\"id\":\"bestehende-id\"}</action>"
+    "\n- Sage NIEMALS, dass etwas eingetragen oder gespeichert wurde, wenn du kein solches <action>...</action>-Tag mitgeschickt hast."
+    "\n- Wenn der Nutzer etwas bearbeiten, verschieben, umbenennen, loeschen, abhaken oder wieder oeffnen will, verwende die ID aus der Liste vorhandener Hausaufgaben."
+    "\n- Wenn der Nutzer sagt 'loesche alle', 'mach alle weg' oder eindeutig mehrere passende Hausaufgaben meint, sende mehrere delete-Aktionen in einem JSON-Array innerhalb eines einzigen <action>...</action>-Tags."
+    "\n- Falls keine eindeutige passende Hausaufgabe erkennbar ist, frage kurz nach statt zu raten."
+)
+
+CALENDAR_INTENT_RULES = (
+    "\n- HOECHSTE PRIORITAET FUER DIESE ANFRAGE: Der Nutzer moechte einen Kalender-/Hausaufgaben-Eintrag."
+    "\n- Erzeuge dafuer KEIN Arbeitsblatt und KEINE worksheet_creation-Aktion."
+    "\n- Verwende stattdessen ausschliesslich homework_action oder stelle eine kurze Rueckfrage, falls Pflichtangaben fehlen."
+)
+
+BULK_DELETE_RULES = (
+    "\n- HOECHSTE PRIORITAET FUER DIESE ANFRAGE: Der Nutzer moechte mehrere Hausaufgaben auf einmal loeschen."
+    "\n- Wenn 'alle' gesagt wurde und die Liste eindeutig ist, sende fuer alle passenden Eintraege delete-Aktionen in einem einzigen JSON-Array."
+)
+
+# --- STILLE HINTERGRUND-AKTIONEN ---
+BACKGROUND_TASKS = (
+    "\n\nHINTERGRUND-AUFGABEN (STRENG GEHEIM):"
+    "\n1. FACH-ZUORDNUNG: Entscheide über das Fach. Nutze UNBEDINGT eines der folgenden Fächer: Deutsch, Mathematik, Englisch, Französisch, Spanisch, Latein, Italienisch, Russisch, Türkisch, Arabisch, Chinesisch, Japanisch, Kunst, Musik, Sport, Geschichte, Politik, Sozialkunde, Gemeinschaftskunde, Geografie, Erdkunde, Wirtschaft, Arbeitslehre, Technik, Informatik, Physik, Chemie, Biologie, Ethik, Religion, Philosophie, Astronomie, Darstellendes Spiel, Theater, Medienkunde, Hauswirtschaft, Textiles Gestalten, Werken, Technik und Design, Informatik und Medienbildung, Naturwissenschaften, Gesellschaftswissenschaften, Wirtschaft und Recht, Informatik und Mathematik, Verbraucherbildung, Berufsorientierung, Förderunterricht, Lernzeit, Klassenrat, Projektunterricht, Methodentraining, Präsentationstraining, Schreibwerkstatt, Leseförderung, Medienkompetenz, Informatik-Grundlagen, Programmieren, Robotik, 3D-Druck, Elektronik, Holztechnik, Metalltechnik, Elektrotechnik, Wirtschaftslehre, Betriebswirtschaft, Rechnungswesen, Buchführung, Recht, Pädagogik, Psychologie, Soziologie, Kriminalistik, Astronomie, Umweltkunde, Ökologie, Ernährungslehre, Gesundheit, Erste Hilfe, Verkehrserziehung, Informatikpraxis, Informatik und Technik, Geologie, Meteorologie, Meereskunde, Völkerkunde, Kulturkunde, Heimat- und Sachunterricht, Sachunterricht, Natur und Technik, Naturwissenschaft und Technik, Informatik und Gesellschaft, Informatiksysteme, Datenverarbeitung, Mediengestaltung, Fotografie, Filmkunde, Chor, Orchester, Ensemble, Instrumentalunterricht, Kunstgeschichte, Musikgeschichte, Tanz, Bewegung und Spiel, Schwimmen, Leichtathletik, Turnen, Basketball, Fußball, Volleyball, Handball, Tennis, Badminton, Fechten, Judo, Hockey, Schach, Schulgarten, Gartenbau, Landwirtschaft, Hauswirtschaft und Ernährung, Kochen, Nähen, Design, Gestalten, Basteln, Holzarbeiten, Metallarbeiten, Physikalische Experimente, Chemische Experimente, Biologische Übungen, Laborpraxis, Leseclub, Schreibkurs, Debattieren, Rhetorik, Journalismus, Schülerzeitung, Wirtschaft und Finanzen, Unternehmertum, Digitale Bildung, Künstliche Intelligenz, Robotik und Coding, Medienethik, Umweltbildung, Nachhaltigkeit, Verkehr, Freizeitpädagogik, Sonderpädagogik, Lernförderung, sonstige. Falls es nicht eindeutig zugeordnet werden kann, nutze 'sonstige'. Sende UNBEDINGT am Ende deiner Nachricht: <action>{\"type\": \"set_chat_subject\", \"subject\": \"Fachname\"}</action>. Erwähne dies NIEMALS im Text."
+)
+
+NAMING_TASK = (
+    "\n\nWEITERE HINTERGRUND-AUFGABE (STRENG GEHEIM):"
+    "\nTITEL: Gib dem Chat einen kurzen, passenden Namen (max. 30 Zeichen). Sende dazu UNBEDINGT am Ende deiner Nachricht: <action>{\"type\": \"chat_naming\", \"title\": \"Dein Titel\"}</action>"
+)
+
+DECISION_MATRIX_MATH = "\n\nENTSCHEIDUNGSMATRIX:\n- Mathe-Aufgabe? -> Lösung direkt nennen.\n- Deutsch/Sprachen/Sonstiges? -> Lösung NIEMALS nennen, nur Tipps geben (Guiding).\nWICHTIG: Handle laut Matrix, aber erwähne sie niemals gegenüber dem Benutzer!"
+DECISION_MATRIX_GUIDING = "\n\nENTSCHEIDUNGSMATRIX: Alle Fächer -> Nur Tipps geben (Guiding)."
+
+REMINDER_MATH = "\n\n⚠️ ERINNERUNG: Der Mathe-Löser ist AKTIV. Löse NUR mathematische Aufgaben JETZT DIREKT. Für alle anderen Fächer (Deutsch, Sprachen, etc.) gilt weiterhin striktes GUIDING!"
+REMINDER_GUIDING = "\n\n⚠️ ERINNERUNG: Der Mathe-Löser ist AUS. Für ALLE Fächer gilt striktes GUIDING (keine Lösungen nennen)."
+
+DIGEST_HEADER = "\n\nFRUEHERE CHATS DES NUTZERS (nur als Hintergrund; greife sie nur auf, wenn sie zur aktuellen Frage passen):\n"
+
+
+@lru_cache(maxsize=None)
+def static_prefix(system_prompt, math_solver_enabled, logged_in):
+    """The cacheable head of the system message, one string per configuration."""
+    prefix = (system_prompt or "") + (MATH_SOLVER_RULE if math_solver_enabled else "")
+    if logged_in:
+        prefix += HOMEWORK_RULES
+    prefix += BACKGROUND_TASKS
+    prefix += DECISION_MATRIX_MATH if math_solver_enabled else DECISION_MATRIX_GUIDING
+    return prefix
+
+
+def _homework_lines(homework):
+    lines = []
+    for hw in homework:
+        hw_subject = hw.get('subject_name') or 'sonstige'
+        hw_status = 'erledigt' if hw.get('completed') else 'offen'
+        lines.append(
+            f"- ID: {hw.get('id', '')} | Titel: {hw.get('title', '')} | Faellig: {hw.get('due_date', '')} | Fach: {hw_subject} | Status: {hw_status}"
+        )
+    return "\n".join(lines) if lines else "- Keine vorhandenen Hausaufgaben."
+
+
+def dynamic_suffix(now, logged_in, homework=(), calendar_entry_intent=False, bulk_delete_intent=False,
+                   needs_title=False, previous_chats=()):
+    """The per-turn tail of the system message, appended after static_prefix()."""
+    current_date_str = now.strftime("%Y-%m-%d")
+    upcoming_weekdays = []
+    for offset in range(7):
+        day = now + timedelta(days=offset)
+        upcoming_weekdays.append(f"{WEEKDAY_NAMES[day.weekday()]} = {day.strftime('%Y-%m-%d')}")
+    upcoming_weekdays_text = "\n- ".join(upcoming_weekdays)
+
+    suffix = (
+        f"\n\nHEUTE IST: {WEEKDAY_NAMES[now.weekday()]}, der {current_date_str} ({now.strftime('%d.%m.%Y')}), Zeitzone Europe/Berlin."
+        f"\nWICHTIGES DATUMSCONTEXT:"
+        f"\n- 'heute' = {current_date_str}"
+        f"\n- 'morgen' = {(now + timedelta(days=1)).strftime('%Y-%m-%d')}"
+        f"\n- 'uebermorgen' = {(now + timedelta(days=2)).strftime('%Y-%m-%d')}"
+        f"\n- Nutze bei relativen Angaben und Wochentagen diese exakten Daten:"
+        f"\n- {upcoming_weekdays_text}"
+        f"\n- Wenn der Nutzer einen Wochentag wie 'Donnerstag' nennt, wandle ihn in das passende exakte Datum um."
+        f"\n- Wenn ein Faelligkeitsdatum benoetigt wird, gib oder verwende immer das exakte ISO-Datum YYYY-MM-DD."
+    )
+    if logged_in:
+        suffix += f"\n\nVORHANDENE HAUSAUFGABEN:\n{_homework_lines(homework)}"
+        if calendar_entry_intent:
+            suffix += CALENDAR_INTENT_RULES
+        if bulk_delete_intent:
+            suffix += BULK_DELETE_RULES
+    if previous_chats:
+        suffix += DIGEST_HEADER + "\n".join(previous_chats)
+    if needs_title:
+        suffix += NAMING_TASK
+    return suffix
+
+
+def final_reminder(math_solver_enabled):
+    return REMINDER_MATH if math_solver_enabled else REMINDER_GUIDING
+
+
+def _field(obj, name):
+    if obj is None:
+        return None
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def usage_report(usage):
+    """Prompt, completion and cached prompt tokens from a completion's usage block.
+
+    OpenAI-compatible APIs report cache hits as prompt_tokens_details.cached_tokens,
+    some proxies as cache_read_input_tokens; values a provider omits are None.
+    """
+    if usage is None:
+        return None
+    cached = _field(_field(usage, 'prompt_tokens_details'), 'cached_tokens')
+    if cached is None:
+        cached = _field(usage, 'cache_read_input_tokens')
+    return {
+        'prompt_tokens': _field(usage, 'prompt_tokens'),
+        'completion_tokens': _field(usage, 'completion_tokens'),
+        'cached_tokens': cached,
+    }
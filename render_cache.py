@@ -0,0 +1,83 @@
+"""
+In-memory cache for rendered worksheets, keyed by the SHA-256 of the markdown.
+
+Worksheets are stored under their content hash (sheets/<sha256>.md/.pdf, see
+worksheet_renderer), so identical markdown is stored and rendered once. This
+cache keeps the preview HTML and PDF bytes of recently viewed worksheets in
+memory; the least recently used entries are evicted once it holds more than
+RENDER_CACHE_MAX_MB. The hash also serves as ETag for preview and download.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+RENDER_CACHE_MAX_MB = float(os.getenv('RENDER_CACHE_MAX_MB', '64'))
+
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+_max_bytes = int(RENDER_CACHE_MAX_MB * 1024 * 1024)
+_entries = OrderedDict()  # (content_hash, kind) -> value
+_size = 0
+_hits = 0
+_misses = 0
+_lock = threading.Lock()
+
+
+def content_hash(markdown_text):
+    return hashlib.sha256(markdown_text.encode('utf-8')).hexdigest()
+
+
+def hash_from_filename(filename):
+    """The content hash in a '<sha256>.<ext>' worksheet filename, None for older (uuid) names."""
+    base_name = os.path.splitext(os.path.basename(filename or ''))[0]
+    return base_name if _HASH_RE.match(base_name) else None
+
+
+def _sizeof(value):
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+
+def get(key, kind):
+    global _hits, _misses
+    with _lock:
+        value = _entries.get((key, kind))
+        if value is None:
+            _misses += 1
+            return None
+        _entries.move_to_end((key, kind))
+        _hits += 1
+        return value
+
+
+def put(key, kind, value):
+    global _size
+    size = _sizeof(value)
+    # Never let one entry flush the whole cache
+    if size > _max_bytes // 4:
+        return
+    with _lock:
+        old = _entries.pop((key, kind), None)
+        if old is not None:
+            _size -= _sizeof(old)
+        _entries[(key, kind)] = value
+        _size += size
+        while _size > _max_bytes and _entries:
+            _, evicted = _entries.popitem(last=False)
+            _size -= _sizeof(evicted)
+
+
+def get_or_build(key, kind, build):
+    """Cached value for (key, kind); build() computes it on a miss."""
+    value = get(key, kind)
+    if value is None:
+        value = build()
+        put(key, kind, value)
+    return value
+
+
+def stats():
+    with _lock:
+        return {'entries': len(_entries), 'bytes': _size, 'max_bytes': _max_bytes, 'hits': _hits, 'misses': _misses}
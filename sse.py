@@ -0,0 +1,282 @@
+"""
+Server-sent events for /ask.
+
+Every message is a named event with a JSON payload (event: text, data:
+{"delta": ...}; event: session_title, data: {"title": ...}; ...) and an id
+of the form <stream>-<n>, where n increases by one per event.
+
+The answer is produced by start(): it runs the producer, a generator of
+(event, payload) pairs, on a background thread. Each event is stored in the
+stream's replay buffer, which keeps the last SSE_REPLAY_EVENTS events. A
+response only listens to the buffer. When the connection drops, the browser
+reconnects to the same URL with a Last-Event-ID header. find() and listen()
+then send what was missed instead of calling the model again. A finished
+stream stays resumable for SSE_REPLAY_TTL seconds. Buffers are kept per
+process, so a reconnect that reaches another gunicorn worker gets `expired`,
+and the client reloads the saved chat instead.
+
+The producer always runs to the end, whether anybody listens or not: a client
+that leaves only stops the sending, the answer is still saved and its actions
+carried out. At most SSE_PRODUCERS answers run in the background per process;
+beyond that busy() is true and the request gets a `busy` event instead of
+waiting unseen for a free thread. SSE_REPLAY=0 turns the replay buffer off:
+the producer then runs in the request's own thread, as the response body, and
+a reconnect gets `expired`.
+
+Coalescer batches text deltas: many deltas of a few characters each would
+cost one event and one write each through the WSGI server and the reverse
+proxy. Text is sent once SSE_COALESCE_MS have passed since the first buffered
+delta or once SSE_COALESCE_BYTES are buffered. The first text of an answer goes
+out at once. Any other event flushes the buffered text first, so order is
+kept. The window is only checked when the stream produces something, so call
+tick() for chunks that yield no text (thinking blocks, action markup).
+SSE_COALESCE_MS=0 sends every delta on its own.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+SSE_COALESCE_MS = float(os.getenv('SSE_COALESCE_MS', '40'))
+SSE_COALESCE_BYTES = int(os.getenv('SSE_COALESCE_BYTES', '2048'))
+SSE_REPLAY_EVENTS = int(os.getenv('SSE_REPLAY_EVENTS', '2000'))
+SSE_REPLAY_TTL = float(os.getenv('SSE_REPLAY_TTL', '120'))
+SSE_REPLAY = os.getenv('SSE_REPLAY', '1').lower() not in ('0', 'false', 'no', 'off')
+# A listener sends a ping when the producer has been quiet this long
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+# Reconnect delay the browser should use
+SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', '2000'))
+# Answers generated in the background at the same time per process (with SSE_REPLAY)
+SSE_PRODUCERS = int(os.getenv('SSE_PRODUCERS', '16'))
+
+# no-transform and X-Accel-Buffering keep proxies (nginx) from buffering the stream
+HEADERS = {'Cache-Control': 'no-cache, no-transform', 'X-Accel-Buffering': 'no'}
+
+_streams = {}
+_streams_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=SSE_PRODUCERS, thread_name_prefix='sse')
+_running = 0  # producers started on _executor and not finished
+
+
+def frame(event, data=None, event_id=None):
+    """One event as a single string."""
+    out = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{out}event: {event}\ndata: {json.dumps(data or {}, ensure_ascii=False)}\n\n"
+
+
+class Coalescer:
+    """Batches text deltas into events. Every method returns the (event, payload) pairs to send now."""
+
+    def __init__(self, window_ms=SSE_COALESCE_MS, max_bytes=SSE_COALESCE_BYTES):
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self.events = 0
+        self.deltas = 0
+        self._parts = []
+        self._size = 0
+        self._since = None
+        self._text_sent = False
+
+    def text(self, delta):
+        if not delta:
+            return self.tick()
+        self.deltas += 1
+        if not self._parts:
+            self._since = time.monotonic()
+        self._parts.append(delta)
+        self._size += len(delta.encode('utf-8'))
+        return self.tick()
+
+    def tick(self):
+        """Send the buffered text if the window has passed or the buffer is full."""
+        if self._parts and (not self._text_sent or self._size >= self.max_bytes
+                            or time.monotonic() - self._since >= self.window):
+            return self.flush()
+        return []
+
+    def control(self, event, data=None):
+        """Any event other than text: the buffered text first, then the event."""
+        self.events += 1
+        return self.flush() + [(event, data or {})]
+
+    def flush(self):
+        if not self._parts:
+            return []
+        delta = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._since = None
+        self._text_sent = True
+        self.events += 1
+        return [('text', {'delta': delta})]
+
+
+class Stream:
+    """The events of one answer, kept for replay to any number of listeners."""
+
+    def __init__(self, owner):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.finished_at = None
+        self.bytes_sent = 0
+        self.listeners = 0
+        self._events = deque(maxlen=SSE_REPLAY_EVENTS)  # (n, frame)
+        self._next = 1
+        self._cond = threading.Condition()
+        self._producer = None  # set when the producer runs inside listen() (SSE_REPLAY=0)
+
+    def _frame(self, event, data):
+        with self._cond:
+            n = self._next
+            self._next += 1
+        return n, frame(event, data, f"{self.id}-{n}")
+
+    def publish(self, event, data=None):
+        n, out = self._frame(event, data)
+        with self._cond:
+            self._events.append((n, out))
+            self._cond.notify_all()
+
+    def _run(self, producer):
+        """The producer's events, then `done`; a failing producer ends with `error`."""
+        try:
+            # A for loop, not yield from: closing this generator must not close the producer
+            for item in producer:
+                yield item
+        except Exception as e:
+            print(f"[sse] Producer of stream {self.id} failed: {e}")
+            yield 'error', {'message': f"❌ Ein unerwarteter Fehler ist aufgetreten: {e}"}
+        yield 'done', {}
+
+    def _pump(self, producer):
+        global _running
+        try:
+            for event, data in self._run(producer):
+                self.publish(event, data)
+        finally:
+            with self._cond:
+                self.finished_at = time.monotonic()
+            with _streams_lock:
+                _running -= 1
+
+    def listen(self, after=0):
+        """Generator of frames: the events after number `after`, then new ones until the stream is done."""
+        if self._producer is not None:
+            producer, self._producer = self._producer, None
+            return self._run_here(producer)
+        return self._listen(after)
+
+    def _run_here(self, producer):
+        """Response body that runs the producer itself; if the client leaves, the rest runs unsent."""
+        events = self._run(producer)
+        with self._cond:
+            self.listeners += 1
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            for event, data in events:
+                _, out = self._frame(event, data)
+                with self._cond:
+                    self.bytes_sent += len(out.encode('utf-8'))
+                yield out
+        finally:
+            with self._cond:
+                self.listeners -= 1
+            for _ in events:
+                pass
+            with self._cond:
+                self.finished_at = time.monotonic()
+
+    def _listen(self, after):
+        with self._cond:
+            self.listeners += 1
+        position = after
+        finished = False
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                with self._cond:
+                    pending = [item for item in self._events if item[0] > position]
+                    if not pending and self.finished_at is None:
+                        self._cond.wait(SSE_KEEPALIVE_SECONDS)
+                        pending = [item for item in self._events if item[0] > position]
+                    first_kept = self._events[0][0] if self._events else self._next
+                    finished = not pending and self.finished_at is not None
+                if position + 1 < first_kept:
+                    # The events after `position` fell out of the buffer; the answer cannot be completed
+                    finished = True
+                    yield frame('expired')
+                    return
+                if finished:
+                    return
+                if not pending:
+                    yield frame('ping')
+                    continue
+                for n, out in pending:
+                    with self._cond:
+                        self.bytes_sent += len(out.encode('utf-8'))
+                    yield out
+                    position = n
+        finally:
+            with self._cond:
+                self.listeners -= 1
+            if not finished:
+                print(f"DEBUG: Client left stream {self.id} at event {position}, generating on in the background.")
+
+
+def _prune():
+    now = time.monotonic()
+    with _streams_lock:
+        for stream_id, stream in list(_streams.items()):
+            if stream.finished_at is not None and now - stream.finished_at > SSE_REPLAY_TTL:
+                del _streams[stream_id]
+
+
+def busy():
+    """Whether all SSE_PRODUCERS background slots of this process are taken."""
+    with _streams_lock:
+        return SSE_REPLAY and _running >= SSE_PRODUCERS
+
+
+def start(owner, producer):
+    """Run producer (a generator of (event, payload) pairs) in the background; returns its Stream.
+
+    None if all SSE_PRODUCERS slots are taken; answer with busy_body() then.
+    With SSE_REPLAY=0 the producer runs inside the Stream's listen() instead.
+    """
+    global _running
+    _prune()
+    stream = Stream(owner)
+    if not SSE_REPLAY:
+        stream._producer = producer
+        return stream
+    with _streams_lock:
+        if _running >= SSE_PRODUCERS:
+            return None
+        _running += 1
+        _streams[stream.id] = stream
+    _executor.submit(stream._pump, producer)
+    return stream
+
+
+def find(last_event_id, owner):
+    """The stream and the event number to resume after, for a Last-Event-ID; (None, 0) if it is gone."""
+    stream_id, _, n = (last_event_id or '').partition('-')
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+    if stream is None or stream.owner != owner or not n.isdigit():
+        return None, 0
+    return stream, int(n)
+
+
+def expired():
+    """Response body for a Last-Event-ID whose stream is no longer kept."""
+    yield frame('expired')
+
+
+def busy_body(message):
+    """Response body for a request that found all producer slots taken."""
+    yield frame('busy', {'message': message})
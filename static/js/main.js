@@ -254,123 +254,143 @@ document.addEventListener('DOMContentLoaded', function() {
             currentEventSource.close();
             currentEventSource = null;
         }
-        const eventSource = new EventSource(`/ask?question=${encodeURIComponent(text)}`);
-        currentEventSource = eventSource;
+        const askUrl = `/ask?question=${encodeURIComponent(text)}`;
+        const MAX_RECONNECTS = 5;
+        let eventSource = null;
+        let lastEventId = null;
+        let reconnectAttempts = 0;
         let lastMessageTime = Date.now();
-        let timeoutCheckInterval = null;
-        
-        // Check for connection timeout - restart if no data for 45 seconds
-        timeoutCheckInterval = setInterval(() => {
-            const timeSinceLastMessage = Date.now() - lastMessageTime;
-            if (timeSinceLastMessage > 45000 && eventSource.readyState === 1) {
-                console.warn('EventSource timeout - no data for 45 seconds, reconnecting...');
-                eventSource.close();
-                // The onerror handler will clean up and show error
-            }
-        }, 10000); // Check every 10 seconds
-        
-        // when the SSE connection terminates (either natural or due to error)
-        // clear the stored reference so that future calls won't try to close it.
-        eventSource.onerror = function(e) {
-            clearInterval(timeoutCheckInterval);
-            if (currentEventSource === eventSource) currentEventSource = null;
-            // Don't show error for normal closure
-            if (e.type !== 'close') {
-                console.error('EventSource error:', e);
-            }
-        };
         let fullAnswer = '';
         let botMessageAppended = false;
         let worksheetLoadingIndicator = { val: null };
 
-        eventSource.onmessage = function(event) {
-            // Reset timeout on each message
-            lastMessageTime = Date.now();
-            
-            const content = event.data;
-            const trimmedContent = content.trim();
-
-            // Ignore PING messages
-            if (trimmedContent === "PING") {
-                return;
+        function appendBotMessage() {
+            if (botMessageAppended) return;
+            if (thinkingIndicator && thinkingIndicator.parentNode) {
+                thinkingIndicator.parentNode.removeChild(thinkingIndicator);
             }
+            chatHistory.appendChild(botMessageElement);
+            botMessageAppended = true;
+        }
 
-            if (!botMessageAppended && trimmedContent !== "") {
-                if (thinkingIndicator && thinkingIndicator.parentNode) {
-                    thinkingIndicator.parentNode.removeChild(thinkingIndicator);
+        function appendText(text) {
+            appendBotMessage();
+            fullAnswer += text;
+
+            // Normalize whitespace for marked - keep newlines but collapse triple newlines to double
+            let cleaningHTML = fullAnswer.replace(/\n{3,}/g, '\n\n');
+            cleaningHTML = cleaningHTML.trimStart();
+            
+            botMessageElement.querySelector('.prose').innerHTML = marked.parse(cleaningHTML);
+        }
+
+        function showWorksheetActions(worksheet_filename) {
+            // Clean filename just in case
+            worksheet_filename = worksheet_filename.replace(/^.*[\\\/]/, '');
+            
+            // Container für Arbeitsblatt-Aktionen
+            const actionContainer = document.createElement('div');
+            actionContainer.className = 'mt-3 space-y-2';
+            
+            const buttonsWrapper = document.createElement('div');
+            buttonsWrapper.className = 'flex flex-wrap gap-2';
+            
+            const previewBtn = document.createElement('button');
+            previewBtn.className = 'inline-flex items-center px-3 py-1.5 border border-purple-200 text-xs font-medium rounded-md shadow-sm text-purple-700 bg-purple-50 hover:bg-purple-100 transition-colors';
+            previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility</span> Vorschau anzeigen';
+            
+            const downloadLink = document.createElement('a');
+            downloadLink.href = `/download-worksheet/${worksheet_filename}`;
+            downloadLink.className = 'inline-flex items-center px-3 py-1.5 border border-transparent text-xs font-medium rounded-md shadow-sm text-white bg-blue-600 hover:bg-blue-700 transition-colors';
+            downloadLink.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">download</span> Herunterladen';
+            
+            buttonsWrapper.appendChild(previewBtn);
+            buttonsWrapper.appendChild(downloadLink);
+            actionContainer.appendChild(buttonsWrapper);
+            
+            const previewWrapper = document.createElement('div');
+            previewWrapper.className = 'hidden mt-2 border border-purple-200 rounded-lg overflow-hidden bg-white';
+            actionContainer.appendChild(previewWrapper);
+            
+            previewBtn.onclick = () => {
+                if (previewWrapper.classList.contains('hidden')) {
+                    previewWrapper.classList.remove('hidden');
+                    previewWrapper.innerHTML = `<iframe src="/preview-worksheet/${worksheet_filename}" style="width: 100%; height: 500px; border: none; background: white;"></iframe>`;
+                    previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility_off</span> Vorschau ausblenden';
+                } else {
+                    previewWrapper.classList.add('hidden');
+                    previewWrapper.innerHTML = '';
+                    previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility</span> Vorschau anzeigen';
                 }
-                chatHistory.appendChild(botMessageElement);
-                botMessageAppended = true;
-            }
+                scrollToBottom();
+            };
             
-            if (trimmedContent.startsWith("WORKSHEET_DOWNLOAD_LINK:")) {
-                let worksheet_filename = trimmedContent.substring("WORKSHEET_DOWNLOAD_LINK:".length);
-                // Clean filename just in case
-                worksheet_filename = worksheet_filename.replace(/^.*[\\\/]/, '');
-                
+            botMessageElement.querySelector('.flex-1').appendChild(actionContainer);
+        }
+
+        function removeLoadingIndicators() {
+            if (thinkingIndicator && thinkingIndicator.parentNode) {
+                thinkingIndicator.parentNode.removeChild(thinkingIndicator);
+            }
+            if (worksheetLoadingIndicator.val && worksheetLoadingIndicator.val.parentNode) {
+                worksheetLoadingIndicator.val.parentNode.removeChild(worksheetLoadingIndicator.val);
+                worksheetLoadingIndicator.val = null;
+            }
+        }
+
+        // when the stream ends (done, busy, expired or given up) close it, so the
+        // browser does not reconnect, and clear the stored reference
+        function closeStream() {
+            clearInterval(timeoutCheckInterval);
+            eventSource.close();
+            if (currentEventSource === eventSource) currentEventSource = null;
+        }
+
+        // Named server events; every payload is JSON
+        const eventHandlers = {
+            ping: () => {},
+            text: (data) => appendText(data.delta),
+            error: (data) => appendText((fullAnswer ? '\n\n' : '') + data.message),
+            worksheet_started: () => {
+                console.log("Arbeitsblatt-Generierung gestartet...");
+                appendBotMessage();
+                showWorksheetLoading(botMessageElement.querySelector('.flex-1'), worksheetLoadingIndicator);
+            },
+            // Render job id; its state is available at /api/jobs/<id>
+            worksheet_job: (data) => { botMessageElement.dataset.worksheetJob = data.job_id; },
+            worksheet_ready: (data) => {
+                appendBotMessage();
                 // Remove loading indicator if it exists
                 if (worksheetLoadingIndicator.val && worksheetLoadingIndicator.val.parentNode) {
                     worksheetLoadingIndicator.val.parentNode.removeChild(worksheetLoadingIndicator.val);
                     worksheetLoadingIndicator.val = null;
                 }
-
-                // Ermittle Dateiendung
-                const dateiendung = worksheet_filename.split('.').pop().toLowerCase();
-                
-                // Container für Arbeitsblatt-Aktionen
-                const actionContainer = document.createElement('div');
-                actionContainer.className = 'mt-3 space-y-2';
-                
-                const buttonsWrapper = document.createElement('div');
-                buttonsWrapper.className = 'flex flex-wrap gap-2';
-                
-                const previewBtn = document.createElement('button');
-                previewBtn.className = 'inline-flex items-center px-3 py-1.5 border border-purple-200 text-xs font-medium rounded-md shadow-sm text-purple-700 bg-purple-50 hover:bg-purple-100 transition-colors';
-                previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility</span> Vorschau anzeigen';
-                
-                const downloadLink = document.createElement('a');
-                downloadLink.href = `/download-worksheet/${worksheet_filename}`;
-                downloadLink.className = 'inline-flex items-center px-3 py-1.5 border border-transparent text-xs font-medium rounded-md shadow-sm text-white bg-blue-600 hover:bg-blue-700 transition-colors';
-                downloadLink.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">download</span> Herunterladen';
-                
-                buttonsWrapper.appendChild(previewBtn);
-                buttonsWrapper.appendChild(downloadLink);
-                actionContainer.appendChild(buttonsWrapper);
-                
-                const previewWrapper = document.createElement('div');
-                previewWrapper.className = 'hidden mt-2 border border-purple-200 rounded-lg overflow-hidden bg-white';
-                actionContainer.appendChild(previewWrapper);
-                
-                previewBtn.onclick = () => {
-                    if (previewWrapper.classList.contains('hidden')) {
-                        previewWrapper.classList.remove('hidden');
-                        previewWrapper.innerHTML = `<iframe src="/preview-worksheet/${worksheet_filename}" style="width: 100%; height: 500px; border: none; background: white;"></iframe>`;
-                        previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility_off</span> Vorschau ausblenden';
-                    } else {
-                        previewWrapper.classList.add('hidden');
-                        previewWrapper.innerHTML = '';
-                        previewBtn.innerHTML = '<span class="material-symbols-outlined text-sm mr-1">visibility</span> Vorschau anzeigen';
-                    }
-                    scrollToBottom();
-                };
-                
-                botMessageElement.querySelector('.flex-1').appendChild(actionContainer);
-            } else if (trimmedContent === "HOMEWORK_SAVING") {
+                if (data.error) appendText('\n\nFehler bei der PDF-Erstellung.');
+                if (data.filename) showWorksheetActions(data.filename);
+            },
+            homework_saving: () => {
+                appendBotMessage();
+                showHomeworkLoading(botMessageElement.querySelector('.flex-1'));
+            },
+            homework_updated: () => {
+                appendBotMessage();
                 showHomeworkLoading(botMessageElement.querySelector('.flex-1'));
-            } else if (trimmedContent.startsWith("HOMEWORK_LINK:")) {
-                const homeworkId = trimmedContent.substring("HOMEWORK_LINK:".length).trim();
-                appendHomeworkLink(botMessageElement.querySelector('.flex-1'), homeworkId);
-            } else if (trimmedContent.startsWith("SESSION_TITLE:")) {
-                const newTitle = trimmedContent.substring("SESSION_TITLE:".length);
+            },
+            homework_link: (data) => {
+                appendBotMessage();
+                appendHomeworkLink(botMessageElement.querySelector('.flex-1'), data.homework_id);
+            },
+            session_title: (data) => {
                 const activeSession = document.querySelector('.chat-session.bg-purple-100');
                 if (activeSession) {
                     const titleEl = activeSession.querySelector('.session-title');
-                    if (titleEl) animateTitleUpdate(titleEl, newTitle);
+                    if (titleEl) animateTitleUpdate(titleEl, data.title);
                 }
                 // Always reload the full session list to ensure sync
                 setTimeout(loadAllChatSessionsAndRender, 500);
-            } else if (trimmedContent.startsWith("SESSION_SUBJECT:")) {
-                const neuesFach = trimmedContent.substring("SESSION_SUBJECT:".length);
+            },
+            session_subject: (data) => {
+                const neuesFach = data.subject;
                 const activChat = document.querySelector('.chat-session.bg-purple-100');
                 if (activChat) {
                     // Update or create the subject element
@@ -386,74 +406,73 @@ document.addEventListener('DOMContentLoaded', function() {
                 // Aktualisiere auch die Fach-Filter-Optionen und die Session-Liste
                 loadChatSubjects();
                 loadAllChatSessionsAndRender();
-            } else if (trimmedContent === "START_WORKSHEET_GENERATION") {
-                console.log("Arbeitsblatt-Generierung gestartet...");
-                showWorksheetLoading(botMessageElement.querySelector('.flex-1'), worksheetLoadingIndicator);
-            } else if (trimmedContent === "HOMEWORK_UPDATED") {
-                showHomeworkLoading(botMessageElement.querySelector('.flex-1'));
-            } else {
-                fullAnswer += content;
-
-                // Also check if the raw stream contains worksheet markers to show animation immediately
-                if (fullAnswer.includes('worksheet_creation') && !worksheetLoadingIndicator.val) {
-                    showWorksheetLoading(botMessageElement.querySelector('.flex-1'), worksheetLoadingIndicator);
+            },
+            done: () => {
+                closeStream();
+                removeLoadingIndicators();
+                if (!botMessageAppended) {
+                    addBotMessage("Es gab ein Problem bei der Verarbeitung deiner Anfrage. Bitte versuche es später noch einmal.");
                 }
+            },
+            // Too many answers running on the server; nothing was saved
+            busy: (data) => {
+                closeStream();
+                removeLoadingIndicators();
+                addBotMessage(data.message);
+            },
+            // The server no longer has the events we missed; show the saved answer instead
+            expired: () => {
+                closeStream();
+                removeLoadingIndicators();
+                loadChatHistory();
+            },
+        };
 
-                // Remove finished action tags and replace with empty string
-                let displayHTML = fullAnswer.replace(/<action>[\s\S]*?<\/action>/gi, '');
-                
-                // Remove thinking/internal tags
-                displayHTML = displayHTML.replace(/\[(?:thinking|thoughts|gedanken|chain-of-thought|analysis)\][\s\S]*?\[\/(?:thinking|thoughts|gedanken|chain-of-thought|analysis)\]/gi, '');
-                displayHTML = displayHTML.replace(/\{(?:gedanken|thoughts|thinking|internal)[^}]*\}/gi, '');
+        function connect() {
+            // A reconnect sends the last event id, so the server continues the running answer
+            const url = lastEventId ? `${askUrl}&last_event_id=${encodeURIComponent(lastEventId)}` : askUrl;
+            eventSource = new EventSource(url);
+            currentEventSource = eventSource;
+            Object.entries(eventHandlers).forEach(([name, handler]) => {
+                eventSource.addEventListener(name, (event) => {
+                    lastMessageTime = Date.now();
+                    reconnectAttempts = 0;
+                    if (event.lastEventId) lastEventId = event.lastEventId;
+                    handler(JSON.parse(event.data));
+                    scrollToBottom();
+                });
+            });
+            eventSource.onerror = function(error) {
+                // The browser reconnects on its own (with Last-Event-ID); give up after a few attempts
+                if (eventSource.readyState === EventSource.CONNECTING && ++reconnectAttempts <= MAX_RECONNECTS) {
+                    console.warn(`EventSource reconnecting (${reconnectAttempts}/${MAX_RECONNECTS})...`);
+                    return;
+                }
+                console.error('EventSource failed:', error);
+                closeStream();
+                removeLoadingIndicators();
+                if (fullAnswer) {
+                    // Do nothing
+                } else {
+                    addBotMessage("Es gab ein Problem bei der Verarbeitung deiner Anfrage. Bitte versuche es später noch einmal.");
+                }
+            };
+        }
 
-                // If we are currently inside an action tag or have a partial tag, hide ONLY the tag
-                // We use a temporary variable for the regex check to avoid mutating displayHTML incorrectly
-                let cleaningHTML = displayHTML;
-                
-                // Hide partial tags at the end of the stream without replacing them with spaces
-                // This prevents "eating" characters if the regex is too broad
-                cleaningHTML = cleaningHTML.replace(/<[a-zA-Z\/]*$/i, ''); 
-                cleaningHTML = cleaningHTML.replace(/<action[\s\S]*$/i, ''); 
-                cleaningHTML = cleaningHTML.replace(/[\{\[]\s*$/g, ''); 
-
-                // Final cleanup for stray complete tag fragments
-                cleaningHTML = cleaningHTML.replace(/<\/action>/gi, '');
-                cleaningHTML = cleaningHTML.replace(/<action>/gi, '');
-                
-                // Filter out redundant "please wait" phrases
-                cleaningHTML = cleaningHTML.replace(/Bitte hab einen Moment Geduld, während ich es generiere\./gi, '');
-                cleaningHTML = cleaningHTML.replace(/Bitte gib mir einen Moment, damit es vollständig generiert wird\./gi, '');
-                cleaningHTML = cleaningHTML.replace(/Bitte hab einen Moment Geduld\./gi, '');
-                cleaningHTML = cleaningHTML.replace(/Bitte gib mir einen Moment\./gi, '');
-
-                // Normalize whitespace for marked - keep newlines but collapse triple newlines to double
-                cleaningHTML = cleaningHTML.replace(/\n{3,}/g, '\n\n');
-                
-                // Trim leading whitespace only if it's the very start of the whole message
-                // and it was likely left over from a stripped "please wait" or tag
-                cleaningHTML = cleaningHTML.trimStart();
-                
-                botMessageElement.querySelector('.prose').innerHTML = marked.parse(cleaningHTML);
+        // Check for a dead connection - the server pings at least every 15 seconds
+        const timeoutCheckInterval = setInterval(() => {
+            const timeSinceLastMessage = Date.now() - lastMessageTime;
+            if (currentEventSource !== eventSource) {
+                clearInterval(timeoutCheckInterval);
+            } else if (timeSinceLastMessage > 45000 && eventSource.readyState === 1) {
+                console.warn('EventSource timeout - no data for 45 seconds, reconnecting...');
+                eventSource.close();
+                lastMessageTime = Date.now();
+                connect();
             }
-            scrollToBottom();
-        };
+        }, 10000); // Check every 10 seconds
 
-        eventSource.onerror = function(error) {
-            console.error('EventSource failed:', error);
-            eventSource.close();
-            if (thinkingIndicator && thinkingIndicator.parentNode) {
-                thinkingIndicator.parentNode.removeChild(thinkingIndicator);
-            }
-            if (worksheetLoadingIndicator.val && worksheetLoadingIndicator.val.parentNode) {
-                worksheetLoadingIndicator.val.parentNode.removeChild(worksheetLoadingIndicator.val);
-                worksheetLoadingIndicator.val = null;
-            }
-            if (fullAnswer) {
-                // Do nothing
-            } else {
-                addBotMessage("Es gab ein Problem bei der Verarbeitung deiner Anfrage. Bitte versuche es später noch einmal.");
-            }
-        };
+        connect();
     }
 
     const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
@@ -1283,19 +1302,69 @@ document.addEventListener('DOMContentLoaded', function() {
         .catch(error => console.error('Error checking chat status:', error));
     }
 
+    // Chat history is loaded in pages; older messages are fetched on demand
+    const HISTORY_PAGE_SIZE = 50;
+
+    function renderHistoryMessage(msg) {
+        if (msg.message_type === 'user') {
+            addUserMessage(msg.content, msg.created_at, msg.image_data);
+        } else if (msg.message_type === 'assistant') {
+            addBotMessage(msg.content, msg.created_at, msg.worksheet_filename, msg.homework_id);
+        }
+    }
+
+    function historyUrl(sessionId, params) {
+        const query = new URLSearchParams(params).toString();
+        return sessionId ? `/load-chat/${sessionId}?${query}` : `/get-chat-history?${query}`;
+    }
+
+    function addLoadOlderButton(sessionId, beforeIdx) {
+        const wrapper = document.createElement('div');
+        wrapper.className = 'flex justify-center load-older-messages';
+        const button = document.createElement('button');
+        button.className = 'text-xs font-medium text-purple-700 bg-purple-50 hover:bg-purple-100 border border-purple-200 rounded-full px-3 py-1 transition-colors';
+        button.textContent = 'Ältere Nachrichten laden';
+        button.addEventListener('click', () => {
+            button.disabled = true;
+            fetch(historyUrl(sessionId, { limit: HISTORY_PAGE_SIZE, before: beforeIdx }), { method: sessionId ? 'POST' : 'GET' })
+            .then(response => response.json())
+            .then(data => {
+                // Render the older page in front of what is already shown and keep the scroll position
+                const previousHeight = chatHistory.scrollHeight;
+                const shown = Array.from(chatHistory.childNodes).filter(node => node !== wrapper);
+                chatHistory.innerHTML = '';
+                const messages = data.chat_history || [];
+                if (data.has_more && messages.length > 0) {
+                    addLoadOlderButton(sessionId, messages[0].msg_idx);
+                }
+                messages.forEach(renderHistoryMessage);
+                shown.forEach(node => chatHistory.appendChild(node));
+                chatHistory.scrollTop += chatHistory.scrollHeight - previousHeight;
+            })
+            .catch(error => {
+                console.error('Error loading older messages:', error);
+                button.disabled = false;
+            });
+        });
+        wrapper.appendChild(button);
+        chatHistory.appendChild(wrapper);
+    }
+
+    function renderHistoryPage(data, sessionId) {
+        const messages = data.chat_history || [];
+        if (data.has_more && messages.length > 0) {
+            addLoadOlderButton(sessionId, messages[0].msg_idx);
+        }
+        messages.forEach(renderHistoryMessage);
+    }
+
     function loadChatHistory() {
-        fetch('/get-chat-history')
+        fetch(historyUrl(null, { limit: HISTORY_PAGE_SIZE }))
         .then(response => response.json())
         .then(data => {
             if (data.chat_history && data.chat_history.length > 0) {
                 chatHistory.innerHTML = ''; // Clear before adding
-                data.chat_history.forEach(msg => {
-                    if (msg.message_type === 'user') {
-                        addUserMessage(msg.content, msg.created_at, msg.image_data);
-                    } else if (msg.message_type === 'assistant') {
-                        addBotMessage(msg.content, msg.created_at, msg.worksheet_filename, msg.homework_id);
-                    }
-                });
+                renderHistoryPage(data, null);
             }
         })
         .catch(error => {
@@ -1352,7 +1421,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const sessionId = sessionElement.dataset.sessionId;
                 currentSessionId = sessionId;
 
-                fetch(`/load-chat/${sessionId}`, {
+                fetch(historyUrl(sessionId, { limit: HISTORY_PAGE_SIZE }), {
                     method: 'POST'
                 })
                 .then(response => response.json())
@@ -1364,13 +1433,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     if (oldIndicator) oldIndicator.remove();
 
                     if (data.chat_history && data.chat_history.length > 0) {
-                        data.chat_history.forEach(msg => {
-                            if (msg.message_type === 'user') {
-                                addUserMessage(msg.content, msg.created_at, msg.image_data);
-                            } else if (msg.message_type === 'assistant') {
-                                addBotMessage(msg.content, msg.created_at, msg.worksheet_filename, msg.homework_id);
-                            }
-                        });
+                        renderHistoryPage(data, sessionId);
                     }
 
                     document.querySelectorAll('.chat-session').forEach(s => {
@@ -1993,21 +2056,24 @@ document.addEventListener('DOMContentLoaded', function() {
 
                         if (data.generating) {
 
-                            // Poll for completion
+                            // Poll for completion; only messages changed since the last poll are fetched
+                            let cursor = data.cursor;
 
                             const pollInterval = setInterval(() => {
 
-                                fetch('/get-chat-history')
+                                fetch(historyUrl(null, { since: cursor }))
 
                                     .then(r => r.json())
 
                                     .then(historyData => {
 
-                                        const history = historyData.chat_history;
+                                        if (historyData.cursor) cursor = historyData.cursor;
+
+                                        const changed = historyData.chat_history || [];
 
-                                        const isStillPending = history.some(msg => msg.worksheet_filename === 'PENDING');
+                                        const worksheetReady = changed.some(msg => msg.worksheet_filename && msg.worksheet_filename !== 'PENDING');
 
-                                        if (!isStillPending) {
+                                        if (worksheetReady) {
 
                                             clearInterval(pollInterval);
 
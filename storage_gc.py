@@ -0,0 +1,201 @@
+"""
+Garbage collection for sheets/, uploads/ and blobs/.
+
+Stored messages reference worksheets (sheets/<name>.md/.pdf, through
+worksheet_filename) and images (blobs/, through 'blob:<sha256>'); deleting a
+chat or a user leaves those files behind. uploads/ holds images cached by
+/cache-image until the next /ask copies them into the blob store; nothing on
+the server refers to them after that.
+
+collect() removes sheets and blobs no message references, and any upload,
+once the file is older than its retention period. The retention period also
+covers files whose message is not saved yet: reusing a sheet or blob touches
+the file (worksheet_renderer.submit, blob_store.put_bytes), and a file is only
+deleted if it was not modified within the retention period before the run
+started. Deletes are rate limited, and both the walk over the stored messages
+and the scan of the directories pause after every GC_BATCH_SIZE entries, so
+a run does not compete with request threads for the disk.
+
+start() runs collect() every GC_INTERVAL_HOURS in a daemon thread. A lock on
+GC_STATE_FILE lets only one process of a deployment collect at a time; the
+file also keeps the report of the last run (without fcntl, on Windows, there
+is no lock and the interval check on the file is all that keeps runs apart).
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import blob_store
+import user_storage as us
+import worksheet_renderer
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, every process collects on its own
+    fcntl = None
+
+UPLOADS_DIR = 'uploads'
+GC_INTERVAL_HOURS = float(os.getenv('GC_INTERVAL_HOURS', '6'))
+GC_RETENTION_HOURS = float(os.getenv('GC_RETENTION_HOURS', '24'))
+GC_UPLOAD_RETENTION_HOURS = float(os.getenv('GC_UPLOAD_RETENTION_HOURS', '24'))
+GC_MAX_DELETES_PER_SECOND = float(os.getenv('GC_MAX_DELETES_PER_SECOND', '50'))
+GC_BATCH_SIZE = int(os.getenv('GC_BATCH_SIZE', '500'))
+GC_BATCH_PAUSE = float(os.getenv('GC_BATCH_PAUSE', '0.05'))
+GC_STATE_FILE = os.getenv('GC_STATE_FILE', os.path.join(us.USERS_DIR, 'storage-gc.json'))
+# Seconds after start() before the first run, so it does not slow down startup
+GC_START_DELAY = float(os.getenv('GC_START_DELAY', '300'))
+
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def _scan(directory):
+    """Files below directory; pauses every GC_BATCH_SIZE entries."""
+    stack = [directory]
+    seen = 0
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                seen += 1
+                if seen % GC_BATCH_SIZE == 0:
+                    time.sleep(GC_BATCH_PAUSE)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+class _Run:
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.started = time.time()
+        self.report = {}
+        self._next_delete = 0.0
+
+    def _throttle(self):
+        if GC_MAX_DELETES_PER_SECOND <= 0:
+            return
+        now = time.monotonic()
+        if now < self._next_delete:
+            time.sleep(self._next_delete - now)
+        self._next_delete = max(now, self._next_delete) + 1 / GC_MAX_DELETES_PER_SECOND
+
+    def consider(self, kind, entry, referenced, retention_hours):
+        stats = self.report.setdefault(kind, {
+            'scanned': 0, 'deleted': 0, 'bytes_freed': 0, 'kept_referenced': 0, 'kept_recent': 0,
+        })
+        stats['scanned'] += 1
+        if referenced:
+            stats['kept_referenced'] += 1
+            return
+        cutoff = self.started - retention_hours * 3600
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if st.st_mtime < cutoff and not self.dry_run:
+                self._throttle()
+                # Fresh stat right before deleting: the file may just have been reused
+                st = os.stat(entry.path)
+                if st.st_mtime < cutoff:
+                    os.remove(entry.path)
+        except FileNotFoundError:
+            return
+        if st.st_mtime >= cutoff:
+            stats['kept_recent'] += 1
+            return
+        stats['deleted'] += 1
+        stats['bytes_freed'] += st.st_size
+
+
+def collect(dry_run=False):
+    """Delete orphaned worksheets, blobs and uploads; returns per-directory counts.
+
+    With dry_run nothing is deleted; the report says what would be.
+    """
+    run = _Run(dry_run)
+    references = us.get_referenced_files(batch_size=GC_BATCH_SIZE, pause=GC_BATCH_PAUSE)
+    # A message names one file of a worksheet; its .md/.pdf sibling belongs to it
+    sheet_names = {os.path.splitext(name)[0] for name in references['worksheets']}
+
+    for entry in _scan(worksheet_renderer.SHEETS_DIR):
+        live = '.tmp-' not in entry.name and os.path.splitext(entry.name)[0] in sheet_names
+        run.consider('sheets', entry, live, GC_RETENTION_HOURS)
+    for entry in _scan(blob_store.BLOBS_DIR):
+        run.consider('blobs', entry, entry.name in references['blobs'], GC_RETENTION_HOURS)
+    for entry in _scan(UPLOADS_DIR):
+        run.consider('uploads', entry, False, GC_UPLOAD_RETENTION_HOURS)
+
+    run.report['duration_seconds'] = round(time.time() - run.started, 2)
+    run.report['dry_run'] = dry_run
+    return run.report
+
+
+def _run_if_due():
+    directory = os.path.dirname(GC_STATE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd = os.open(GC_STATE_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None  # another process is collecting
+        st = os.fstat(fd)
+        if st.st_size and time.time() - st.st_mtime < GC_INTERVAL_HOURS * 3600:
+            return None  # another process collected recently
+        report = collect()
+        state = json.dumps({'finished_at': datetime.now().isoformat(), 'report': report}, indent=2)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, state.encode('utf-8'), 0)
+        return report
+    finally:
+        os.close(fd)
+
+
+def _summary(report):
+    parts = []
+    for kind in ('sheets', 'blobs', 'uploads'):
+        stats = report.get(kind)
+        if stats:
+            parts.append(f"{kind}: {stats['deleted']} file(s), {stats['bytes_freed'] / 1024 / 1024:.1f} MB")
+    return '; '.join(parts) or 'nothing to scan'
+
+
+def _loop():
+    time.sleep(GC_START_DELAY)
+    while True:
+        try:
+            report = _run_if_due()
+            if report is not None:
+                print(f"[storage_gc] Reclaimed {_summary(report)} in {report['duration_seconds']}s.")
+        except Exception as e:
+            print(f"[storage_gc] Collection failed: {e}")
+        time.sleep(min(GC_INTERVAL_HOURS * 3600, 3600))
+
+
+def start():
+    """Collect in the background (once per process); GC_INTERVAL_HOURS=0 disables it."""
+    global _started_pid
+    if GC_INTERVAL_HOURS <= 0:
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        threading.Thread(target=_loop, name='storage-gc', daemon=True).start()
+
+
+def last_report():
+    """{'finished_at', 'report'} of the last background run, None if there was none."""
+    try:
+        with open(GC_STATE_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
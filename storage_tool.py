@@ -0,0 +1,74 @@
+import argparse
+import json
+import sys
+
+import user_storage as us
+
+
+def cmd_recover(args):
+    print("--- Learn-AI: Speicher-Wiederherstellung ---")
+    report = us.recover_storage()
+    print(json.dumps(report, indent=2))
+
+
+def cmd_rebuild_indexes(args):
+    print("--- Learn-AI: Indizes neu aufbauen ---")
+    school_index = us.rebuild_school_index()
+    schools = school_index.get('schools', {})
+    print(f"{len(schools)} Schule(n) indiziert.")
+
+
+def cmd_migrate_images(args):
+    print("--- Learn-AI: Chat-Bilder in den Blob-Speicher verschieben ---")
+    count = us.migrate_inline_images()
+    print(f"{count} Einträge umgeschrieben.")
+
+
+def cmd_gc(args):
+    import storage_gc
+    print("--- Learn-AI: Verwaiste Arbeitsblätter, Bilder und Uploads entfernen ---")
+    report = storage_gc.collect(dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+def cmd_migrate(args):
+    import user_storage_sqlite as sq
+    print(f"--- Learn-AI: Migration nach '{args.to}' ---")
+    if args.to == 'sqlite':
+        count = sq.migrate_files_to_sqlite()
+    else:
+        count = sq.migrate_sqlite_to_files()
+    print(f"{count} Benutzer migriert.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wartungswerkzeug für den Learn-AI Benutzerspeicher.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('recover', help="Temp-Dateien entfernen und beschädigte Dateien aus .bak wiederherstellen")
+    p.set_defaults(func=cmd_recover)
+
+    p = sub.add_parser('rebuild-indexes', help="Schul-/Klassen-/Rollen-Index aus allen user.json neu erstellen")
+    p.set_defaults(func=cmd_rebuild_indexes)
+
+    p = sub.add_parser('migrate', help="Daten zwischen Datei- und SQLite-Backend kopieren")
+    p.add_argument('--to', choices=['sqlite', 'files'], required=True)
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser('migrate-images', help="Eingebettete Base64-Bilder alter Nachrichten in den Blob-Speicher verschieben")
+    p.set_defaults(func=cmd_migrate_images)
+
+    p = sub.add_parser('gc', help="Arbeitsblätter, Bilder und Uploads löschen, auf die kein Chat mehr verweist")
+    p.add_argument('--dry-run', action='store_true', help="Nur berichten, nichts löschen")
+    p.set_defaults(func=cmd_gc)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nAbgebrochen.")
+        sys.exit(0)
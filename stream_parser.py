@@ -0,0 +1,136 @@
+"""
+Incremental parser for the model's streamed answer.
+
+The model mixes display text with hidden markup: <action>{...}</action>
+blocks carrying JSON commands, thinking blocks like [thinking]...[/thinking]
+or {gedanken ...}, and filler phrases we never want to show. ActionStreamParser
+consumes the answer chunk by chunk and splits it into clean display text and
+completed action blocks, so /ask can stream only the text to the client and
+run each action as soon as its closing tag arrives. Text that could still be
+the start of a tag is held back until the next chunk decides it.
+"""
+
+import json
+
+ACTION_OPEN = '<action>'
+ACTION_CLOSE = '</action>'
+
+_THINKING_TAGS = ('thinking', 'thoughts', 'gedanken', 'chain-of-thought', 'analysis')
+_INTERNAL_BRACES = ('gedanken', 'thoughts', 'thinking', 'internal')
+
+# Phrases the model uses while "generating" a worksheet; they are dropped
+REDUNDANT_PHRASES = (
+    'Bitte hab einen Moment Geduld, während ich es generiere.',
+    'Bitte gib mir einen Moment, damit es vollständig generiert wird.',
+    'Bitte hab einen Moment Geduld.',
+    'Bitte gib mir einen Moment.',
+    'Ich habe das Arbeitsblatt erstellt!',
+    'Das Arbeitsblatt wird gerade erstellt.',
+)
+
+# (opener, closer, kind); matched case-insensitively. kind 'action' blocks are
+# reported, 'hidden' blocks are dropped, a closer of None drops just the opener.
+_MARKERS = (
+    [(ACTION_OPEN, ACTION_CLOSE, 'action')]
+    + [(f'[{tag}]', f'[/{tag}]', 'hidden') for tag in _THINKING_TAGS]
+    + [('{' + word, '}', 'hidden') for word in _INTERNAL_BRACES]
+    + [(phrase, None, 'hidden') for phrase in REDUNDANT_PHRASES]
+)
+# Longer phrases first, so "... Geduld, während ..." wins over "... Geduld."
+_MARKERS.sort(key=lambda marker: -len(marker[0]))
+_OPENERS = [(opener.lower(), closer and closer.lower(), kind) for opener, closer, kind in _MARKERS]
+
+
+def parse_action_block(block):
+    """The action dicts in the JSON of one <action> block; [] if it is unusable."""
+    try:
+        try:
+            data = json.loads(block)
+        except json.JSONDecodeError:
+            # Models sometimes put raw newlines into JSON strings
+            data = json.loads(block.replace('\n', '\\n').replace('\r', '\\r'))
+    except (json.JSONDecodeError, TypeError):
+        return []
+    items = data if isinstance(data, list) else [data]
+    return [item for item in items if isinstance(item, dict)]
+
+
+class ActionStreamParser:
+    """Split a streamed answer into display text and action blocks.
+
+    feed() and close() return a list of events, each ('text', str) or
+    ('action', block) where block is the raw text between the action tags.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._block = None  # (closer, kind) while inside a block
+
+    @property
+    def open_block(self):
+        """Partial content of the action block currently being received, else None."""
+        if self._block and self._block[1] == 'action':
+            return self._buffer
+        return None
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        events = []
+        while self._buffer:
+            if self._block:
+                closer, kind = self._block
+                pos = self._buffer.lower().find(closer)
+                if pos < 0:
+                    break
+                if kind == 'action':
+                    events.append(('action', self._buffer[:pos]))
+                self._buffer = self._buffer[pos + len(closer):]
+                self._block = None
+                continue
+
+            lowered = self._buffer.lower()
+            found = None
+            for opener, closer, kind in _OPENERS:
+                pos = lowered.find(opener)
+                if pos >= 0 and (found is None or pos < found[0]):
+                    found = (pos, opener, closer, kind)
+            if found is None:
+                keep = self._partial_opener_len(lowered)
+                self._emit(events, self._buffer[:len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+            pos, opener, closer, kind = found
+            self._emit(events, self._buffer[:pos])
+            self._buffer = self._buffer[pos + len(opener):]
+            if closer:
+                self._block = (closer, kind)
+        return events
+
+    def close(self):
+        """Flush held-back text at the end of the stream; unterminated blocks are dropped."""
+        events = []
+        if not self._block:
+            self._emit(events, self._buffer)
+        self._buffer = ''
+        self._block = None
+        return events
+
+    @staticmethod
+    def _partial_opener_len(lowered):
+        """Length of the longest buffer suffix that could still grow into an opener."""
+        longest = 0
+        for opener, _, _ in _OPENERS:
+            for size in range(min(len(opener) - 1, len(lowered)), longest, -1):
+                if lowered.endswith(opener[:size]):
+                    longest = size
+                    break
+        return longest
+
+    @staticmethod
+    def _emit(events, text):
+        if not text:
+            return
+        if events and events[-1][0] == 'text':
+            events[-1] = ('text', events[-1][1] + text)
+        else:
+            events.append(('text', text))
@@ -0,0 +1,120 @@
+"""
+Rolling summaries for long chat sessions.
+
+Once a session has more than SUMMARY_TRIGGER_MESSAGES messages, everything
+except the newest SUMMARY_KEEP_RECENT messages is compressed into a running
+summary stored with the session (user_storage.save_session_summary). The
+summary is extended incrementally: each run folds only the messages added
+since the previous summary into it. Runs happen on a small thread pool after
+the assistant reply has been saved, never on the request path; /ask then
+sends summary + recent turns instead of the full history.
+"""
+
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_router
+import user_storage as us
+from context_builder import IMAGE_PLACEHOLDER
+
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv('SUMMARY_TRIGGER_MESSAGES', '30'))
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '10'))
+# Re-summarize only after this many further messages left the recent window
+SUMMARY_MIN_NEW = int(os.getenv('SUMMARY_MIN_NEW', '10'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '600'))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL')
+
+SUMMARY_INSTRUCTIONS = (
+    "Du fasst einen Nachhilfe-Chat zwischen einem Schüler und einem KI-Tutor zusammen. "
+    "Schreibe eine kompakte Zusammenfassung auf Deutsch (höchstens 250 Wörter) mit: "
+    "den behandelten Themen und Aufgaben, dem aktuellen Lernstand, offenen Fragen, "
+    "Vereinbarungen und wichtigen Fakten über den Schüler. Keine Begrüßung, keine Einleitung."
+)
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('SUMMARY_WORKERS', '2')), thread_name_prefix='summarizer')
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+
+def _pending_range(message_count, summary):
+    """Message index range [start, end) the next summary should cover, or None."""
+    if message_count <= SUMMARY_TRIGGER_MESSAGES:
+        return None
+    end = message_count - SUMMARY_KEEP_RECENT
+    start = summary['upto_idx'] if summary else 0
+    if end - start < (SUMMARY_MIN_NEW if summary else 1):
+        return None
+    return start, end
+
+
+def _transcript(messages):
+    lines = []
+    for msg in messages:
+        role = msg.get('message_type')
+        if role not in ('user', 'assistant'):
+            continue
+        text = msg.get('content') or ''
+        if msg.get('image_data'):
+            text = f"{IMAGE_PLACEHOLDER} {text}"
+        lines.append(f"{'Schüler' if role == 'user' else 'Tutor'}: {text}")
+    return "\n".join(lines)
+
+
+def _summarize(user_uuid, session_id):
+    summary = us.get_session_summary(user_uuid, session_id)
+    history = us.get_chat_history(user_uuid, session_id, since=summary['upto_idx'] if summary else None)
+    if not history:
+        return
+    message_count = history[-1]['msg_idx'] + 1
+    pending = _pending_range(message_count, summary)
+    if pending is None:
+        return
+    start, end = pending
+    new_messages = [m for m in history if start <= m['msg_idx'] < end]
+
+    prompt = ""
+    if summary:
+        prompt += f"BISHERIGE ZUSAMMENFASSUNG:\n{summary['summary']}\n\n"
+    prompt += f"NEUE NACHRICHTEN:\n{_transcript(new_messages)}\n\nAktualisierte Zusammenfassung:"
+    response = llm_router.complete(
+        [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": prompt},
+        ],
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+    text = (response.choices[0].message.content or '').strip()
+    if text:
+        us.save_session_summary(user_uuid, session_id, text, end)
+        print(f"DEBUG: Session {session_id} summarized up to message {end}")
+
+
+def _run(user_uuid, session_id):
+    try:
+        _summarize(user_uuid, session_id)
+    except Exception as e:
+        print(f"Summarization failed for session {session_id}: {e}")
+        traceback.print_exc()
+    finally:
+        with _inflight_lock:
+            _inflight.discard((user_uuid, session_id))
+
+
+def needs_summary(user_uuid, session_id, message_count):
+    return _pending_range(message_count, us.get_session_summary(user_uuid, session_id)) is not None
+
+
+def schedule(user_uuid, session_id, message_count):
+    """Queue a summary update if the session has grown enough; returns immediately."""
+    if not user_uuid or not needs_summary(user_uuid, session_id, message_count):
+        return False
+    key = (user_uuid, session_id)
+    with _inflight_lock:
+        if key in _inflight:
+            return False
+        _inflight.add(key)
+    _executor.submit(_run, user_uuid, session_id)
+    return True
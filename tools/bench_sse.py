@@ -0,0 +1,148 @@
+"""
+Measure what SSE coalescing (sse.py) saves on the /ask stream.
+
+Starts tools/mock_openai_server.py as the LLM and, for every value of
+--windows, the app with that SSE_COALESCE_MS on the werkzeug server. Each
+/ask answer is read over a raw socket. The script reports per answer:
+- events: the server's writes, since every frame is one write.
+- recv() calls and bytes on the client side. This is what a reverse proxy
+  in front of the app has to read and forward.
+- server CPU time, read from /proc on Linux.
+- client CPU time for reading and splitting the events.
+- time to the first text and to the end of the answer.
+
+Usage: python tools/bench_sse.py [--windows 0,20,40,100] [--requests 5] [--repeat 10] [--token-delay 0.005]
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process, None where /proc is missing."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def ask(port, question):
+    """One /ask request over a raw socket."""
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    sock = socket.create_connection(('127.0.0.1', port))
+    # HTTP/1.0 keeps the body free of chunked encoding
+    sock.sendall(f"GET /ask?question={quote(question)} HTTP/1.0\r\nHost: localhost\r\n\r\n".encode())
+    received = bytearray()
+    recv_calls = 0
+    first_text = None
+    while True:
+        data = sock.recv(65536)
+        recv_calls += 1
+        if not data:
+            break
+        received += data
+        if first_text is None and b'event: text' in received:
+            first_text = time.perf_counter() - started
+    sock.close()
+    body = received.split(b'\r\n\r\n', 1)[1].decode('utf-8')
+    events = [e for e in body.split('\n\n') if e.strip()]
+    return {
+        'events': len(events), 'recv_calls': recv_calls, 'bytes': len(body.encode('utf-8')),
+        'client_cpu_ms': (time.process_time() - cpu_started) * 1000,
+        'first_text_ms': (first_text or 0) * 1000, 'total_ms': (time.perf_counter() - started) * 1000,
+    }
+
+
+def serve(port):
+    """--serve: run the app on port (in the temporary working directory)."""
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import make_server
+    import app
+    make_server('127.0.0.1', port, app.app, threaded=True).serve_forever()
+
+
+def bench(window, llm_port, args, workdir):
+    port = free_port()
+    env = dict(os.environ, SSE_COALESCE_MS=str(window), BASE_URL=f'http://127.0.0.1:{llm_port}/v1',
+               API_KEY='bench', LLM_ENDPOINTS='', USER_STORAGE_FSYNC='off', GC_INTERVAL_HOURS='0')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port)], cwd=workdir,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        ask(port, 'Warm-up')
+        results = []
+        for n in range(args.requests):
+            cpu_before = cpu_seconds(server.pid)
+            result = ask(port, f'Wie addiere ich Brüche? ({n})')
+            cpu_after = cpu_seconds(server.pid)
+            result['server_cpu_ms'] = (cpu_after - cpu_before) * 1000 if cpu_before is not None else float('nan')
+            results.append(result)
+        return {key: statistics.mean(r[key] for r in results) for key in results[0]}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--windows', default='0,20,40,100', help='SSE_COALESCE_MS values to compare')
+    parser.add_argument('--requests', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=10, help='length of the mock answer')
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    llm_port = free_port()
+    llm = subprocess.Popen([sys.executable, os.path.join(ROOT, 'tools', 'mock_openai_server.py'), '--port', str(llm_port),
+                            '--ttft', '0', '--token-delay', str(args.token_delay), '--repeat', str(args.repeat), '--quiet'],
+                           stdout=subprocess.DEVNULL)
+    workdir = tempfile.mkdtemp(prefix='bench_sse_')
+    try:
+        wait_for_port(llm_port)
+        print(f"{'window':>8} {'events':>8} {'recv':>8} {'bytes':>8} {'server cpu':>11} {'client cpu':>11} "
+              f"{'1st text':>9} {'total':>9}")
+        for window in (float(w) for w in args.windows.split(',')):
+            r = bench(window, llm_port, args, workdir)
+            print(f"{window:>6g}ms {r['events']:>8.0f} {r['recv_calls']:>8.0f} {r['bytes']:>8.0f} "
+                  f"{r['server_cpu_ms']:>9.1f}ms {r['client_cpu_ms']:>9.1f}ms {r['first_text_ms']:>7.0f}ms "
+                  f"{r['total_ms']:>7.0f}ms")
+    finally:
+        llm.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare the file and SQLite user_storage backends under concurrent /ask load.
+
+Each simulated request performs the storage calls of one /ask turn: load the
+session history and all prompt context, then save the user and the assistant
+message. Every backend runs in its own subprocess (the backend is chosen at
+import time via USER_STORAGE_BACKEND) against a fresh temp directory.
+
+Usage: python tools/bench_storage_backends.py [--users 30] [--turns 20] [--history 40]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _ask_turn(us, uid, session_id, i):
+    start = time.perf_counter()
+    us.get_chat_history(uid, session_id)
+    us.get_all_previous_chats_summaries(uid, exclude_session_id=session_id)
+    us.get_homework_for_user(uid)
+    us.get_subjects(uid)
+    us.get_memories(uid)
+    us.get_math_solver_status(uid)
+    us.get_session_name(uid, session_id)
+    us.save_chat_message(uid, session_id, 'user', f'Frage {i} ' + 'x' * 300)
+    us.save_chat_message(uid, session_id, 'assistant', f'Antwort {i} ' + 'y' * 1500, chat_subject='Mathematik')
+    return time.perf_counter() - start
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_backend(args):
+    sys.path.insert(0, ROOT)
+    import user_storage as us
+
+    uids = []
+    for u in range(args.users):
+        us.create_user(f'bench_{u}', 'pw', 'student', 'Benchschule')
+        uid = us.get_user_by_username(f'bench_{u}')['uuid']
+        for s in range(5):
+            for m in range(args.history):
+                us.save_chat_message(uid, f'old-{s}', 'user' if m % 2 else 'assistant', 'z' * 800)
+        for h in range(10):
+            us.create_homework(uid, f'Aufgabe {h}', '2030-01-01', '')
+        us.add_memory(uid, 'Mag Mathe')
+        uids.append(uid)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(uid):
+        own = [_ask_turn(us, uid, 'bench-session', i) for i in range(args.turns)]
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(uid,)) for uid in uids]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        'turns_per_s': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p95_ms': _percentile(latencies, 95) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--history', type=int, default=40, help="messages in each of 5 older sessions per user")
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        os.chdir(tempfile.mkdtemp(prefix=f'learn-ai-bench-{args.backend}-'))
+        run_backend(args)
+        return
+
+    print(f"users={args.users} turns/user={args.turns} history={args.history}")
+    for backend in ('files', 'sqlite'):
+        env = dict(os.environ, USER_STORAGE_BACKEND=backend)
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--backend', backend,
+             '--users', str(args.users), '--turns', str(args.turns), '--history', str(args.history)],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{backend:7s}: {result['turns_per_s']:8.1f} turns/s  "
+              f"p50 {result['p50_ms']:6.1f} ms  p95 {result['p95_ms']:6.1f} ms  p99 {result['p99_ms']:6.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Contention benchmark for user_storage locking.
+
+Simulates a classroom: N students save chat messages and toggle homework at the
+same time. Runs once with the per-user lock registry and once with every lock
+collapsed into a single process-wide lock (the old behaviour), and prints the
+throughput of both.
+
+Usage: python tools/bench_storage_locking.py [--users 30] [--ops 50]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import user_storage as us
+
+
+def _setup_users(count):
+    uids = []
+    for i in range(count):
+        username = f"bench_student_{i}"
+        us.create_user(username, 'pw', 'student', 'Benchschule')
+        uid = us.get_user_by_username(username)['uuid']
+        us.create_homework(uid, 'Aufgabe', '2030-01-01', '')
+        uids.append(uid)
+    return uids
+
+
+def _worker(uid, ops, barrier):
+    hw_id = us.get_homework_for_user(uid)[0]['id']
+    barrier.wait()
+    for i in range(ops):
+        us.save_chat_message(uid, 'bench-session', 'user', f'Frage {i} ' + 'x' * 400)
+        us.save_chat_message(uid, 'bench-session', 'assistant', f'Antwort {i} ' + 'y' * 1200)
+        us.toggle_homework_status(hw_id, uid)
+
+
+def _run(uids, ops):
+    barrier = threading.Barrier(len(uids) + 1)
+    threads = [threading.Thread(target=_worker, args=(uid, ops, barrier)) for uid in uids]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total_ops = len(uids) * ops * 3
+    return total_ops / elapsed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--ops', type=int, default=50)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='learn-ai-bench-'))
+    uids = _setup_users(args.users)
+
+    per_user_rate, per_user_time = _run(uids, args.ops)
+
+    global_lock = us._ResourceLock(os.path.join(us.LOCKS_DIR, '_global.lock'))
+    original = us._resource_lock
+    us._resource_lock = lambda owner, resource: global_lock
+    try:
+        global_rate, global_time = _run(uids, args.ops)
+    finally:
+        us._resource_lock = original
+
+    print(f"users={args.users} ops/user={args.ops * 3}")
+    print(f"global lock   : {global_rate:8.1f} ops/s ({global_time:.2f}s)")
+    print(f"per-user locks: {per_user_rate:8.1f} ops/s ({per_user_time:.2f}s)")
+    print(f"speedup       : {per_user_rate / global_rate:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
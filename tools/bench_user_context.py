@@ -0,0 +1,79 @@
+"""
+Time the storage work /ask does before it can call the model.
+
+Compares the former sequence of separate user_storage calls with a single
+load_user_context() for a user with some chat history, homework and
+memories. Runs against a fresh temp directory with the backend selected via
+USER_STORAGE_BACKEND (files by default).
+
+Usage: python tools/bench_user_context.py [--sessions 20] [--history 60] [--rounds 300]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def separate_calls(us, uid, session_id):
+    us.get_session_summary(uid, session_id)
+    us.get_chat_history(uid, session_id)
+    us.get_all_previous_chats_summaries(uid, exclude_session_id=session_id)
+    us.get_homework_for_user(uid)
+    us.get_subjects(uid)
+    us.get_memories(uid)
+    us.get_math_solver_status(uid)
+    us.get_session_name(uid, session_id)
+    us.get_subject_id_by_name(uid, 'Mathematik')
+
+
+def consolidated(us, uid, session_id):
+    ctx = us.load_user_context(uid, session_id)
+    ctx.subject_id_by_name('Mathematik')
+
+
+def measure(fn, us, uid, session_id, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(us, uid, session_id)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--history', type=int, default=60)
+    parser.add_argument('--rounds', type=int, default=300)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench-ctx-'))
+    os.environ.setdefault('USER_STORAGE_FSYNC', 'off')
+    sys.path.insert(0, ROOT)
+    import user_storage as us
+
+    us.create_user('bench', 'pw', 'student', 'Benchschule')
+    uid = us.get_user_by_username('bench')['uuid']
+    for s in range(args.sessions):
+        for m in range(args.history):
+            us.save_chat_message(uid, f's{s}', 'user' if m % 2 == 0 else 'assistant', 'z' * 600, chat_subject='Mathematik')
+    subject_id = us.create_subject(uid, 'Mathematik')
+    for h in range(15):
+        us.create_homework(uid, f'Aufgabe {h}', '2030-01-01', '', subject_id)
+    for m in range(10):
+        us.add_memory(uid, f'Fakt {m}')
+
+    print(f"backend={os.getenv('USER_STORAGE_BACKEND', 'files')} sessions={args.sessions} history={args.history}")
+    for name, fn in (('separate calls', separate_calls), ('load_user_context', consolidated)):
+        mean, p95 = measure(fn, us, uid, 's0', args.rounds)
+        print(f"{name:>18}: mean {mean:7.2f} ms   p95 {p95:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
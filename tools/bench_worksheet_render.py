@@ -0,0 +1,96 @@
+"""
+Compare worksheet PDF rendering: the offline pdf_renderer (in-process and
+through worksheet_renderer's process pool) against the remote md-to-pdf
+service. Renders a typical worksheet --rounds times per engine, plus a burst
+of --concurrency parallel renders, and prints mean / p95 latency. The remote
+engine is skipped with a note when the service cannot be reached.
+
+Usage: python tools/bench_worksheet_render.py [--rounds 30] [--concurrency 8] [--no-remote]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKSHEET = """# Arbeitsblatt: Bruchrechnung
+
+Name: ____________________  Datum: __________
+
+## Aufgabe 1: Addiere die Brüche
+
+Berechne **und kürze** das Ergebnis, wenn möglich. *Tipp:* Finde zuerst den Hauptnenner.
+
+1. 1/2 + 1/4 = ______
+2. 2/3 + 1/6 = ______
+3. 3/5 + 1/10 = ______
+
+## Aufgabe 2: Vergleiche
+
+| Aufgabe | Bruch A | Bruch B | Größer? |
+|---------|---------|---------|---------|
+| a) | 3/4 | 5/8 | |
+| b) | 2/5 | 3/7 | |
+| c) | 7/9 | 11/12 | |
+
+> Merke: Brüche mit gleichem Nenner werden addiert, indem man die Zähler addiert.
+
+```
+1/2 + 1/4 = 2/4 + 1/4 = 3/4
+```
+"""
+
+
+def measure(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(WORKSHEET)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+
+
+def burst(fn, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fn, [WORKSHEET] * concurrency))
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--no-remote', action='store_true')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import pdf_renderer
+    import worksheet_renderer as wr
+
+    engines = [
+        ('local in-process', pdf_renderer.render_markdown),
+        (f'local pool ({wr.WORKSHEET_RENDER_PROCESSES} proc)', wr.render_pdf_local),
+    ]
+    if not args.no_remote:
+        engines.append((f'remote {wr.MD_TO_PDF_URL}', wr.render_pdf_remote))
+
+    wr.render_pdf_local(WORKSHEET)  # start the pool outside the timings
+    for name, fn in engines:
+        try:
+            fn(WORKSHEET)
+        except Exception as e:
+            print(f"{name:>40}: skipped ({e})")
+            continue
+        mean, p95 = measure(fn, args.rounds)
+        total = burst(fn, args.concurrency)
+        print(f"{name:>40}: mean {mean:8.2f} ms   p95 {p95:8.2f} ms   {args.concurrency} parallel {total:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Minimal OpenAI-compatible chat completions server for trying out llm_router
+(failover, TTFT routing, circuit breakers) without a real provider.
+
+Answers POST /v1/chat/completions (streamed or not) with a fixed German text.
+--ttft delays the first token, --token-delay every further chunk,
+--fail-rate answers that share of requests with --fail-status (429 sends a
+Retry-After of --retry-after seconds) and --stall-rate stops streaming after
+the first chunk without closing the connection. --repeat sends the text that
+many times, for answers of realistic length.
+
+Usage: python tools/mock_openai_server.py [--port 8001] [--ttft 0.2] [--token-delay 0.02]
+                                          [--fail-rate 0] [--fail-status 503] [--stall-rate 0]
+                                          [--repeat 1]
+
+Two mocks, the first one slow, behind the router:
+    python tools/mock_openai_server.py --port 8001 --ttft 30 &
+    python tools/mock_openai_server.py --port 8002 &
+    LLM_ENDPOINTS='[{"name": "slow", "base_url": "http://127.0.0.1:8001/v1", "model": "mock", "api_key": "x"},
+                    {"name": "fast", "base_url": "http://127.0.0.1:8002/v1", "model": "mock", "api_key": "x"}]' \\
+        LLM_TTFT_DEADLINE=3 python app.py
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = ("Gute Frage! Lass uns das Schritt für Schritt angehen. Was weißt du schon über Brüche? "
+          "Wenn zwei Brüche den gleichen Nenner haben, kannst du die Zähler einfach addieren.")
+
+
+def _words(text):
+    words = text.split(' ')
+    return [w + (' ' if i < len(words) - 1 else '') for i, w in enumerate(words)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+    def _json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._json(404, {'error': {'message': 'not found'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        opts = self.options
+        if random.random() < opts.fail_rate:
+            headers = {'Retry-After': str(opts.retry_after)} if opts.fail_status == 429 else None
+            self._json(opts.fail_status, {'error': {'message': f'mock failure {opts.fail_status}'}}, headers)
+            return
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get('model', 'mock')
+        answer = ' '.join([ANSWER] * opts.repeat)
+        usage = {'prompt_tokens': 100, 'completion_tokens': len(answer.split()), 'total_tokens': 100 + len(answer.split())}
+        time.sleep(opts.ttft)
+        if not request.get('stream'):
+            self._json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        def send(payload):
+            self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            })
+
+        stall = random.random() < opts.stall_rate
+        try:
+            for n, word in enumerate(_words(answer)):
+                if n:
+                    time.sleep(opts.token_delay)
+                send(chunk({'role': 'assistant', 'content': word} if n == 0 else {'content': word}))
+                if stall:
+                    time.sleep(3600)
+            send(chunk({}, 'stop'))
+            if (request.get('stream_options') or {}).get('include_usage'):
+                send(json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                 'model': model, 'choices': [], 'usage': usage}))
+            send('[DONE]')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=float, default=2)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--quiet', action='store_true')
+    Handler.options = parser.parse_args()
+    server = ThreadingHTTPServer((Handler.options.host, Handler.options.port), Handler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{Handler.options.host}:{Handler.options.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,131 @@
 File-based user data storage module.
 Replaces SQLite for user profiles, conversations, homework, subjects and memories.
 Each user gets a UUID4 folder under users/.
+Chat sessions are stored as a small manifest plus one append-only log per session.
 """
 
 import os
+import re
 import json
+import hashlib
 import uuid
 import shutil
 import threading
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import bcrypt
 
+import blob_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
 USERS_DIR = 'users'
 INDEX_FILE = os.path.join(USERS_DIR, 'index.json')
+SCHOOL_INDEX_FILE = os.path.join(USERS_DIR, 'school_index.json')
+LOCKS_DIR = os.path.join(USERS_DIR, '.locks')
+
+
+# ---------------------------------------------------------------------------
+# Locking
+#
+# Every writer locks only the file(s) it touches, keyed by (owner, resource),
+# e.g. (user_uuid, 'homework') or ('_index', 'index'). A lock is a reentrant
+# thread lock plus an flock on users/.locks/<owner>.<resource>.lock so several
+# gunicorn workers stay consistent. When one call needs several resources it
+# acquires them in this order to avoid deadlocks:
+#   index -> user -> school-index -> sessions -> session-<id> -> subjects -> homework -> memories
+# ---------------------------------------------------------------------------
+
+
+# Resource locks the current thread holds, and the paths it wrote meanwhile
+# that still wait for a group fsync (see _make_durable)
+_held = threading.local()
+
+
+class _ResourceLock:
+    def __init__(self, path):
+        self._path = path
+        self._mutex = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._mutex.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._fd = fd
+            except BaseException:
+                self._mutex.release()
+                raise
+        self._depth += 1
+        _held.count = getattr(_held, 'count', 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._mutex.release()
+        _held.count -= 1
+        if _held.count == 0 and getattr(_held, 'durable', None):
+            # Wait for the fsync only now, so other requests for the same resource need not
+            paths, _held.durable = _held.durable, set()
+            _group_committer.commit(paths)
+        return False
+
+
+_locks_guard = threading.Lock()
+_locks = weakref.WeakValueDictionary()
+
+
+def _resource_lock(owner, resource):
+    key = f"{owner}.{resource}"
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _ResourceLock(os.path.join(LOCKS_DIR, key + '.lock'))
+            _locks[key] = lock
+        return lock
 
-_lock = threading.Lock()
+
+def _index_lock():
+    return _resource_lock('_index', 'index')
+
+
+def _school_index_lock():
+    return _resource_lock('_index', 'school-index')
+
+
+def _user_lock(user_uuid, resource):
+    return _resource_lock(user_uuid, resource)
+
+
+def _session_lock(user_uuid, session_id):
+    safe_id = os.path.basename(_session_log_path(user_uuid, session_id))[:-len('.jsonl')]
+    return _resource_lock(user_uuid, f'session-{safe_id}')
+
+
+def _remove_user_lock_files(user_uuid):
+    try:
+        names = os.listdir(LOCKS_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(f"{user_uuid}."):
+            try:
+                os.remove(os.path.join(LOCKS_DIR, name))
+            except OSError:
+                pass
 
 
 def _ensure_users_dir():
@@ -29,22 +140,300 @@ def get_user_dir(user_uuid):
     return os.path.join(USERS_DIR, user_uuid)
 
 
+# ---------------------------------------------------------------------------
+# Crash-safe file I/O
+#
+# JSON documents are written to a temp file and committed with os.replace, so
+# readers and a restarted worker only ever see the old or the new version.
+# Before each commit the previous version is hard-linked to <file>.bak; if a
+# document turns out unreadable, _load_json restores the last good snapshot
+# instead of silently returning an empty default. Session logs get no
+# snapshot: a rewrite drops old content (inline images, deleted chats) on
+# purpose, and a torn log is repaired by cutting its last line instead.
+#
+# USER_STORAGE_FSYNC controls durability:
+#   always - fsync every write before it is committed
+#   group  - (default) fsync a document's temp file before it is committed;
+#            log appends and directory entries are flushed in rounds that
+#            merge all writes landing within USER_STORAGE_GROUP_COMMIT_MS.
+#            A writer waits for its round after releasing its locks.
+#   off    - never fsync (tests, tmpfs)
+# ---------------------------------------------------------------------------
+
+FSYNC_MODE = os.getenv('USER_STORAGE_FSYNC', 'group').lower()
+GROUP_COMMIT_WINDOW = float(os.getenv('USER_STORAGE_GROUP_COMMIT_MS', '20')) / 1000.0
+
+
+class _GroupCommitter:
+    """Background flusher that merges fsyncs of files written close together."""
+
+    def __init__(self, window):
+        self._window = window
+        self._cond = threading.Condition()
+        self._pending = set()
+        self._done_rounds = 0
+        self._flushing = False
+        self._thread = None
+
+    def commit(self, paths):
+        """Queue paths for fsync and block until a flush round covering them has finished."""
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='user-storage-fsync', daemon=True)
+                self._thread.start()
+            self._pending.update(paths)
+            target = self._done_rounds + (2 if self._flushing else 1)
+            self._cond.notify_all()
+            while self._done_rounds < target:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self._window)
+            with self._cond:
+                batch, self._pending = self._pending, set()
+                self._flushing = True
+            for path in batch:
+                _fsync_path(path)
+            with self._cond:
+                self._flushing = False
+                self._done_rounds += 1
+                self._cond.notify_all()
+
+
+_group_committer = _GroupCommitter(GROUP_COMMIT_WINDOW)
+
+
+def _fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _make_durable(paths):
+    """Flush already written files (and directory entries) according to FSYNC_MODE.
+
+    In group mode a caller holding resource locks waits when it releases the last one.
+    """
+    if FSYNC_MODE == 'group':
+        if getattr(_held, 'count', 0):
+            if not getattr(_held, 'durable', None):
+                _held.durable = set()
+            _held.durable.update(paths)
+        else:
+            _group_committer.commit(paths)
+    elif FSYNC_MODE == 'always':
+        for path in paths:
+            _fsync_path(path)
+
+
+def _atomic_write_bytes(path, payload, backup=True):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        # Before the rename, so a committed name never points to data still in the page cache
+        if FSYNC_MODE in ('always', 'group'):
+            os.fsync(f.fileno())
+    if backup and os.path.exists(path):
+        bak_tmp = tmp_path + '.bak'
+        try:
+            os.link(path, bak_tmp)
+            os.replace(bak_tmp, path + '.bak')
+        except OSError:
+            try:
+                shutil.copyfile(path, path + '.bak')
+            except OSError:
+                pass
+    os.replace(tmp_path, path)
+    if FSYNC_MODE == 'group':
+        _make_durable([directory])
+    elif FSYNC_MODE == 'always':
+        _fsync_path(directory)
+
+
+def _recover_from_backup(path, default):
+    """Restore <path> from its .bak snapshot. Returns the recovered data or default."""
+    backup_path = path + '.bak'
+    data = None
+    try:
+        with open(backup_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if os.path.exists(path):
+        # Keep the damaged file for manual inspection instead of overwriting it
+        corrupt_path = f"{path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        try:
+            os.replace(path, corrupt_path)
+            print(f"[user_storage] Unreadable file moved to {corrupt_path}")
+        except OSError:
+            pass
+
+    if data is None:
+        return default
+    with open(backup_path, 'rb') as f:
+        _atomic_write_bytes(path, f.read())
+    print(f"[user_storage] Restored {path} from last good snapshot.")
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Parsed document cache
+#
+# Parsed JSON documents and replayed session logs are kept in a size-bounded
+# LRU keyed by path. Every lookup stats the file and compares inode, size and
+# mtime, so writes from other gunicorn workers invalidate the entry. Session
+# logs are append-only: when only their size grew, just the new tail is parsed.
+# Callers always get their own copy, so mutating a result never touches the
+# cache.
+# ---------------------------------------------------------------------------
+
+CACHE_MAX_BYTES = int(float(os.getenv('USER_STORAGE_CACHE_MB', '64')) * 1024 * 1024)
+
+
+def _clone(obj):
+    if isinstance(obj, dict):
+        return {k: _clone(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_clone(v) for v in obj]
+    return obj
+
+
+class _DocumentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (signature, size, value, extra)
+        self._bytes = 0
+        self._guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tail_reads = 0
+        self.evictions = 0
+
+    def get(self, path):
+        with self._guard:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            return entry
+
+    def put(self, path, signature, size, value, extra=None):
+        if size > self.max_bytes:
+            self.discard(path)
+            return
+        with self._guard:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[path] = (signature, size, value, extra)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[1]
+                self.evictions += 1
+
+    def count(self, counter):
+        with self._guard:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def discard(self, path):
+        with self._guard:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._guard:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._guard:
+            lookups = self.hits + self.misses + self.tail_reads
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'tail_reads': self.tail_reads,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_doc_cache = _DocumentCache(CACHE_MAX_BYTES)
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def get_cache_stats():
+    """Return hit/miss counters and size of the parsed document cache."""
+    return _doc_cache.stats()
+
+
 def _load_json(path, default=None):
     if default is None:
         default = {}
-    if os.path.exists(path):
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, OSError):
-            return default
-    return default
+    signature = _file_signature(path)
+    if signature is not None:
+        entry = _doc_cache.get(path)
+        if entry is not None and entry[0] == signature:
+            _doc_cache.count('hits')
+            return _clone(entry[2])
+    _doc_cache.count('misses')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        _doc_cache.discard(path)
+        if os.path.exists(path + '.bak'):
+            return _recover_from_backup(path, default)
+        return default
+    except (ValueError, OSError):
+        _doc_cache.discard(path)
+        return _recover_from_backup(path, default)
+    if signature is not None:
+        _doc_cache.put(path, signature, signature[1], _clone(data))
+    return data
 
 
 def _save_json(path, data):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    _atomic_write_bytes(path, payload)
+    signature = _file_signature(path)
+    if signature is not None:
+        _doc_cache.put(path, signature, signature[1], _clone(data))
+
+
+def _remove_json(path):
+    """Delete a document together with its .bak snapshot so it is not restored."""
+    _doc_cache.discard(path)
+    for p in (path, path + '.bak'):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
 
 
 def _load_index():
@@ -69,24 +458,22 @@ def hash_pw(password):
 
 def create_user(username, password, user_type, school=None):
     """Create a new user. Returns True on success, False if username taken or IT-admin conflict."""
-    with _lock:
+    # bcrypt is slow on purpose; hash before taking the index lock
+    hashed_pw = hash_pw(password).decode('utf-8')
+    with _index_lock():
         index = _load_index()
         if username in index:
             return False
 
         if user_type == 'it-admin' and school:
             # Only one IT-admin per school
-            for uid in index.values():
-                u = _load_user(uid)
-                if u and u.get('user_type') == 'it-admin' and u.get('school') == school:
-                    return False
+            if _users_for_school(school, 'it-admin'):
+                return False
 
         user_uuid = str(uuid.uuid4())
         user_dir = get_user_dir(user_uuid)
         os.makedirs(user_dir, exist_ok=True)
 
-        hashed_pw = hash_pw(password).decode('utf-8')
-
         now = datetime.now().isoformat()
         user_data = {
             'uuid': user_uuid,
@@ -100,11 +487,16 @@ def create_user(username, password, user_type, school=None):
             'created_at': now,
         }
         _save_json(os.path.join(user_dir, 'user.json'), user_data)
-        _save_json(os.path.join(user_dir, 'conversations.json'), [])
+        _save_json(os.path.join(user_dir, 'sessions.json'), [])
         _save_json(os.path.join(user_dir, 'homework.json'), [])
         _save_json(os.path.join(user_dir, 'subjects.json'), [])
         _save_json(os.path.join(user_dir, 'memories.json'), [])
 
+        with _school_index_lock():
+            school_index = _load_school_index()
+            _school_index_add(school_index, user_data)
+            _save_json(SCHOOL_INDEX_FILE, school_index)
+
         index[username] = user_uuid
         _save_index(index)
         return True
@@ -112,7 +504,8 @@ def create_user(username, password, user_type, school=None):
 
 def _load_user(user_uuid):
     path = os.path.join(get_user_dir(user_uuid), 'user.json')
-    return _load_json(path, None)
+    # _load_json turns a None default into {}; an unknown user is None
+    return _load_json(path, None) or None
 
 
 def _save_user(user_uuid, data):
@@ -146,12 +539,25 @@ def get_user_by_username(username):
 
 
 def _update_user_field(user_uuid, **kwargs):
-    with _lock:
+    with _user_lock(user_uuid, 'user'):
         user = _load_user(user_uuid)
-        if user is None:
+        if not user:
             return False
+        old_user = dict(user)
         user.update(kwargs)
-        _save_user(user_uuid, user)
+        if not any(old_user.get(k) != user.get(k) for k in _SCHOOL_INDEX_FIELDS):
+            _save_user(user_uuid, user)
+            return True
+        # Add the new membership before the user file changes and drop the old
+        # one afterwards, so a crash in between never hides the user.
+        with _school_index_lock():
+            school_index = _load_school_index()
+            _school_index_add(school_index, user)
+            _save_json(SCHOOL_INDEX_FILE, school_index)
+            _save_user(user_uuid, user)
+            _school_index_remove(school_index, old_user)
+            _school_index_add(school_index, user)
+            _save_json(SCHOOL_INDEX_FILE, school_index)
         return True
 
 
@@ -178,16 +584,16 @@ def get_all_users():
 
 
 def get_teachers_for_school(school):
-    return [u for u in get_all_users() if u.get('user_type') == 'teacher' and u.get('school') == school]
+    return _users_for_school(school, 'teacher')
 
 
 def get_students_for_school(school):
-    return [u for u in get_all_users() if u.get('user_type') == 'student' and u.get('school') == school]
+    return _users_for_school(school, 'student')
 
 
 def get_unique_school_names():
-    schools = {u.get('school') for u in get_all_users() if u.get('school')}
-    return sorted(schools)
+    schools = _load_school_index().get('schools', {})
+    return sorted(name for name, entry in schools.items() if any(entry.get('roles', {}).values()))
 
 
 def get_student_usernames_for_school(school):
@@ -195,8 +601,8 @@ def get_student_usernames_for_school(school):
 
 
 def get_unique_class_names_for_school(school):
-    classes = {u.get('class_name') for u in get_all_users() if u.get('school') == school and u.get('class_name')}
-    return sorted(classes)
+    classes = _load_school_index().get('schools', {}).get(school, {}).get('classes', {})
+    return sorted(name for name, roles in classes.items() if any(roles.values()))
 
 
 def get_teacher_usernames_for_school(school):
@@ -205,7 +611,7 @@ def get_teacher_usernames_for_school(school):
 
 def delete_user(user_uuid):
     """Delete user folder and remove from index."""
-    with _lock:
+    with _index_lock(), _user_lock(user_uuid, 'user'):
         user = _load_user(user_uuid)
         if not user:
             return False
@@ -216,7 +622,89 @@ def delete_user(user_uuid):
         index = _load_index()
         index.pop(username, None)
         _save_index(index)
-        return True
+        with _school_index_lock():
+            school_index = _load_school_index()
+            _school_index_remove(school_index, user)
+            _save_json(SCHOOL_INDEX_FILE, school_index)
+    _remove_user_lock_files(user_uuid)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Secondary indexes
+#
+# users/school_index.json maps school -> role -> user UUIDs and
+# school -> class -> role -> user UUIDs, so admin pages don't have to open
+# every user.json. It is maintained by create_user, _update_user_field and
+# delete_user; lookups re-check each user file and skip stale entries.
+# rebuild_school_index() recreates it from disk (storage_tool.py rebuild-indexes).
+# ---------------------------------------------------------------------------
+
+_SCHOOL_INDEX_FIELDS = ('school', 'class_name', 'user_type')
+
+
+def _school_index_add(school_index, user):
+    school, role, uid = user.get('school'), user.get('user_type'), user.get('uuid')
+    if not school or not role or not uid:
+        return
+    entry = school_index.setdefault('schools', {}).setdefault(school, {'roles': {}, 'classes': {}})
+    members = entry['roles'].setdefault(role, [])
+    if uid not in members:
+        members.append(uid)
+    class_name = user.get('class_name')
+    if class_name:
+        members = entry['classes'].setdefault(class_name, {}).setdefault(role, [])
+        if uid not in members:
+            members.append(uid)
+
+
+def _school_index_remove(school_index, user):
+    school, role, uid = user.get('school'), user.get('user_type'), user.get('uuid')
+    entry = school_index.get('schools', {}).get(school)
+    if not entry:
+        return
+    if uid in entry['roles'].get(role, []):
+        entry['roles'][role].remove(uid)
+    class_roles = entry['classes'].get(user.get('class_name'), {})
+    if uid in class_roles.get(role, []):
+        class_roles[role].remove(uid)
+        if not any(class_roles.values()):
+            entry['classes'].pop(user.get('class_name'), None)
+    if not any(entry['roles'].values()):
+        school_index['schools'].pop(school, None)
+
+
+def _load_school_index():
+    if not os.path.exists(SCHOOL_INDEX_FILE):
+        return rebuild_school_index()
+    return _load_json(SCHOOL_INDEX_FILE, {'schools': {}})
+
+
+def rebuild_school_index():
+    """Recreate users/school_index.json by scanning every user.json. Returns the new index."""
+    with _school_index_lock():
+        school_index = {'schools': {}}
+        for uid in _load_index().values():
+            user = _load_user(uid)
+            if user:
+                _school_index_add(school_index, user)
+        _save_json(SCHOOL_INDEX_FILE, school_index)
+        return school_index
+
+
+def _users_for_school(school, role, class_name=None):
+    entry = _load_school_index().get('schools', {}).get(school, {})
+    if class_name is None:
+        uids = entry.get('roles', {}).get(role, [])
+    else:
+        uids = entry.get('classes', {}).get(class_name, {}).get(role, [])
+    users = []
+    for uid in uids:
+        u = _load_user(uid)
+        if (u and u.get('user_type') == role and u.get('school') == school
+                and (class_name is None or u.get('class_name') == class_name)):
+            users.append(u)
+    return users
 
 
 # ---------------------------------------------------------------------------
@@ -243,78 +731,416 @@ def set_first_login_status(user_uuid, status):
 
 # ---------------------------------------------------------------------------
 # Conversations (OpenAI-like format)
+#
+# Layout per user:
+#   sessions.json              small manifest, one entry per chat session
+#   sessions/<session_id>.jsonl append-only message log for one session
+#
+# Each log line is either {"op": "append", "message": {...}} or
+# {"op": "update", "idx": n, "fields": {...}}. Replaying the log in order
+# yields the session's messages, so saving a message or attaching a
+# worksheet only appends one line instead of rewriting the user's history.
 # ---------------------------------------------------------------------------
 
-def _load_conversations(user_uuid):
+_SAFE_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+
+def _manifest_path(user_uuid):
+    return os.path.join(get_user_dir(user_uuid), 'sessions.json')
+
+
+def _legacy_conversations_path(user_uuid):
+    return os.path.join(get_user_dir(user_uuid), 'conversations.json')
+
+
+def _session_log_path(user_uuid, session_id):
+    session_id = str(session_id)
+    if not _SAFE_SESSION_ID.match(session_id):
+        session_id = hashlib.sha1(session_id.encode('utf-8')).hexdigest()
+    return os.path.join(get_user_dir(user_uuid), 'sessions', f'{session_id}.jsonl')
+
+
+def _session_summary_path(user_uuid, session_id):
+    return _session_log_path(user_uuid, session_id)[:-len('.jsonl')] + '.summary.json'
+
+
+def _append_log_records(user_uuid, session_id, records):
+    path = _session_log_path(user_uuid, session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records).encode('utf-8')
+    with open(path, 'ab+') as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                # Terminate a torn line left by an interrupted append
+                payload = b'\n' + payload
+        f.write(payload)
+        f.flush()
+        if FSYNC_MODE == 'always':
+            os.fsync(f.fileno())
+    if FSYNC_MODE == 'group':
+        _make_durable([path])
+
+
+def _iter_log_records(user_uuid, session_id):
+    path = _session_log_path(user_uuid, session_id)
+    try:
+        f = open(path, 'r', encoding='utf-8')
+    except OSError:
+        return
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn trailing line from an interrupted append
+                continue
+
+
+def _replay_messages(records, messages=None):
+    messages = [] if messages is None else messages
+    for rec in records:
+        op = rec.get('op')
+        if op == 'append':
+            messages.append(rec.get('message', {}))
+        elif op == 'update':
+            idx = rec.get('idx', -1)
+            if 0 <= idx < len(messages):
+                messages[idx].update(rec.get('fields', {}))
+    return messages
+
+
+def _parse_log_lines(data):
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def _load_session_messages(user_uuid, session_id):
+    path = _session_log_path(user_uuid, session_id)
+    signature = _file_signature(path)
+    if signature is None:
+        _doc_cache.discard(path)
+        return []
+
+    entry = _doc_cache.get(path)
+    if entry is not None and entry[0] == signature:
+        _doc_cache.count('hits')
+        return _clone(entry[2])
+
+    if entry is not None and entry[0][0] == signature[0] and entry[3] <= signature[1]:
+        # Same file, only grown: replay just the appended tail
+        _doc_cache.count('tail_reads')
+        messages, offset = _clone(entry[2]), entry[3]
+    else:
+        _doc_cache.count('misses')
+        messages, offset = [], 0
+
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        _doc_cache.discard(path)
+        return []
+    complete = data[:data.rfind(b'\n') + 1]
+    _replay_messages(_parse_log_lines(complete.decode('utf-8', errors='replace')), messages)
+    _doc_cache.put(path, signature, signature[1], messages, offset + len(complete))
+    return _clone(messages)
+
+
+def _write_session_log(user_uuid, session_id, messages):
+    """Rewrite a session log from scratch (used by imports/migrations only)."""
+    payload = ''.join(
+        json.dumps({'op': 'append', 'message': m}, ensure_ascii=False) + '\n' for m in messages
+    )
+    path = _session_log_path(user_uuid, session_id)
+    _atomic_write_bytes(path, payload.encode('utf-8'), backup=False)
+    try:
+        # Left by earlier versions, which snapshotted logs too
+        os.remove(path + '.bak')
+    except OSError:
+        pass
+
+
+def _import_conversations(user_uuid, conversations):
+    """Write a list of legacy-format sessions (with inline messages) as manifest + logs."""
+    manifest = []
+    for s in conversations:
+        msgs = s.get('messages', [])
+        _write_session_log(user_uuid, s['id'], msgs)
+        manifest.append({
+            'id': s['id'],
+            'name': s.get('name', 'Neuer Chat'),
+            'subject': s.get('subject'),
+            'created_at': s.get('created_at', ''),
+            'updated_at': s.get('updated_at', s.get('created_at', '')),
+            'message_count': len(msgs),
+            'first_message_at': msgs[0].get('created_at') if msgs else None,
+            'last_message_at': msgs[-1].get('created_at') if msgs else None,
+            'preview': _build_preview(msgs),
+        })
+    _save_json(_manifest_path(user_uuid), manifest)
+    return manifest
+
+
+def _migrate_legacy_conversations(user_uuid):
+    """Convert an old conversations.json into the manifest + log layout."""
+    with _user_lock(user_uuid, 'sessions'):
+        if os.path.exists(_manifest_path(user_uuid)):
+            return _load_json(_manifest_path(user_uuid), [])
+        legacy_path = _legacy_conversations_path(user_uuid)
+        manifest = _import_conversations(user_uuid, _load_json(legacy_path, []))
+        os.replace(legacy_path, legacy_path + '.migrated')
+        return manifest
+
+
+def _ensure_manifest(user_uuid):
+    """Migrate legacy data now, before a session-<id> lock is taken.
+
+    The migration takes the 'sessions' lock, which must never be acquired
+    while holding a session lock (lock order: sessions, then session-<id>).
+    """
+    if not os.path.exists(_manifest_path(user_uuid)) and os.path.exists(_legacy_conversations_path(user_uuid)):
+        _migrate_legacy_conversations(user_uuid)
+
+
+def _load_manifest(user_uuid):
     if not user_uuid:
         return []
-    path = os.path.join(get_user_dir(user_uuid), 'conversations.json')
+    path = _manifest_path(user_uuid)
+    if not os.path.exists(path) and os.path.exists(_legacy_conversations_path(user_uuid)):
+        return _migrate_legacy_conversations(user_uuid)
     return _load_json(path, [])
 
 
-def _save_conversations(user_uuid, conversations):
+def _save_manifest(user_uuid, manifest):
     if not user_uuid:
         return
-    path = os.path.join(get_user_dir(user_uuid), 'conversations.json')
-    _save_json(path, conversations)
+    _save_json(_manifest_path(user_uuid), manifest)
 
 
-def _find_session(conversations, session_id):
-    for s in conversations:
+# Each manifest entry keeps the first few user/assistant messages (shortened)
+# as 'preview', the input for the cross-chat digest
+_PREVIEW_MESSAGES = 5
+_PREVIEW_CHARS = 100
+
+
+def _preview_item(msg):
+    return {'role': msg.get('role'), 'content': (msg.get('content') or '')[:_PREVIEW_CHARS]}
+
+
+def _build_preview(messages):
+    items = [_preview_item(m) for m in messages if m.get('role') in ('user', 'assistant')]
+    return items[:_PREVIEW_MESSAGES]
+
+
+def _add_to_preview(session, msg):
+    preview = session.get('preview')
+    if preview is not None and len(preview) < _PREVIEW_MESSAGES and msg.get('role') in ('user', 'assistant'):
+        preview.append(_preview_item(msg))
+
+
+def _needs_backfill(s):
+    return 'last_message_at' not in s or 'preview' not in s
+
+
+def _backfill_listing_fields(user_uuid):
+    """Add timestamps and previews to manifest entries written before they were tracked."""
+    with _user_lock(user_uuid, 'sessions'):
+        manifest = _load_manifest(user_uuid)
+        changed = False
+        for s in manifest:
+            if not _needs_backfill(s):
+                continue
+            first_ts = last_ts = None
+            appended = []
+            for rec in _iter_log_records(user_uuid, s['id']):
+                if rec.get('op') == 'append':
+                    msg = rec.get('message', {})
+                    if first_ts is None:
+                        first_ts = msg.get('created_at')
+                    last_ts = msg.get('created_at')
+                    if len(appended) < _PREVIEW_MESSAGES and msg.get('role') in ('user', 'assistant'):
+                        appended.append(msg)
+            s['first_message_at'] = first_ts
+            s['last_message_at'] = last_ts
+            s['preview'] = _build_preview(appended)
+            changed = True
+        if changed:
+            _save_manifest(user_uuid, manifest)
+        return manifest
+
+
+def _load_listing_manifest(user_uuid):
+    manifest = _load_manifest(user_uuid)
+    if any(_needs_backfill(s) for s in manifest):
+        manifest = _backfill_listing_fields(user_uuid)
+    return manifest
+
+
+def _find_session(manifest, session_id):
+    for s in manifest:
         if s.get('id') == session_id:
             return s
     return None
 
 
-def get_user_chat_sessions(user_uuid):
-    if not user_uuid:
-        return []
-    conversations = _load_conversations(user_uuid)
-    sessions = []
-    for s in conversations:
-        msgs = s.get('messages', [])
-        sessions.append({
-            'session_id': s['id'],
-            'session_name': s.get('name', 'Neuer Chat'),
-            'first_message': msgs[0]['created_at'] if msgs else s.get('created_at', ''),
-            'last_message': msgs[-1]['created_at'] if msgs else s.get('created_at', ''),
-            'chat_subject': s.get('subject'),
-        })
+_MANIFEST_ONLY_FIELDS = ('message_count', 'first_message_at', 'last_message_at', 'preview', 'blobs', 'log_bytes')
+
+
+def _log_size(user_uuid, session_id):
+    try:
+        return os.path.getsize(_session_log_path(user_uuid, session_id))
+    except OSError:
+        return 0
+
+
+def _reconcile_message_count(user_uuid, session):
+    """Bring session['message_count'] in line with the log; call with the session lock held.
+
+    The log append and the manifest write are two steps, so a crash between
+    them leaves the count behind the log. 'log_bytes' is the log size as of
+    the last manifest write; the log is only counted when its size differs.
+    """
+    if session.get('log_bytes') == _log_size(user_uuid, session['id']):
+        return
+    count = len(_load_session_messages(user_uuid, session['id']))
+    if count != session.get('message_count', 0):
+        print(f"[user_storage] message_count of session {session['id']} was {session.get('message_count', 0)}, "
+              f"its log holds {count} message(s).")
+        session['message_count'] = count
+
+
+def _load_conversations(user_uuid):
+    """Rebuild the full legacy conversations list (export only)."""
+    conversations = []
+    for entry in _load_manifest(user_uuid):
+        s = {k: v for k, v in entry.items() if k not in _MANIFEST_ONLY_FIELDS}
+        s['messages'] = _load_session_messages(user_uuid, entry['id'])
+        conversations.append(s)
+    return conversations
+
+
+def _session_listing_entry(s):
+    return {
+        'session_id': s['id'],
+        'session_name': s.get('name', 'Neuer Chat'),
+        'first_message': s.get('first_message_at') or s.get('created_at', ''),
+        'last_message': s.get('last_message_at') or s.get('created_at', ''),
+        'chat_subject': s.get('subject'),
+    }
+
+
+def _list_sessions(user_uuid, subject=None):
+    """Sidebar listing built from the manifest alone; message logs are not read."""
+    sessions = [
+        _session_listing_entry(s)
+        for s in _load_listing_manifest(user_uuid)
+        if subject is None or s.get('subject') == subject
+    ]
     sessions.sort(key=lambda x: x['last_message'] or '', reverse=True)
     return sessions
 
 
-def get_chat_history(user_uuid, session_id):
+def get_user_chat_sessions(user_uuid):
     if not user_uuid:
         return []
-    conversations = _load_conversations(user_uuid)
-    session = _find_session(conversations, session_id)
+    return _list_sessions(user_uuid)
+
+
+def _parse_since(since):
+    """Split a 'since' cursor into (msg_idx, timestamp); one of them is None.
+
+    An integer (or digit string) selects messages from that index on, anything
+    else is an updated_at timestamp selecting messages added or changed after it.
+    """
+    if since is None or since == '':
+        return None, None
+    if isinstance(since, int) or (isinstance(since, str) and since.isdigit()):
+        return int(since), None
+    return None, str(since)
+
+
+def _history_entry(idx, m, subject):
+    return {
+        'msg_idx': idx,
+        'message_type': m['role'],
+        'content': m['content'],
+        'image_data': blob_store.to_public_urls(m.get('image_data')),
+        'worksheet_filename': m.get('worksheet_filename'),
+        'homework_id': m.get('homework_id'),
+        'created_at': m.get('created_at'),
+        'updated_at': m.get('updated_at') or m.get('created_at'),
+        'chat_subject': subject,
+    }
+
+
+def get_chat_history_page(user_uuid, session_id, limit=None, before=None, since=None):
+    """Return part of a session's history plus paging information.
+
+    before=<msg_idx> pages backwards, limit keeps only the newest N of the
+    selection, since=<msg_idx or updated_at> returns only new or changed
+    messages. The result is {'messages', 'has_more', 'cursor'}: has_more tells
+    whether older messages exist before the page, cursor is the newest
+    updated_at of the session to pass as 'since' on the next poll.
+    """
+    if not user_uuid:
+        return {'messages': [], 'has_more': False, 'cursor': None}
+    return _session_history_page(user_uuid, _find_session(_load_manifest(user_uuid), session_id), limit, before, since)
+
+
+def _session_history_page(user_uuid, session, limit=None, before=None, since=None):
+    page = {'messages': [], 'has_more': False, 'cursor': None}
     if not session:
-        return []
-    return [
-        {
-            'message_type': m['role'],
-            'content': m['content'],
-            'image_data': m.get('image_data'),
-            'worksheet_filename': m.get('worksheet_filename'),
-            'homework_id': m.get('homework_id'),
-            'created_at': m.get('created_at'),
-            'chat_subject': session.get('subject'),
-        }
-        for m in session.get('messages', [])
-    ]
+        return page
+    messages = _load_session_messages(user_uuid, session['id'])
+    since_idx, since_ts = _parse_since(since)
+    selected = []
+    for idx, m in enumerate(messages):
+        updated_at = m.get('updated_at') or m.get('created_at') or ''
+        if page['cursor'] is None or updated_at > page['cursor']:
+            page['cursor'] = updated_at
+        if before is not None and idx >= before:
+            continue
+        if since_idx is not None and idx < since_idx:
+            continue
+        if since_ts is not None and updated_at <= since_ts:
+            continue
+        selected.append((idx, m))
+    if limit is not None and limit >= 0:
+        selected = selected[-limit:] if limit else []
+    page['messages'] = [_history_entry(idx, m, session.get('subject')) for idx, m in selected]
+    if selected:
+        page['has_more'] = selected[0][0] > 0
+    return page
+
+
+def get_chat_history(user_uuid, session_id, limit=None, before=None, since=None):
+    return get_chat_history_page(user_uuid, session_id, limit=limit, before=before, since=since)['messages']
 
 
 def save_chat_message(user_uuid, session_id, message_type, content,
                       image_data=None, worksheet_filename=None, homework_id=None,
                       chat_subject=None, session_name=None):
     """Save a chat message. Returns message index within session (for worksheet updates)."""
-    # image_data can be a string (data URL) or a list of strings
+    # image_data can be a string (data URL) or a list of strings; inline
+    # images are moved to the blob store and only references are kept
     if not user_uuid:
         return None
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        session = _find_session(conversations, session_id)
+    if image_data:
+        image_data = blob_store.externalize_images(image_data)
+    with _user_lock(user_uuid, 'sessions'), _session_lock(user_uuid, session_id):
+        manifest = _load_manifest(user_uuid)
+        session = _find_session(manifest, session_id)
         now = datetime.now().isoformat()
 
         if session is None:
@@ -324,9 +1150,13 @@ def save_chat_message(user_uuid, session_id, message_type, content,
                 'subject': chat_subject,
                 'created_at': now,
                 'updated_at': now,
-                'messages': [],
+                'message_count': 0,
+                'first_message_at': now,
+                'last_message_at': now,
+                'preview': [],
+                'blobs': [],
             }
-            conversations.insert(0, session)
+            manifest.insert(0, session)
         else:
             if session_name and session.get('name') in (None, 'Neuer Chat', ''):
                 session['name'] = session_name
@@ -346,57 +1176,71 @@ def save_chat_message(user_uuid, session_id, message_type, content,
         if homework_id:
             msg['homework_id'] = homework_id
 
-        session['messages'].append(msg)
-        msg_idx = len(session['messages']) - 1
-        _save_conversations(user_uuid, conversations)
+        _reconcile_message_count(user_uuid, session)
+        msg_idx = session.get('message_count', 0)
+        _append_log_records(user_uuid, session_id, [{'op': 'append', 'message': msg}])
+        session['message_count'] = msg_idx + 1
+        session['log_bytes'] = _log_size(user_uuid, session_id)
+        if not session.get('first_message_at'):
+            session['first_message_at'] = now
+        session['last_message_at'] = now
+        _add_to_preview(session, msg)
+        if image_data and 'blobs' in session:
+            session['blobs'] = sorted(set(session['blobs']) | blob_store.hashes_in(image_data))
+        _save_manifest(user_uuid, manifest)
         return msg_idx
 
 
-def update_chat_message_worksheet(user_uuid, session_id, msg_idx, worksheet_filename):
+def _update_chat_message_fields(user_uuid, session_id, msg_idx, **fields):
     if not user_uuid:
         return False
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        session = _find_session(conversations, session_id)
-        if session and 0 <= msg_idx < len(session['messages']):
-            session['messages'][msg_idx]['worksheet_filename'] = worksheet_filename
-            _save_conversations(user_uuid, conversations)
+    fields['updated_at'] = datetime.now().isoformat()
+    _ensure_manifest(user_uuid)
+    with _session_lock(user_uuid, session_id):
+        session = _find_session(_load_manifest(user_uuid), session_id)
+        if session:
+            _reconcile_message_count(user_uuid, session)
+        if session and 0 <= msg_idx < session.get('message_count', 0):
+            _append_log_records(user_uuid, session_id, [{'op': 'update', 'idx': msg_idx, 'fields': fields}])
             return True
     return False
 
 
+def update_chat_message_worksheet(user_uuid, session_id, msg_idx, worksheet_filename):
+    return _update_chat_message_fields(user_uuid, session_id, msg_idx, worksheet_filename=worksheet_filename)
+
+
 def update_chat_message_homework(user_uuid, session_id, msg_idx, homework_id):
-    if not user_uuid:
-        return False
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        session = _find_session(conversations, session_id)
-        if session and 0 <= msg_idx < len(session['messages']):
-            session['messages'][msg_idx]['homework_id'] = homework_id
-            _save_conversations(user_uuid, conversations)
-            return True
-    return False
+    return _update_chat_message_fields(user_uuid, session_id, msg_idx, homework_id=homework_id)
 
 
 def delete_chat_session(user_uuid, session_id):
     if not user_uuid:
         return False
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        conversations = [s for s in conversations if s.get('id') != session_id]
-        _save_conversations(user_uuid, conversations)
+    with _user_lock(user_uuid, 'sessions'), _session_lock(user_uuid, session_id):
+        manifest = _load_manifest(user_uuid)
+        remaining = [s for s in manifest if s.get('id') != session_id]
+        if len(remaining) != len(manifest):
+            _save_manifest(user_uuid, remaining)
+        log_path = _session_log_path(user_uuid, session_id)
+        for p in (log_path, log_path + '.bak'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        _remove_json(_session_summary_path(user_uuid, session_id))
     return True
 
 
 def rename_chat_session(user_uuid, session_id, new_name):
     if not user_uuid:
         return False
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        session = _find_session(conversations, session_id)
+    with _user_lock(user_uuid, 'sessions'):
+        manifest = _load_manifest(user_uuid)
+        session = _find_session(manifest, session_id)
         if session:
             session['name'] = new_name
-            _save_conversations(user_uuid, conversations)
+            _save_manifest(user_uuid, manifest)
             return True
     return False
 
@@ -404,72 +1248,95 @@ def rename_chat_session(user_uuid, session_id, new_name):
 def get_session_name(user_uuid, session_id):
     if not user_uuid:
         return None
-    conversations = _load_conversations(user_uuid)
-    session = _find_session(conversations, session_id)
+    session = _find_session(_load_manifest(user_uuid), session_id)
     return session.get('name') if session else None
 
 
 def update_chat_session_subject(user_uuid, session_id, subject):
     if not user_uuid:
         return False
-    with _lock:
-        conversations = _load_conversations(user_uuid)
-        session = _find_session(conversations, session_id)
+    with _user_lock(user_uuid, 'sessions'):
+        manifest = _load_manifest(user_uuid)
+        session = _find_session(manifest, session_id)
         if session:
             session['subject'] = subject
-            _save_conversations(user_uuid, conversations)
+            _save_manifest(user_uuid, manifest)
             return True
     return False
 
 
+def get_session_summary(user_uuid, session_id):
+    """Running summary of a session's older messages, or None.
+
+    Returns {'summary': text, 'upto_idx': n, 'updated_at': ts}; the summary
+    covers the messages with msg_idx < n.
+    """
+    if not user_uuid:
+        return None
+    summary = _load_json(_session_summary_path(user_uuid, session_id), {})
+    return summary if summary.get('summary') else None
+
+
+def save_session_summary(user_uuid, session_id, summary, upto_idx):
+    if not user_uuid:
+        return False
+    _ensure_manifest(user_uuid)
+    with _session_lock(user_uuid, session_id):
+        if not _find_session(_load_manifest(user_uuid), session_id):
+            return False
+        current = _load_json(_session_summary_path(user_uuid, session_id), {})
+        # A slower, older summarization run must not overwrite a newer one
+        if current.get('upto_idx', 0) > upto_idx:
+            return False
+        _save_json(_session_summary_path(user_uuid, session_id), {
+            'summary': summary,
+            'upto_idx': upto_idx,
+            'updated_at': datetime.now().isoformat(),
+        })
+    return True
+
+
 def get_unique_chat_subjects(user_uuid):
     if not user_uuid:
         return []
-    conversations = _load_conversations(user_uuid)
-    subjects = sorted({s.get('subject') for s in conversations if s.get('subject')})
-    return subjects
+    return sorted({s.get('subject') for s in _load_manifest(user_uuid) if s.get('subject')})
 
 
 def get_chat_sessions_by_subject(user_uuid, subject):
     if not user_uuid:
         return []
-    conversations = _load_conversations(user_uuid)
-    sessions = []
-    for s in conversations:
-        if s.get('subject') == subject:
-            msgs = s.get('messages', [])
-            sessions.append({
-                'session_id': s['id'],
-                'session_name': s.get('name', 'Neuer Chat'),
-                'first_message': msgs[0]['created_at'] if msgs else s.get('created_at', ''),
-                'last_message': msgs[-1]['created_at'] if msgs else s.get('created_at', ''),
-                'chat_subject': s.get('subject'),
-            })
-    sessions.sort(key=lambda x: x['last_message'] or '', reverse=True)
-    return sessions
+    return _list_sessions(user_uuid, subject)
 
 
 def get_all_previous_chats_summaries(user_uuid, exclude_session_id=None):
+    """Cross-chat digest: one line per earlier chat (name, subject, first messages).
+
+    Built from the manifest previews, which save_chat_message keeps current,
+    so no message log is read.
+    """
     if not user_uuid:
         return []
-    conversations = _load_conversations(user_uuid)
+    return _previous_chats_summaries(_load_listing_manifest(user_uuid), exclude_session_id)
+
+
+def _digest_line(name, subject, preview):
+    line = f"- {name}"
+    if subject:
+        line += f" (Thema: {subject})"
+    if preview:
+        parts = [f"[{m['role']}]: {m['content']}" for m in preview]
+        line += ": " + " | ".join(parts)
+    return line
+
+
+def _previous_chats_summaries(manifest, exclude_session_id=None, max_chats=20):
     summaries = []
-    for s in conversations:
-        if len(summaries) >= 20:
+    for s in manifest:
+        if len(summaries) >= max_chats:
             break
         if exclude_session_id and s.get('id') == exclude_session_id:
             continue
-        name = s.get('name', 'Neuer Chat')
-        subject = s.get('subject')
-        preview_msgs = [m for m in s.get('messages', []) if m['role'] in ('user', 'assistant')][:5]
-
-        summary = f"- {name}"
-        if subject:
-            summary += f" (Thema: {subject})"
-        if preview_msgs:
-            parts = [f"[{m['role']}]: {m['content'][:100]}" for m in preview_msgs]
-            summary += ": " + " | ".join(parts)
-        summaries.append(summary)
+        summaries.append(_digest_line(s.get('name', 'Neuer Chat'), s.get('subject'), s.get('preview')))
     return summaries
 
 
@@ -499,7 +1366,7 @@ def get_subject_id_by_name(user_uuid, name):
 
 
 def create_subject(user_uuid, name):
-    with _lock:
+    with _user_lock(user_uuid, 'subjects'):
         subjects = _load_subjects(user_uuid)
         for s in subjects:
             if s['name'].lower() == name.lower():
@@ -511,7 +1378,7 @@ def create_subject(user_uuid, name):
 
 
 def delete_subject(subject_id, user_uuid):
-    with _lock:
+    with _user_lock(user_uuid, 'subjects'), _user_lock(user_uuid, 'homework'):
         subjects = _load_subjects(user_uuid)
         subjects = [s for s in subjects if s['id'] != subject_id]
         _save_subjects(user_uuid, subjects)
@@ -547,7 +1414,7 @@ def _enrich_hw(hw, subject_map):
 
 
 def create_homework(user_uuid, title, due_date, notes, subject_id=None):
-    with _lock:
+    with _user_lock(user_uuid, 'homework'):
         homework = _load_homework(user_uuid)
         new_homework = {
             'id': str(uuid.uuid4()),
@@ -566,8 +1433,11 @@ def create_homework(user_uuid, title, due_date, notes, subject_id=None):
 
 
 def get_homework_for_user(user_uuid):
-    homework = _load_homework(user_uuid)
-    subject_map = {s['id']: s['name'] for s in _load_subjects(user_uuid)}
+    return _homework_view(_load_homework(user_uuid), _load_subjects(user_uuid))
+
+
+def _homework_view(homework, subjects):
+    subject_map = {s['id']: s['name'] for s in subjects}
     enriched = [_enrich_hw(hw, subject_map) for hw in homework]
     enriched.sort(key=lambda x: (x['completed'], x.get('due_date') or ''))
     return enriched
@@ -587,7 +1457,7 @@ def get_single_homework(homework_id, user_uuid=None):
 
 
 def update_homework(homework_id, user_uuid, title, due_date, notes, subject_id=None):
-    with _lock:
+    with _user_lock(user_uuid, 'homework'):
         homework = _load_homework(user_uuid)
         for hw in homework:
             if hw['id'] == homework_id:
@@ -600,7 +1470,7 @@ def update_homework(homework_id, user_uuid, title, due_date, notes, subject_id=N
 def delete_homework(homework_id, user_uuid=None):
     if not user_uuid:
         return False
-    with _lock:
+    with _user_lock(user_uuid, 'homework'):
         homework = _load_homework(user_uuid)
         homework = [hw for hw in homework if hw['id'] != homework_id]
         _save_homework(user_uuid, homework)
@@ -608,12 +1478,13 @@ def delete_homework(homework_id, user_uuid=None):
 
 
 def delete_all_homework(user_uuid):
-    _save_homework(user_uuid, [])
+    with _user_lock(user_uuid, 'homework'):
+        _save_homework(user_uuid, [])
     return True
 
 
 def toggle_homework_status(homework_id, user_uuid):
-    with _lock:
+    with _user_lock(user_uuid, 'homework'):
         homework = _load_homework(user_uuid)
         for hw in homework:
             if hw['id'] == homework_id:
@@ -626,7 +1497,7 @@ def toggle_homework_status(homework_id, user_uuid):
 
 def delete_old_completed_homework(user_uuid):
     cutoff = (datetime.now() - timedelta(days=1)).isoformat()
-    with _lock:
+    with _user_lock(user_uuid, 'homework'):
         homework = _load_homework(user_uuid)
         homework = [
             hw for hw in homework
@@ -650,7 +1521,7 @@ def _save_memories(user_uuid, memories):
 
 
 def add_memory(user_uuid, content):
-    with _lock:
+    with _user_lock(user_uuid, 'memories'):
         memories = _load_memories(user_uuid)
         if any(m['content'] == content for m in memories):
             return False
@@ -664,7 +1535,7 @@ def get_memories(user_uuid):
 
 
 def delete_memory(memory_id, user_uuid):
-    with _lock:
+    with _user_lock(user_uuid, 'memories'):
         memories = _load_memories(user_uuid)
         memories = [m for m in memories if m['id'] != memory_id]
         _save_memories(user_uuid, memories)
@@ -672,7 +1543,7 @@ def delete_memory(memory_id, user_uuid):
 
 
 def delete_memory_by_content(user_uuid, content):
-    with _lock:
+    with _user_lock(user_uuid, 'memories'):
         memories = _load_memories(user_uuid)
         orig = len(memories)
         memories = [m for m in memories if m['content'] != content]
@@ -682,15 +1553,103 @@ def delete_memory_by_content(user_uuid, content):
     return False
 
 
+# ---------------------------------------------------------------------------
+# Per-request user context
+# ---------------------------------------------------------------------------
+
+class UserContext:
+    """Snapshot of everything one chat turn needs, built by load_user_context().
+
+    Values are plain copies; writes still go through the normal API. Action
+    handling keeps the snapshot in step where later lookups depend on it
+    (see add_subject).
+    """
+
+    def __init__(self, user_uuid, session_id):
+        self.user_uuid = user_uuid
+        self.session_id = session_id
+        self.user = {}
+        self.session = {}
+        self.summary = None
+        self.history = []
+        self.previous_chats = []
+        self.homework = []
+        self.subjects = []
+        self.memories = []
+
+    @property
+    def math_solver_enabled(self):
+        return bool((self.user or {}).get('math_solver', False))
+
+    @property
+    def session_name(self):
+        return self.session.get('name')
+
+    @property
+    def chat_subject(self):
+        return self.session.get('subject')
+
+    @property
+    def memories_text(self):
+        return "\n".join(f"- {m['content']}" for m in self.memories)
+
+    def subject_id_by_name(self, name):
+        for s in self.subjects:
+            if s['name'].lower() == name.lower():
+                return s['id']
+        return None
+
+    def add_subject(self, subject_id, name):
+        self.subjects.append({'id': subject_id, 'name': name})
+
+    def homework_title(self, homework_id, default=None):
+        return next((hw.get('title') for hw in self.homework if hw.get('id') == homework_id), default)
+
+
+def load_user_context(user_uuid, session_id, include_profile=True, include_previous_chats=False):
+    """Load the chat pipeline's inputs for one turn, reading each file once.
+
+    History starts after the session summary, if there is one.
+    include_profile=False skips the account data (user, homework, subjects,
+    memories), as for guests. The digest of the user's other chats is only
+    built with include_previous_chats=True.
+    """
+    ctx = UserContext(user_uuid, session_id)
+    if not user_uuid:
+        return ctx
+    manifest = _load_manifest(user_uuid)
+    ctx.session = _find_session(manifest, session_id) or {}
+    ctx.summary = get_session_summary(user_uuid, session_id)
+    since = ctx.summary['upto_idx'] if ctx.summary else None
+    ctx.history = _session_history_page(user_uuid, ctx.session, since=since)['messages']
+    if include_profile:
+        ctx.user = _load_user(user_uuid)
+        ctx.subjects = _load_subjects(user_uuid)
+        ctx.homework = _homework_view(_load_homework(user_uuid), ctx.subjects)
+        ctx.memories = _load_memories(user_uuid)
+        if include_previous_chats:
+            ctx.previous_chats = _previous_chats_summaries(_load_listing_manifest(user_uuid), session_id)
+    return ctx
+
+
 # ---------------------------------------------------------------------------
 # Data export / import for download
 # ---------------------------------------------------------------------------
 
+def _inline_export_images(conversations):
+    for s in conversations:
+        for m in s.get('messages', []):
+            img = m.get('image_data')
+            if img:
+                m['image_data'] = [blob_store.to_data_url(v) for v in img] if isinstance(img, list) else blob_store.to_data_url(img)
+    return conversations
+
+
 def export_user_data(user_uuid):
     """Return all user data as a dict suitable for JSON export."""
     return {
         'user': _load_user(user_uuid),
-        'conversations': _load_conversations(user_uuid),
+        'conversations': _inline_export_images(_load_conversations(user_uuid)),
         'homework': _load_homework(user_uuid),
         'subjects': _load_subjects(user_uuid),
         'memories': _load_memories(user_uuid),
@@ -708,12 +1667,198 @@ def get_all_user_ids():
 
 def get_students_for_class(class_name: str, school: str):
     """Return list of student user dicts for the given class and school."""
-    students = []
-    for uid in _load_index().values():
-        u = _load_user(uid)
-        if u and u.get('user_type') == 'student' and u.get('class_name') == class_name and u.get('school') == school:
-            students.append(u)
-    return students
+    return _users_for_school(school, 'student', class_name)
+
+
+# ---------------------------------------------------------------------------
+# Maintenance
+# ---------------------------------------------------------------------------
+
+def recover_storage(stale_after=60):
+    """Repair the users/ tree after a crash.
+
+    Removes temp files left by interrupted writes, restores unreadable JSON
+    documents from their .bak snapshot and cuts torn trailing lines off
+    session logs. Returns a dict with counts of what was repaired.
+    """
+    report = {'temp_files_removed': 0, 'documents_restored': 0, 'documents_unrecoverable': 0, 'logs_repaired': 0}
+    if not os.path.isdir(USERS_DIR):
+        return report
+    cutoff = time.time() - stale_after
+    for root, dirs, files in os.walk(USERS_DIR):
+        dirs[:] = [d for d in dirs if d != '.locks']
+        for name in files:
+            path = os.path.join(root, name)
+            if '.tmp-' in name:
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        report['temp_files_removed'] += 1
+                except OSError:
+                    pass
+            elif name.endswith('.json'):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        json.load(f)
+                except (OSError, ValueError):
+                    restored = _recover_from_backup(path, None)
+                    key = 'documents_restored' if restored is not None else 'documents_unrecoverable'
+                    report[key] += 1
+            elif name.endswith('.jsonl'):
+                if _truncate_torn_log_tail(path):
+                    report['logs_repaired'] += 1
+    return report
+
+
+def _all_storage_owners():
+    owners = list(_load_index().values())
+    guests_dir = os.path.join(USERS_DIR, 'guests')
+    if os.path.isdir(guests_dir):
+        owners.extend(os.listdir(guests_dir))
+    return owners
+
+
+def migrate_inline_images():
+    """Move inline base64 images of stored messages into the blob store.
+
+    Session logs that still contain data URLs are rewritten with blob
+    references. Safe to run concurrently with normal traffic and repeatedly.
+    Returns the number of rewritten sessions.
+    """
+    rewritten = 0
+    for owner in _all_storage_owners():
+        for entry in _load_manifest(owner):
+            messages = _load_session_messages(owner, entry['id'])
+            if not any(blob_store.has_inline_images(m.get('image_data')) for m in messages):
+                continue
+            with _session_lock(owner, entry['id']):
+                # Re-read under the lock so appends made meanwhile are kept
+                messages = _load_session_messages(owner, entry['id'])
+                for m in messages:
+                    if m.get('image_data'):
+                        m['image_data'] = blob_store.externalize_images(m['image_data'])
+                _write_session_log(owner, entry['id'], messages)
+            _backfill_blob_refs(owner, (entry['id'],))
+            rewritten += 1
+    if rewritten:
+        print(f"[user_storage] Moved inline images of {rewritten} session(s) to the blob store.")
+    return rewritten
+
+
+def reset_stale_pending_worksheets(keep=(), older_than=timedelta(minutes=10)):
+    """Clear the PENDING worksheet marker of messages no render job will finish.
+
+    keep holds (user_uuid, session_id, msg_idx) of messages whose job is still
+    queued; messages younger than older_than are left alone, as their job may
+    not be attached yet. Returns the number of reset messages.
+    """
+    cutoff = (datetime.now() - older_than).isoformat()
+    keep = set(keep)
+    reset = 0
+    for owner in _all_storage_owners():
+        for entry in _load_manifest(owner):
+            for idx, m in enumerate(_load_session_messages(owner, entry['id'])):
+                if (m.get('worksheet_filename') == 'PENDING' and (m.get('created_at') or '') < cutoff
+                        and (owner, entry['id'], idx) not in keep):
+                    _update_chat_message_fields(owner, entry['id'], idx, worksheet_filename=None)
+                    reset += 1
+    if reset:
+        print(f"[user_storage] Cleared {reset} worksheet(s) stuck in PENDING.")
+    return reset
+
+
+def _read_session_messages_uncached(user_uuid, session_id):
+    """Messages of a session log, read past the document cache (for full scans)."""
+    try:
+        with open(_session_log_path(user_uuid, session_id), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    complete = data[:data.rfind(b'\n') + 1]
+    return _replay_messages(_parse_log_lines(complete.decode('utf-8', errors='replace')))
+
+
+def get_referenced_files(batch_size=0, pause=0.0):
+    """Worksheet filenames and blob hashes that stored messages still point to.
+
+    Used by storage_gc to tell orphaned files from live ones. Reads past the
+    document cache, so a scan does not evict the hot sessions, and sleeps
+    `pause` seconds after every batch_size session logs.
+    """
+    worksheets, blobs = set(), set()
+    logs_read = 0
+    for owner in _all_storage_owners():
+        try:
+            with open(_manifest_path(owner), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = _load_manifest(owner)  # legacy data or a damaged manifest
+        for entry in manifest:
+            for m in _read_session_messages_uncached(owner, entry['id']):
+                if m.get('worksheet_filename'):
+                    worksheets.add(m['worksheet_filename'])
+                if m.get('image_data'):
+                    blobs |= blob_store.hashes_in(m['image_data'])
+            logs_read += 1
+            if batch_size and logs_read % batch_size == 0:
+                time.sleep(pause)
+    return {'worksheets': worksheets, 'blobs': blobs}
+
+
+# Each manifest entry lists the blobs its messages point to as 'blobs';
+# user_references_blob() keeps their union per manifest version
+_blob_refs = {}  # manifest path -> (signature, set of blob hashes)
+
+
+def _session_blob_hashes(messages):
+    hashes = set()
+    for m in messages:
+        if m.get('image_data'):
+            hashes |= blob_store.hashes_in(m['image_data'])
+    return hashes
+
+
+def _backfill_blob_refs(user_uuid, session_ids=()):
+    """Add 'blobs' to manifest entries written before it was tracked (and redo it for session_ids)."""
+    with _user_lock(user_uuid, 'sessions'):
+        manifest = _load_manifest(user_uuid)
+        missing = [s for s in manifest if 'blobs' not in s or s['id'] in session_ids]
+        for s in missing:
+            s['blobs'] = sorted(_session_blob_hashes(_read_session_messages_uncached(user_uuid, s['id'])))
+        if missing:
+            _save_manifest(user_uuid, manifest)
+        return manifest
+
+
+def user_references_blob(user_uuid, blob_hash):
+    """Whether one of the user's own sessions has a message pointing to the blob."""
+    if not user_uuid:
+        return False
+    path = _manifest_path(user_uuid)
+    # Taken before the read: a manifest written meanwhile only makes the entry stale
+    signature = _file_signature(path)
+    entry = _blob_refs.get(path)
+    if entry is None or signature is None or entry[0] != signature:
+        manifest = _load_manifest(user_uuid)
+        if any('blobs' not in s for s in manifest):
+            manifest = _backfill_blob_refs(user_uuid)
+            signature = None
+        entry = (signature, {h for s in manifest for h in s['blobs']})
+        if signature is not None:
+            _blob_refs[path] = entry
+    return blob_hash in entry[1]
+
+
+def _truncate_torn_log_tail(path):
+    try:
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if not data or data.endswith(b'\n'):
+                return False
+            f.truncate(data.rfind(b'\n') + 1)
+            return True
+    except OSError:
+        return False
 
 
 # ---------------------------------------------------------------------------
@@ -726,6 +1871,15 @@ def migrate_from_sqlite():
     if not os.path.exists(db_path):
         return
 
+    with _index_lock():
+        _migrate_from_sqlite(db_path)
+
+
+def _migrate_from_sqlite(db_path):
+    # Several workers may start at once; re-check under the index lock
+    if not os.path.exists(db_path):
+        return
+
     try:
         import sqlite3
         conn = sqlite3.connect(db_path)
@@ -801,7 +1955,7 @@ def migrate_from_sqlite():
                 conversations.sort(key=lambda s: s.get('updated_at') or '', reverse=True)
             except Exception:
                 pass
-            _save_json(os.path.join(user_dir, 'conversations.json'), conversations)
+            _import_conversations(user_uuid, conversations)
 
             # Migrate homework
             homework = []
@@ -853,6 +2007,7 @@ def migrate_from_sqlite():
 
         if migrated:
             _save_index(index)
+            rebuild_school_index()
             print(f"[user_storage] Migrated {migrated} user(s) from SQLite to file storage.")
 
         conn.close()
@@ -863,3 +2018,44 @@ def migrate_from_sqlite():
 
     except Exception as e:
         print(f"[user_storage] Migration error: {e}")
+
+
+# ---------------------------------------------------------------------------
+# Backend selection
+#
+# USER_STORAGE_BACKEND=files (default) keeps the per-user folder layout above;
+# USER_STORAGE_BACKEND=sqlite rebinds the public API below to
+# user_storage_sqlite. The file implementations stay reachable through
+# _FILE_BACKEND for migrations between the two.
+# ---------------------------------------------------------------------------
+
+BACKEND = os.getenv('USER_STORAGE_BACKEND', 'files').lower()
+
+_BACKEND_API = (
+    'create_user', 'get_user', 'get_user_by_id', 'get_user_by_username', '_update_user_field',
+    'assign_teacher_to_class', 'add_student_to_class', 'get_all_users',
+    'get_teachers_for_school', 'get_students_for_school', 'get_unique_school_names',
+    'get_student_usernames_for_school', 'get_unique_class_names_for_school',
+    'get_teacher_usernames_for_school', 'delete_user', 'rebuild_school_index',
+    'get_math_solver_status', 'set_math_solver_status', 'get_first_login_status', 'set_first_login_status',
+    'get_user_chat_sessions', 'get_chat_history', 'get_chat_history_page', 'save_chat_message',
+    'update_chat_message_worksheet', 'update_chat_message_homework', 'delete_chat_session',
+    'rename_chat_session', 'get_session_name', 'update_chat_session_subject',
+    'get_unique_chat_subjects', 'get_chat_sessions_by_subject', 'get_all_previous_chats_summaries',
+    'get_session_summary', 'save_session_summary', 'load_user_context', 'user_references_blob',
+    'get_subjects', 'get_subject_id_by_name', 'create_subject', 'delete_subject',
+    'create_homework', 'get_homework_for_user', 'get_single_homework', 'update_homework',
+    'delete_homework', 'delete_all_homework', 'toggle_homework_status', 'delete_old_completed_homework',
+    'add_memory', 'get_memories', 'delete_memory', 'delete_memory_by_content',
+    'export_user_data', 'get_all_user_ids', 'get_students_for_class', 'migrate_from_sqlite',
+    'migrate_inline_images', 'reset_stale_pending_worksheets', 'get_referenced_files',
+)
+
+_FILE_BACKEND = {name: globals()[name] for name in _BACKEND_API}
+
+if BACKEND == 'sqlite':
+    import user_storage_sqlite as _sqlite_backend
+    for _name in _BACKEND_API:
+        globals()[_name] = getattr(_sqlite_backend, _name)
+elif BACKEND != 'files':
+    raise ValueError(f"Unknown USER_STORAGE_BACKEND: {BACKEND!r}")
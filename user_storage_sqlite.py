@@ -0,0 +1,1142 @@
+"""
+SQLite backend for user_storage.
+
+Implements the public user_storage API on a single SQLite database in WAL mode
+(readers never block the writer, and several gunicorn workers can share it).
+Selected with USER_STORAGE_BACKEND=sqlite; the database path comes from
+USER_STORAGE_DB. user_storage rebinds its public functions to the ones here,
+so callers keep using `import user_storage as us`.
+"""
+
+import os
+import json
+import uuid
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import bcrypt
+
+import blob_store
+import user_storage as us
+
+DATABASE_PATH = os.getenv('USER_STORAGE_DB', os.path.join(us.USERS_DIR, 'user_data.db'))
+POOL_SIZE = int(os.getenv('USER_STORAGE_DB_POOL', '8'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    uuid TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    user_type TEXT NOT NULL,
+    school TEXT,
+    class_name TEXT,
+    math_solver INTEGER NOT NULL DEFAULT 0,
+    is_first_login INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_school_role ON users(school, user_type);
+CREATE INDEX IF NOT EXISTS idx_users_school_class ON users(school, class_name, user_type);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    user_uuid TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    subject TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    first_message_at TEXT,
+    last_message_at TEXT,
+    preview TEXT,
+    PRIMARY KEY (user_uuid, id)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_subject ON sessions(user_uuid, subject);
+
+CREATE TABLE IF NOT EXISTS messages (
+    user_uuid TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    image_data TEXT,
+    worksheet_filename TEXT,
+    homework_id TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (user_uuid, session_id, idx)
+);
+
+CREATE TABLE IF NOT EXISTS session_summaries (
+    user_uuid TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    upto_idx INTEGER NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (user_uuid, session_id)
+);
+
+CREATE TABLE IF NOT EXISTS homework (
+    id TEXT PRIMARY KEY,
+    user_uuid TEXT NOT NULL,
+    title TEXT,
+    due_date TEXT,
+    notes TEXT,
+    subject_id TEXT,
+    completed INTEGER NOT NULL DEFAULT 0,
+    completed_at TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_homework_user ON homework(user_uuid);
+
+CREATE TABLE IF NOT EXISTS subjects (
+    id TEXT PRIMARY KEY,
+    user_uuid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_subjects_user_name ON subjects(user_uuid, name COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS memories (
+    id TEXT PRIMARY KEY,
+    user_uuid TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_memories_user ON memories(user_uuid);
+'''
+
+
+# Blobs each message points to, so /blob/<hash> can check ownership without
+# scanning image_data; created (and filled) by _upgrade_schema
+MESSAGE_BLOBS_SCHEMA = (
+    'CREATE TABLE message_blobs (user_uuid TEXT NOT NULL, session_id TEXT NOT NULL, idx INTEGER NOT NULL, '
+    'blob_hash TEXT NOT NULL, PRIMARY KEY (user_uuid, blob_hash, session_id, idx))',
+    'CREATE INDEX idx_message_blobs_session ON message_blobs(user_uuid, session_id)',
+)
+
+
+def _index_message_blobs(conn, user_uuid, session_id, idx, image_data):
+    """Replace the message_blobs rows of one message; image_data as stored in the message (decoded)."""
+    conn.execute('DELETE FROM message_blobs WHERE user_uuid = ? AND session_id = ? AND idx = ?', (user_uuid, session_id, idx))
+    if image_data:
+        conn.executemany(
+            'INSERT OR IGNORE INTO message_blobs (user_uuid, session_id, idx, blob_hash) VALUES (?, ?, ?, ?)',
+            [(user_uuid, session_id, idx, h) for h in blob_store.hashes_in(image_data)]
+        )
+
+
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+
+def _upgrade_schema(conn):
+    """Add columns introduced after a database was first created."""
+    columns = {r['name'] for r in conn.execute('PRAGMA table_info(sessions)')}
+    if 'last_message_at' not in columns:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('ALTER TABLE sessions ADD COLUMN first_message_at TEXT')
+        conn.execute('ALTER TABLE sessions ADD COLUMN last_message_at TEXT')
+        conn.execute('''
+            UPDATE sessions SET
+                first_message_at = (SELECT created_at FROM messages m WHERE m.user_uuid = sessions.user_uuid
+                                    AND m.session_id = sessions.id ORDER BY idx ASC LIMIT 1),
+                last_message_at = (SELECT created_at FROM messages m WHERE m.user_uuid = sessions.user_uuid
+                                   AND m.session_id = sessions.id ORDER BY idx DESC LIMIT 1)
+        ''')
+        conn.commit()
+    columns = {r['name'] for r in conn.execute('PRAGMA table_info(messages)')}
+    if 'updated_at' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN updated_at TEXT')
+    columns = {r['name'] for r in conn.execute('PRAGMA table_info(sessions)')}
+    if 'preview' not in columns:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('ALTER TABLE sessions ADD COLUMN preview TEXT')
+        sessions = conn.execute('SELECT user_uuid, id FROM sessions').fetchall()
+        for row in sessions:
+            msgs = conn.execute(
+                "SELECT role, content FROM messages WHERE user_uuid = ? AND session_id = ? AND role IN ('user', 'assistant') "
+                'ORDER BY idx LIMIT ?',
+                (row['user_uuid'], row['id'], us._PREVIEW_MESSAGES)
+            ).fetchall()
+            conn.execute(
+                'UPDATE sessions SET preview = ? WHERE user_uuid = ? AND id = ?',
+                (json.dumps(us._build_preview([dict(m) for m in msgs]), ensure_ascii=False), row['user_uuid'], row['id'])
+            )
+        conn.commit()
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_blobs'").fetchone() is None:
+        conn.execute('BEGIN IMMEDIATE')
+        for statement in MESSAGE_BLOBS_SCHEMA:
+            conn.execute(statement)
+        rows = conn.execute('SELECT user_uuid, session_id, idx, image_data FROM messages WHERE image_data IS NOT NULL').fetchall()
+        for r in rows:
+            _index_message_blobs(conn, r['user_uuid'], r['session_id'], r['idx'], json.loads(r['image_data']))
+        conn.commit()
+
+
+class _ConnectionPool:
+    def __init__(self, path, size):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        with self._init_lock:
+            if not self._initialized:
+                conn.executescript(SCHEMA)
+                _upgrade_schema(conn)
+                self._initialized = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+_pool = _ConnectionPool(DATABASE_PATH, POOL_SIZE)
+
+
+@contextmanager
+def _read():
+    with _pool.connection() as conn:
+        yield conn
+
+
+@contextmanager
+def _write():
+    """Write transaction; BEGIN IMMEDIATE takes the write lock up front."""
+    with _pool.connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+# ---------------------------------------------------------------------------
+# Row conversion
+# ---------------------------------------------------------------------------
+
+def _user_row(row):
+    if row is None:
+        return None
+    user = dict(row)
+    user['math_solver'] = bool(user['math_solver'])
+    user['is_first_login'] = bool(user['is_first_login'])
+    return user
+
+
+def _message_row(row):
+    msg = {'role': row['role'], 'content': row['content'], 'created_at': row['created_at']}
+    if row['image_data']:
+        msg['image_data'] = json.loads(row['image_data'])
+    if row['worksheet_filename']:
+        msg['worksheet_filename'] = row['worksheet_filename']
+    if row['homework_id']:
+        msg['homework_id'] = row['homework_id']
+    if row['updated_at']:
+        msg['updated_at'] = row['updated_at']
+    return msg
+
+
+def _homework_row(row):
+    hw = dict(row)
+    hw['completed'] = bool(hw['completed'])
+    return hw
+
+
+def _listing_entry(row):
+    return {
+        'session_id': row['id'],
+        'session_name': row['name'] or 'Neuer Chat',
+        'first_message': row['first_message_at'] or row['created_at'] or '',
+        'last_message': row['last_message_at'] or row['created_at'] or '',
+        'chat_subject': row['subject'],
+    }
+
+
+_LISTING_QUERY = '''
+    SELECT id, name, subject, created_at, first_message_at, last_message_at
+    FROM sessions
+'''
+
+
+# ---------------------------------------------------------------------------
+# User management
+# ---------------------------------------------------------------------------
+
+def create_user(username, password, user_type, school=None):
+    """Create a new user. Returns True on success, False if username taken or IT-admin conflict."""
+    hashed_pw = us.hash_pw(password).decode('utf-8')
+    with _write() as conn:
+        if conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+            return False
+        if user_type == 'it-admin' and school:
+            # Only one IT-admin per school
+            if conn.execute("SELECT 1 FROM users WHERE school = ? AND user_type = 'it-admin'", (school,)).fetchone():
+                return False
+        conn.execute(
+            'INSERT INTO users (uuid, username, password, user_type, school, class_name, math_solver, is_first_login, created_at) '
+            'VALUES (?, ?, ?, ?, ?, NULL, 0, 1, ?)',
+            (str(uuid.uuid4()), username, hashed_pw, user_type, school, _now())
+        )
+    return True
+
+
+def get_user(username, password):
+    """Authenticate user. Returns user dict or None."""
+    user = get_user_by_username(username)
+    if user and bcrypt.checkpw(password.encode('utf-8'), user.get('password').encode('utf-8')):
+        return user
+    return None
+
+
+def get_user_by_id(user_uuid):
+    with _read() as conn:
+        row = conn.execute('SELECT * FROM users WHERE uuid = ?', (user_uuid,)).fetchone()
+    return _user_row(row)
+
+
+def get_user_by_username(username):
+    with _read() as conn:
+        row = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    return _user_row(row)
+
+
+def _update_user_field(user_uuid, **kwargs):
+    columns = ', '.join(f'{k} = ?' for k in kwargs)
+    with _write() as conn:
+        cur = conn.execute(f'UPDATE users SET {columns} WHERE uuid = ?', (*kwargs.values(), user_uuid))
+    return cur.rowcount > 0
+
+
+def assign_teacher_to_class(teacher_username, class_name):
+    with _write() as conn:
+        cur = conn.execute('UPDATE users SET class_name = ? WHERE username = ?', (class_name, teacher_username))
+    return cur.rowcount > 0
+
+
+def add_student_to_class(student_username, class_name):
+    return assign_teacher_to_class(student_username, class_name)
+
+
+def get_all_users():
+    with _read() as conn:
+        return [_user_row(r) for r in conn.execute('SELECT * FROM users ORDER BY rowid')]
+
+
+def get_teachers_for_school(school):
+    with _read() as conn:
+        rows = conn.execute("SELECT * FROM users WHERE school = ? AND user_type = 'teacher' ORDER BY rowid", (school,))
+        return [_user_row(r) for r in rows]
+
+
+def get_students_for_school(school):
+    with _read() as conn:
+        rows = conn.execute("SELECT * FROM users WHERE school = ? AND user_type = 'student' ORDER BY rowid", (school,))
+        return [_user_row(r) for r in rows]
+
+
+def get_unique_school_names():
+    with _read() as conn:
+        rows = conn.execute("SELECT DISTINCT school FROM users WHERE school IS NOT NULL AND school != '' ORDER BY school")
+        return [r['school'] for r in rows]
+
+
+def get_student_usernames_for_school(school):
+    return [u['username'] for u in get_students_for_school(school)]
+
+
+def get_unique_class_names_for_school(school):
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT class_name FROM users WHERE school = ? AND class_name IS NOT NULL AND class_name != '' ORDER BY class_name",
+            (school,)
+        )
+        return [r['class_name'] for r in rows]
+
+
+def get_teacher_usernames_for_school(school):
+    return [u['username'] for u in get_teachers_for_school(school)]
+
+
+def delete_user(user_uuid):
+    with _write() as conn:
+        cur = conn.execute('DELETE FROM users WHERE uuid = ?', (user_uuid,))
+        if cur.rowcount == 0:
+            return False
+        for table in ('sessions', 'messages', 'message_blobs', 'session_summaries', 'homework', 'subjects', 'memories'):
+            conn.execute(f'DELETE FROM {table} WHERE user_uuid = ?', (user_uuid,))
+    return True
+
+
+def rebuild_school_index():
+    """SQL indexes are maintained by SQLite; just refresh the planner statistics."""
+    with _write() as conn:
+        conn.execute('ANALYZE')
+    return {'schools': {s: {} for s in get_unique_school_names()}}
+
+
+# ---------------------------------------------------------------------------
+# User settings
+# ---------------------------------------------------------------------------
+
+def get_math_solver_status(user_uuid):
+    return bool((get_user_by_id(user_uuid) or {}).get('math_solver', False))
+
+
+def set_math_solver_status(user_uuid, status):
+    return _update_user_field(user_uuid, math_solver=int(bool(status)))
+
+
+def get_first_login_status(user_uuid):
+    return bool((get_user_by_id(user_uuid) or {}).get('is_first_login', False))
+
+
+def set_first_login_status(user_uuid, status):
+    return _update_user_field(user_uuid, is_first_login=int(bool(status)))
+
+
+# ---------------------------------------------------------------------------
+# Conversations
+# ---------------------------------------------------------------------------
+
+def get_user_chat_sessions(user_uuid):
+    if not user_uuid:
+        return []
+    with _read() as conn:
+        rows = conn.execute(_LISTING_QUERY + ' WHERE user_uuid = ?', (user_uuid,)).fetchall()
+    sessions = [_listing_entry(r) for r in rows]
+    sessions.sort(key=lambda x: x['last_message'] or '', reverse=True)
+    return sessions
+
+
+def get_chat_history_page(user_uuid, session_id, limit=None, before=None, since=None):
+    if not user_uuid:
+        return {'messages': [], 'has_more': False, 'cursor': None}
+    with _read() as conn:
+        return _history_page(conn, user_uuid, session_id, limit, before, since)
+
+
+def _history_page(conn, user_uuid, session_id, limit=None, before=None, since=None):
+    page = {'messages': [], 'has_more': False, 'cursor': None}
+    since_idx, since_ts = us._parse_since(since)
+    where = ['user_uuid = ?', 'session_id = ?']
+    params = [user_uuid, session_id]
+    if before is not None:
+        where.append('idx < ?')
+        params.append(before)
+    if since_idx is not None:
+        where.append('idx >= ?')
+        params.append(since_idx)
+    if since_ts is not None:
+        where.append("COALESCE(updated_at, created_at, '') > ?")
+        params.append(since_ts)
+    query = f"SELECT * FROM messages WHERE {' AND '.join(where)} ORDER BY idx DESC"
+    if limit is not None and limit >= 0:
+        query += f' LIMIT {int(limit)}'
+    session = conn.execute('SELECT subject FROM sessions WHERE user_uuid = ? AND id = ?', (user_uuid, session_id)).fetchone()
+    if not session:
+        return page
+    rows = conn.execute(query, params).fetchall()[::-1]
+    page['cursor'] = conn.execute(
+        "SELECT MAX(COALESCE(updated_at, created_at, '')) AS cursor FROM messages WHERE user_uuid = ? AND session_id = ?",
+        (user_uuid, session_id)
+    ).fetchone()['cursor']
+    page['messages'] = [
+        {
+            'msg_idx': r['idx'],
+            'message_type': r['role'],
+            'content': r['content'],
+            'image_data': blob_store.to_public_urls(json.loads(r['image_data'])) if r['image_data'] else None,
+            'worksheet_filename': r['worksheet_filename'],
+            'homework_id': r['homework_id'],
+            'created_at': r['created_at'],
+            'updated_at': r['updated_at'] or r['created_at'],
+            'chat_subject': session['subject'],
+        }
+        for r in rows
+    ]
+    if rows:
+        page['has_more'] = rows[0]['idx'] > 0
+    return page
+
+
+def get_chat_history(user_uuid, session_id, limit=None, before=None, since=None):
+    return get_chat_history_page(user_uuid, session_id, limit=limit, before=before, since=since)['messages']
+
+
+def save_chat_message(user_uuid, session_id, message_type, content,
+                      image_data=None, worksheet_filename=None, homework_id=None,
+                      chat_subject=None, session_name=None):
+    """Save a chat message. Returns message index within session (for worksheet updates)."""
+    if not user_uuid:
+        return None
+    if image_data:
+        image_data = blob_store.externalize_images(image_data)
+    now = _now()
+    with _write() as conn:
+        session = conn.execute(
+            'SELECT name, message_count, preview FROM sessions WHERE user_uuid = ? AND id = ?', (user_uuid, session_id)
+        ).fetchone()
+        preview = json.loads(session['preview']) if session and session['preview'] else []
+        if session is None:
+            conn.execute(
+                'INSERT INTO sessions (user_uuid, id, name, subject, created_at, updated_at, message_count, first_message_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                (user_uuid, session_id, session_name or 'Neuer Chat', chat_subject, now, now, now)
+            )
+            msg_idx = 0
+        else:
+            msg_idx = session['message_count']
+            name = session['name']
+            if session_name and name in (None, 'Neuer Chat', ''):
+                name = session_name
+            conn.execute(
+                'UPDATE sessions SET name = ?, subject = COALESCE(?, subject), updated_at = ? WHERE user_uuid = ? AND id = ?',
+                (name, chat_subject or None, now, user_uuid, session_id)
+            )
+        conn.execute(
+            'INSERT INTO messages (user_uuid, session_id, idx, role, content, image_data, worksheet_filename, homework_id, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_uuid, session_id, msg_idx, message_type, content,
+             json.dumps(image_data) if image_data else None, worksheet_filename or None, homework_id or None, now)
+        )
+        _index_message_blobs(conn, user_uuid, session_id, msg_idx, image_data)
+        conn.execute(
+            'UPDATE sessions SET message_count = ?, first_message_at = COALESCE(first_message_at, ?), last_message_at = ? '
+            'WHERE user_uuid = ? AND id = ?',
+            (msg_idx + 1, now, now, user_uuid, session_id)
+        )
+        if len(preview) < us._PREVIEW_MESSAGES and message_type in ('user', 'assistant'):
+            preview.append(us._preview_item({'role': message_type, 'content': content}))
+            conn.execute(
+                'UPDATE sessions SET preview = ? WHERE user_uuid = ? AND id = ?',
+                (json.dumps(preview, ensure_ascii=False), user_uuid, session_id)
+            )
+    return msg_idx
+
+
+def _update_message_column(user_uuid, session_id, msg_idx, column, value):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        cur = conn.execute(
+            f'UPDATE messages SET {column} = ?, updated_at = ? WHERE user_uuid = ? AND session_id = ? AND idx = ?',
+            (value, _now(), user_uuid, session_id, msg_idx)
+        )
+    return cur.rowcount > 0
+
+
+def update_chat_message_worksheet(user_uuid, session_id, msg_idx, worksheet_filename):
+    return _update_message_column(user_uuid, session_id, msg_idx, 'worksheet_filename', worksheet_filename)
+
+
+def update_chat_message_homework(user_uuid, session_id, msg_idx, homework_id):
+    return _update_message_column(user_uuid, session_id, msg_idx, 'homework_id', homework_id)
+
+
+def delete_chat_session(user_uuid, session_id):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        conn.execute('DELETE FROM messages WHERE user_uuid = ? AND session_id = ?', (user_uuid, session_id))
+        conn.execute('DELETE FROM message_blobs WHERE user_uuid = ? AND session_id = ?', (user_uuid, session_id))
+        conn.execute('DELETE FROM session_summaries WHERE user_uuid = ? AND session_id = ?', (user_uuid, session_id))
+        conn.execute('DELETE FROM sessions WHERE user_uuid = ? AND id = ?', (user_uuid, session_id))
+    return True
+
+
+def rename_chat_session(user_uuid, session_id, new_name):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        cur = conn.execute('UPDATE sessions SET name = ? WHERE user_uuid = ? AND id = ?', (new_name, user_uuid, session_id))
+    return cur.rowcount > 0
+
+
+def get_session_name(user_uuid, session_id):
+    if not user_uuid:
+        return None
+    with _read() as conn:
+        row = conn.execute('SELECT name FROM sessions WHERE user_uuid = ? AND id = ?', (user_uuid, session_id)).fetchone()
+    return row['name'] if row else None
+
+
+def update_chat_session_subject(user_uuid, session_id, subject):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        cur = conn.execute('UPDATE sessions SET subject = ? WHERE user_uuid = ? AND id = ?', (subject, user_uuid, session_id))
+    return cur.rowcount > 0
+
+
+def get_session_summary(user_uuid, session_id):
+    if not user_uuid:
+        return None
+    with _read() as conn:
+        return _session_summary(conn, user_uuid, session_id)
+
+
+def _session_summary(conn, user_uuid, session_id):
+    row = conn.execute(
+        'SELECT summary, upto_idx, updated_at FROM session_summaries WHERE user_uuid = ? AND session_id = ?',
+        (user_uuid, session_id)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def save_session_summary(user_uuid, session_id, summary, upto_idx):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        if not conn.execute('SELECT 1 FROM sessions WHERE user_uuid = ? AND id = ?', (user_uuid, session_id)).fetchone():
+            return False
+        # A slower, older summarization run must not overwrite a newer one
+        cur = conn.execute(
+            'INSERT INTO session_summaries (user_uuid, session_id, summary, upto_idx, updated_at) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (user_uuid, session_id) DO UPDATE SET summary = excluded.summary, upto_idx = excluded.upto_idx, '
+            'updated_at = excluded.updated_at WHERE excluded.upto_idx >= session_summaries.upto_idx',
+            (user_uuid, session_id, summary, upto_idx, _now())
+        )
+    return cur.rowcount > 0
+
+
+def get_unique_chat_subjects(user_uuid):
+    if not user_uuid:
+        return []
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT subject FROM sessions WHERE user_uuid = ? AND subject IS NOT NULL AND subject != '' ORDER BY subject",
+            (user_uuid,)
+        )
+        return [r['subject'] for r in rows]
+
+
+def get_chat_sessions_by_subject(user_uuid, subject):
+    if not user_uuid:
+        return []
+    with _read() as conn:
+        rows = conn.execute(_LISTING_QUERY + ' WHERE user_uuid = ? AND subject = ?', (user_uuid, subject)).fetchall()
+    sessions = [_listing_entry(r) for r in rows]
+    sessions.sort(key=lambda x: x['last_message'] or '', reverse=True)
+    return sessions
+
+
+def get_all_previous_chats_summaries(user_uuid, exclude_session_id=None):
+    if not user_uuid:
+        return []
+    with _read() as conn:
+        return _previous_chats_summaries(conn, user_uuid, exclude_session_id)
+
+
+def _previous_chats_summaries(conn, user_uuid, exclude_session_id=None, max_chats=20):
+    sessions = conn.execute(
+        'SELECT name, subject, preview FROM sessions WHERE user_uuid = ? AND id != ? ORDER BY created_at DESC LIMIT ?',
+        (user_uuid, exclude_session_id or '', max_chats)
+    )
+    return [
+        us._digest_line(s['name'] or 'Neuer Chat', s['subject'], json.loads(s['preview']) if s['preview'] else [])
+        for s in sessions
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Subjects
+# ---------------------------------------------------------------------------
+
+def get_subjects(user_uuid):
+    with _read() as conn:
+        return _subjects(conn, user_uuid)
+
+
+def _subjects(conn, user_uuid):
+    rows = conn.execute('SELECT id, name, created_at FROM subjects WHERE user_uuid = ? ORDER BY rowid', (user_uuid,))
+    return [dict(r) for r in rows]
+
+
+def get_subject_id_by_name(user_uuid, name):
+    with _read() as conn:
+        row = conn.execute(
+            'SELECT id FROM subjects WHERE user_uuid = ? AND name = ? COLLATE NOCASE ORDER BY rowid LIMIT 1', (user_uuid, name)
+        ).fetchone()
+    return row['id'] if row else None
+
+
+def create_subject(user_uuid, name):
+    with _write() as conn:
+        if conn.execute('SELECT 1 FROM subjects WHERE user_uuid = ? AND name = ? COLLATE NOCASE', (user_uuid, name)).fetchone():
+            return False
+        new_id = str(uuid.uuid4())
+        conn.execute('INSERT INTO subjects (id, user_uuid, name, created_at) VALUES (?, ?, ?, ?)', (new_id, user_uuid, name, _now()))
+    return new_id
+
+
+def delete_subject(subject_id, user_uuid):
+    with _write() as conn:
+        conn.execute('DELETE FROM subjects WHERE id = ? AND user_uuid = ?', (subject_id, user_uuid))
+        conn.execute('UPDATE homework SET subject_id = NULL WHERE subject_id = ? AND user_uuid = ?', (subject_id, user_uuid))
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Homework
+# ---------------------------------------------------------------------------
+
+def create_homework(user_uuid, title, due_date, notes, subject_id=None):
+    new_homework = {
+        'id': str(uuid.uuid4()),
+        'user_uuid': user_uuid,
+        'title': title,
+        'due_date': due_date,
+        'notes': notes,
+        'subject_id': subject_id,
+        'completed': False,
+        'completed_at': None,
+        'created_at': _now(),
+    }
+    with _write() as conn:
+        conn.execute(
+            'INSERT INTO homework (id, user_uuid, title, due_date, notes, subject_id, completed, completed_at, created_at) '
+            'VALUES (:id, :user_uuid, :title, :due_date, :notes, :subject_id, 0, NULL, :created_at)',
+            new_homework
+        )
+    return new_homework
+
+
+def get_homework_for_user(user_uuid):
+    with _read() as conn:
+        return _homework_for_user(conn, user_uuid)
+
+
+def _homework_for_user(conn, user_uuid):
+    rows = conn.execute(
+        'SELECT h.*, s.name AS subject_name FROM homework h '
+        'LEFT JOIN subjects s ON s.id = h.subject_id AND s.user_uuid = h.user_uuid '
+        "WHERE h.user_uuid = ? ORDER BY h.completed, COALESCE(h.due_date, ''), h.rowid",
+        (user_uuid,)
+    ).fetchall()
+    enriched = []
+    for r in rows:
+        hw = _homework_row(r)
+        hw['user_id'] = hw.get('user_uuid', '')
+        enriched.append(hw)
+    return enriched
+
+
+def get_single_homework(homework_id, user_uuid=None):
+    if not user_uuid:
+        return None
+    with _read() as conn:
+        row = conn.execute(
+            'SELECT h.*, s.name AS subject_name FROM homework h '
+            'LEFT JOIN subjects s ON s.id = h.subject_id AND s.user_uuid = h.user_uuid '
+            'WHERE h.id = ? AND h.user_uuid = ?',
+            (homework_id, user_uuid)
+        ).fetchone()
+    if not row:
+        return None
+    result = _homework_row(row)
+    result['user_id'] = user_uuid  # used for ownership check in app.py
+    return result
+
+
+def update_homework(homework_id, user_uuid, title, due_date, notes, subject_id=None):
+    with _write() as conn:
+        cur = conn.execute(
+            'UPDATE homework SET title = ?, due_date = ?, notes = ?, subject_id = ? WHERE id = ? AND user_uuid = ?',
+            (title, due_date, notes, subject_id, homework_id, user_uuid)
+        )
+    return cur.rowcount > 0
+
+
+def delete_homework(homework_id, user_uuid=None):
+    if not user_uuid:
+        return False
+    with _write() as conn:
+        conn.execute('DELETE FROM homework WHERE id = ? AND user_uuid = ?', (homework_id, user_uuid))
+    return True
+
+
+def delete_all_homework(user_uuid):
+    with _write() as conn:
+        conn.execute('DELETE FROM homework WHERE user_uuid = ?', (user_uuid,))
+    return True
+
+
+def toggle_homework_status(homework_id, user_uuid):
+    with _write() as conn:
+        cur = conn.execute(
+            'UPDATE homework SET completed = 1 - completed, '
+            'completed_at = CASE WHEN completed = 0 THEN ? ELSE NULL END '
+            'WHERE id = ? AND user_uuid = ?',
+            (_now(), homework_id, user_uuid)
+        )
+    return cur.rowcount > 0
+
+
+def delete_old_completed_homework(user_uuid):
+    cutoff = (datetime.now() - timedelta(days=1)).isoformat()
+    with _write() as conn:
+        conn.execute(
+            'DELETE FROM homework WHERE user_uuid = ? AND completed = 1 AND completed_at IS NOT NULL AND completed_at < ?',
+            (user_uuid, cutoff)
+        )
+
+
+# ---------------------------------------------------------------------------
+# Memories
+# ---------------------------------------------------------------------------
+
+def add_memory(user_uuid, content):
+    with _write() as conn:
+        if conn.execute('SELECT 1 FROM memories WHERE user_uuid = ? AND content = ?', (user_uuid, content)).fetchone():
+            return False
+        conn.execute(
+            'INSERT INTO memories (id, user_uuid, content, created_at) VALUES (?, ?, ?, ?)',
+            (str(uuid.uuid4()), user_uuid, content, _now())
+        )
+    return True
+
+
+def get_memories(user_uuid):
+    with _read() as conn:
+        return _memories(conn, user_uuid)
+
+
+def _memories(conn, user_uuid):
+    rows = conn.execute(
+        'SELECT id, content, created_at FROM memories WHERE user_uuid = ? ORDER BY rowid DESC', (user_uuid,)
+    )
+    return [dict(r) for r in rows]
+
+
+def delete_memory(memory_id, user_uuid):
+    with _write() as conn:
+        conn.execute('DELETE FROM memories WHERE id = ? AND user_uuid = ?', (memory_id, user_uuid))
+    return True
+
+
+def delete_memory_by_content(user_uuid, content):
+    with _write() as conn:
+        cur = conn.execute('DELETE FROM memories WHERE user_uuid = ? AND content = ?', (user_uuid, content))
+    return cur.rowcount > 0
+
+
+# ---------------------------------------------------------------------------
+# Data export
+# ---------------------------------------------------------------------------
+
+def _conversations(conn, user_uuid):
+    conversations = []
+    sessions = conn.execute(
+        'SELECT id, name, subject, created_at, updated_at FROM sessions WHERE user_uuid = ? ORDER BY created_at DESC',
+        (user_uuid,)
+    ).fetchall()
+    for s in sessions:
+        session = dict(s)
+        rows = conn.execute(
+            'SELECT * FROM messages WHERE user_uuid = ? AND session_id = ? ORDER BY idx', (user_uuid, s['id'])
+        )
+        session['messages'] = [_message_row(r) for r in rows]
+        conversations.append(session)
+    return conversations
+
+
+def export_user_data(user_uuid):
+    """Return all user data as a dict suitable for JSON export."""
+    with _read() as conn:
+        conversations = _conversations(conn, user_uuid)
+        homework = [
+            _homework_row(r) for r in conn.execute('SELECT * FROM homework WHERE user_uuid = ? ORDER BY rowid', (user_uuid,))
+        ]
+    return {
+        'user': get_user_by_id(user_uuid),
+        'conversations': us._inline_export_images(conversations),
+        'homework': homework,
+        'subjects': get_subjects(user_uuid),
+        'memories': get_memories(user_uuid),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Notification helpers
+# ---------------------------------------------------------------------------
+
+def get_all_user_ids():
+    """Return list of all non-guest user UUIDs."""
+    with _read() as conn:
+        return [r['uuid'] for r in conn.execute('SELECT uuid FROM users ORDER BY rowid')]
+
+
+def get_students_for_class(class_name: str, school: str):
+    """Return list of student user dicts for the given class and school."""
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT * FROM users WHERE school = ? AND class_name = ? AND user_type = 'student' ORDER BY rowid",
+            (school, class_name)
+        )
+        return [_user_row(r) for r in rows]
+
+
+def migrate_inline_images():
+    """Move inline base64 images of stored messages into the blob store."""
+    rewritten = 0
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT user_uuid, session_id, idx, image_data FROM messages WHERE image_data LIKE '%data:%'"
+        ).fetchall()
+    for r in rows:
+        image_data = blob_store.externalize_images(json.loads(r['image_data']))
+        with _write() as conn:
+            conn.execute(
+                'UPDATE messages SET image_data = ? WHERE user_uuid = ? AND session_id = ? AND idx = ?',
+                (json.dumps(image_data), r['user_uuid'], r['session_id'], r['idx'])
+            )
+            _index_message_blobs(conn, r['user_uuid'], r['session_id'], r['idx'], image_data)
+        rewritten += 1
+    if rewritten:
+        print(f"[user_storage] Moved inline images of {rewritten} message(s) to the blob store.")
+    return rewritten
+
+
+def reset_stale_pending_worksheets(keep=(), older_than=timedelta(minutes=10)):
+    """Clear the PENDING worksheet marker of messages no render job will finish."""
+    cutoff = (datetime.now() - older_than).isoformat()
+    keep = set(keep)
+    with _read() as conn:
+        rows = conn.execute(
+            "SELECT user_uuid, session_id, idx FROM messages WHERE worksheet_filename = 'PENDING' AND created_at < ?",
+            (cutoff,)
+        ).fetchall()
+    stale = [r for r in rows if (r['user_uuid'], r['session_id'], r['idx']) not in keep]
+    for r in stale:
+        update_chat_message_worksheet(r['user_uuid'], r['session_id'], r['idx'], None)
+    if stale:
+        print(f"[user_storage] Cleared {len(stale)} worksheet(s) stuck in PENDING.")
+    return len(stale)
+
+
+def get_referenced_files(batch_size=0, pause=0.0):
+    """Worksheet filenames and blob hashes that stored messages still point to.
+
+    Reads batch_size rows per transaction and sleeps `pause` seconds between them.
+    """
+    worksheets, blobs = set(), set()
+    last_rowid = 0
+    while True:
+        with _read() as conn:
+            rows = conn.execute(
+                'SELECT rowid, worksheet_filename, image_data FROM messages '
+                'WHERE rowid > ? AND (worksheet_filename IS NOT NULL OR image_data IS NOT NULL) '
+                'ORDER BY rowid LIMIT ?', (last_rowid, batch_size or -1)
+            ).fetchall()
+        for r in rows:
+            if r['worksheet_filename']:
+                worksheets.add(r['worksheet_filename'])
+            if r['image_data']:
+                blobs |= blob_store.hashes_in(json.loads(r['image_data']))
+        if not batch_size or len(rows) < batch_size:
+            break
+        last_rowid = rows[-1]['rowid']
+        time.sleep(pause)
+    return {'worksheets': worksheets, 'blobs': blobs}
+
+
+def user_references_blob(user_uuid, blob_hash):
+    """Whether one of the user's own sessions has a message pointing to the blob."""
+    if not user_uuid:
+        return False
+    with _read() as conn:
+        row = conn.execute(
+            'SELECT 1 FROM message_blobs WHERE user_uuid = ? AND blob_hash = ? LIMIT 1', (user_uuid, blob_hash)
+        ).fetchone()
+    return row is not None
+
+
+# ---------------------------------------------------------------------------
+# Per-request user context
+# ---------------------------------------------------------------------------
+
+def load_user_context(user_uuid, session_id, include_profile=True, include_previous_chats=False):
+    """Load the chat pipeline's inputs for one turn from a single read snapshot."""
+    ctx = us.UserContext(user_uuid, session_id)
+    if not user_uuid:
+        return ctx
+    with _read() as conn:
+        conn.execute('BEGIN')
+        session = conn.execute(
+            'SELECT id, name, subject, created_at, updated_at, message_count FROM sessions WHERE user_uuid = ? AND id = ?',
+            (user_uuid, session_id)
+        ).fetchone()
+        ctx.session = dict(session) if session else {}
+        ctx.summary = _session_summary(conn, user_uuid, session_id)
+        since = ctx.summary['upto_idx'] if ctx.summary else None
+        ctx.history = _history_page(conn, user_uuid, session_id, since=since)['messages']
+        if include_profile:
+            ctx.user = _user_row(conn.execute('SELECT * FROM users WHERE uuid = ?', (user_uuid,)).fetchone())
+            ctx.subjects = _subjects(conn, user_uuid)
+            ctx.homework = _homework_for_user(conn, user_uuid)
+            ctx.memories = _memories(conn, user_uuid)
+            if include_previous_chats:
+                ctx.previous_chats = _previous_chats_summaries(conn, user_uuid, session_id)
+    return ctx
+
+
+# ---------------------------------------------------------------------------
+# Migration between backends
+# ---------------------------------------------------------------------------
+
+def _import_user_files(conn, user_uuid, user=None):
+    """Copy one user's (or guest's) file-layout data into the database."""
+    if user:
+        conn.execute(
+            'INSERT INTO users (uuid, username, password, user_type, school, class_name, math_solver, is_first_login, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_uuid, user['username'], user['password'], user['user_type'], user.get('school'), user.get('class_name'),
+             int(bool(user.get('math_solver'))), int(bool(user.get('is_first_login'))), user.get('created_at'))
+        )
+    for s in us._load_conversations(user_uuid):
+        msgs = s.get('messages', [])
+        conn.execute(
+            'INSERT OR REPLACE INTO sessions (user_uuid, id, name, subject, created_at, updated_at, message_count, '
+            'first_message_at, last_message_at, preview) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_uuid, s['id'], s.get('name'), s.get('subject'), s.get('created_at'), s.get('updated_at'), len(msgs),
+             msgs[0].get('created_at') if msgs else None, msgs[-1].get('created_at') if msgs else None,
+             json.dumps(us._build_preview(msgs), ensure_ascii=False))
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO messages (user_uuid, session_id, idx, role, content, image_data, worksheet_filename, homework_id, '
+            'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(user_uuid, s['id'], i, m.get('role'), m.get('content'),
+              json.dumps(m['image_data']) if m.get('image_data') else None,
+              m.get('worksheet_filename'), m.get('homework_id'), m.get('created_at'), m.get('updated_at'))
+             for i, m in enumerate(msgs)]
+        )
+        for i, m in enumerate(msgs):
+            _index_message_blobs(conn, user_uuid, s['id'], i, m.get('image_data'))
+    if not user:
+        return
+    conn.executemany(
+        'INSERT OR REPLACE INTO homework (id, user_uuid, title, due_date, notes, subject_id, completed, completed_at, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [(hw['id'], user_uuid, hw.get('title'), hw.get('due_date'), hw.get('notes'), hw.get('subject_id'),
+          int(bool(hw.get('completed'))), hw.get('completed_at'), hw.get('created_at'))
+         for hw in us._load_homework(user_uuid)]
+    )
+    conn.executemany(
+        'INSERT OR REPLACE INTO subjects (id, user_uuid, name, created_at) VALUES (?, ?, ?, ?)',
+        [(s['id'], user_uuid, s['name'], s.get('created_at')) for s in us._load_subjects(user_uuid)]
+    )
+    # memories.json is newest-first; insert oldest first so rowid order matches
+    conn.executemany(
+        'INSERT OR REPLACE INTO memories (id, user_uuid, content, created_at) VALUES (?, ?, ?, ?)',
+        [(m['id'], user_uuid, m['content'], m.get('created_at')) for m in reversed(us._load_memories(user_uuid))]
+    )
+
+
+def migrate_files_to_sqlite():
+    """Copy users from the per-user folder layout into the SQLite database.
+
+    Users whose username already exists in the database are skipped, so the
+    migration can be re-run safely. Returns the number of migrated users.
+    """
+    migrated = 0
+    with us._index_lock():
+        for username, user_uuid in us._load_index().items():
+            with _write() as conn:
+                if conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                    continue
+                user = us._load_user(user_uuid)
+                if not user:
+                    continue
+                _import_user_files(conn, user_uuid, user)
+            migrated += 1
+        guests_dir = os.path.join(us.USERS_DIR, 'guests')
+        if os.path.isdir(guests_dir):
+            for guest_uuid in os.listdir(guests_dir):
+                with _write() as conn:
+                    if conn.execute('SELECT 1 FROM sessions WHERE user_uuid = ? LIMIT 1', (guest_uuid,)).fetchone():
+                        continue
+                    _import_user_files(conn, guest_uuid)
+    if migrated:
+        print(f"[user_storage] Migrated {migrated} user(s) from file storage to SQLite.")
+    return migrated
+
+
+def migrate_sqlite_to_files():
+    """Copy users from the SQLite database into the per-user folder layout.
+
+    Users whose username already exists in users/index.json are skipped.
+    Returns the number of migrated users.
+    """
+    migrated = 0
+    with us._index_lock():
+        index = us._load_index()
+        with _read() as conn:
+            users = [_user_row(r) for r in conn.execute('SELECT * FROM users ORDER BY rowid').fetchall()]
+            guest_ids = [r['user_uuid'] for r in conn.execute(
+                "SELECT DISTINCT user_uuid FROM sessions WHERE user_uuid LIKE 'guest\\_%' ESCAPE '\\'"
+            ).fetchall()]
+            for user in users:
+                if user['username'] in index:
+                    continue
+                user_uuid = user['uuid']
+                user_dir = us.get_user_dir(user_uuid)
+                os.makedirs(user_dir, exist_ok=True)
+                us._save_json(os.path.join(user_dir, 'user.json'), user)
+                us._import_conversations(user_uuid, _conversations(conn, user_uuid))
+                homework = [
+                    _homework_row(r) for r in conn.execute('SELECT * FROM homework WHERE user_uuid = ? ORDER BY rowid', (user_uuid,))
+                ]
+                us._save_json(os.path.join(user_dir, 'homework.json'), homework)
+                us._save_json(os.path.join(user_dir, 'subjects.json'), get_subjects(user_uuid))
+                us._save_json(os.path.join(user_dir, 'memories.json'), get_memories(user_uuid))
+                index[user['username']] = user_uuid
+                migrated += 1
+            for guest_uuid in guest_ids:
+                if not os.path.exists(us._manifest_path(guest_uuid)):
+                    us._import_conversations(guest_uuid, _conversations(conn, guest_uuid))
+        if migrated:
+            us._save_index(index)
+            us._FILE_BACKEND['rebuild_school_index']()
+            print(f"[user_storage] Migrated {migrated} user(s) from SQLite to file storage.")
+    return migrated
+
+
+def migrate_from_sqlite():
+    """Import the legacy users.db into the file layout, then seed an empty database from it."""
+    us._FILE_BACKEND['migrate_from_sqlite']()
+    with _read() as conn:
+        empty = conn.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None
+    if empty and os.path.exists(us.INDEX_FILE):
+        migrate_files_to_sqlite()
@@ -0,0 +1,186 @@
+"""
+Worksheet rendering for /ask.
+
+A worksheet_creation action carries markdown; submit() stores it under
+sheets/<sha256 of the markdown>.md and queues a 'worksheet' job (see
+job_queue) that renders the PDF, so the render survives a dying request and is
+retried on failure. Identical worksheets share one file pair and are rendered
+only once. The last
+attempt falls back to the .md file. WORKSHEET_RENDERER selects the engine:
+'local' (default) uses the offline pdf_renderer in a bounded process pool,
+so layout work does not hold the GIL against request threads; 'remote' posts
+to the md-to-pdf service and falls back to the local engine when the service
+fails. A finished job writes its file onto the chat message it was attached
+to with attach_to_message().
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import requests
+
+import job_queue
+import metrics
+import pdf_renderer
+import render_cache
+import user_storage as us
+
+SHEETS_DIR = 'sheets'
+WORKSHEET_RENDERER = os.getenv('WORKSHEET_RENDERER', 'local').lower()
+MD_TO_PDF_URL = os.getenv('MD_TO_PDF_URL', 'https://api.md-to-pdf.l-ai.pro')
+MD_TO_PDF_TIMEOUT = int(os.getenv('MD_TO_PDF_TIMEOUT', '30'))
+# 0 renders in the calling thread instead of a worker process
+WORKSHEET_RENDER_PROCESSES = int(os.getenv('WORKSHEET_RENDER_PROCESSES', '2'))
+WORKSHEET_RENDER_TIMEOUT = int(os.getenv('WORKSHEET_RENDER_TIMEOUT', '30'))
+WORKSHEET_MAX_ATTEMPTS = int(os.getenv('WORKSHEET_MAX_ATTEMPTS', '3'))
+_process_pool = None
+_process_pool_pid = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    global _process_pool, _process_pool_pid
+    with _process_pool_lock:
+        # A pool inherited through a fork (gunicorn --preload) belongs to the parent
+        if _process_pool is None or _process_pool_pid != os.getpid():
+            _process_pool = ProcessPoolExecutor(max_workers=WORKSHEET_RENDER_PROCESSES)
+            _process_pool_pid = os.getpid()
+            # Fork the workers right away instead of on the first render
+            _process_pool.submit(int).result()
+        return _process_pool
+
+
+def start():
+    """Fork the render processes; call before the process starts other threads.
+
+    A child forked while another thread holds a lock (stdout, sqlite, imports)
+    can hang before it runs a single render.
+    """
+    if WORKSHEET_RENDER_PROCESSES > 0:
+        _get_process_pool()
+
+
+def render_pdf_local(markdown_text):
+    if WORKSHEET_RENDER_PROCESSES <= 0:
+        return pdf_renderer.render_markdown(markdown_text)
+    global _process_pool
+    try:
+        return _get_process_pool().submit(pdf_renderer.render_markdown, markdown_text).result(timeout=WORKSHEET_RENDER_TIMEOUT)
+    except BrokenProcessPool:
+        # A worker died; start a fresh pool for the next render
+        with _process_pool_lock:
+            _process_pool = None
+        raise
+
+
+def render_pdf_remote(markdown_text):
+    response = requests.post(MD_TO_PDF_URL, data={'markdown': markdown_text}, timeout=MD_TO_PDF_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def _engines():
+    if WORKSHEET_RENDERER == 'remote':
+        return [render_pdf_remote, render_pdf_local]
+    return [render_pdf_local]
+
+
+def _write_atomic(path, data):
+    # Identical worksheets share a path; readers must never see a partial file
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _observe_render(engine, started, outcome):
+    metrics.observe('worksheet_render_seconds', time.perf_counter() - started, help='Duration of one PDF render',
+                    engine=engine.__name__.replace('render_pdf_', ''), outcome=outcome)
+
+
+def _render_job(payload, job):
+    """Job handler: render sheets/<md> to sheets/<pdf>.
+
+    Raises while retries are left; the last attempt falls back to the .md file.
+    """
+    pdf_path = os.path.join(SHEETS_DIR, payload['pdf'])
+    if os.path.exists(pdf_path):
+        # Same markdown was rendered before; touch it so storage_gc keeps it
+        os.utime(pdf_path)
+        return {'filename': payload['pdf'], 'error': None}
+    with open(os.path.join(SHEETS_DIR, payload['md']), encoding='utf-8') as f:
+        markdown_text = f.read()
+    error = None
+    for engine in _engines():
+        started = time.perf_counter()
+        try:
+            pdf_bytes = engine(markdown_text)
+            _write_atomic(pdf_path, pdf_bytes)
+            render_cache.put(render_cache.hash_from_filename(payload['pdf']), 'pdf', pdf_bytes)
+            _observe_render(engine, started, 'ok')
+            return {'filename': payload['pdf'], 'error': None}
+        except Exception as e:
+            _observe_render(engine, started, 'error')
+            print(f"PDF generation failed ({engine.__name__}): {e}")
+            error = str(e) or type(e).__name__
+    if job['attempts'] < job['max_attempts']:
+        raise RuntimeError(error)
+    return {'filename': payload['md'], 'error': error}
+
+
+def _attach_to_message(job):
+    """on_finish: store the rendered file on the chat message that waits for it."""
+    target = job['target']
+    filename = (job_result(job) or {}).get('filename')
+    us.update_chat_message_worksheet(target['user_id'], target['session_id'], target['msg_idx'], filename)
+
+
+job_queue.register('worksheet', _render_job, on_finish=_attach_to_message)
+
+
+def submit(md_content, owner=None):
+    """Store the worksheet markdown and queue its PDF render; returns the job id."""
+    markdown_text = md_content.strip()
+    content_hash = render_cache.content_hash(markdown_text)
+    payload = {'md': f"{content_hash}.md", 'pdf': f"{content_hash}.pdf"}
+    md_path = os.path.join(SHEETS_DIR, payload['md'])
+    try:
+        # An identical worksheet exists; mark it as in use for storage_gc
+        os.utime(md_path)
+    except FileNotFoundError:
+        _write_atomic(md_path, markdown_text.encode('utf-8'))
+    job_queue.start()
+    return job_queue.enqueue('worksheet', payload, owner=owner, max_attempts=WORKSHEET_MAX_ATTEMPTS)
+
+
+def read_pdf(filename):
+    """PDF bytes of a content-hash named sheet, served from render_cache when possible."""
+    def load():
+        with open(os.path.join(SHEETS_DIR, filename), 'rb') as f:
+            return f.read()
+    return render_cache.get_or_build(render_cache.hash_from_filename(filename), 'pdf', load)
+
+
+def job_result(job):
+    """{'filename', 'error'} of a finished worksheet job, None while it is still running."""
+    if not job or job['state'] not in job_queue.TERMINAL:
+        return None
+    if job['state'] == job_queue.FAILED:
+        # Failed outside the handler (e.g. the worker died on every attempt)
+        return {'filename': job['payload']['md'], 'error': job['error']}
+    return job['result']
+
+
+def attach_to_message(job_id, user_uuid, session_id, msg_idx):
+    """Let the job update the chat message when it finishes (immediately if it already has)."""
+    job_queue.set_target(job_id, {'user_id': user_uuid, 'session_id': session_id, 'msg_idx': msg_idx})
+
+
+def recover():
+    """Startup: requeue interrupted renders, then clear PENDING markers no job will resolve."""
+    job_queue.recover()
+    live = {(t['user_id'], t['session_id'], t['msg_idx']) for t in job_queue.pending_targets('worksheet')}
+    us.reset_stale_pending_worksheets(keep=live)